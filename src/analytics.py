@@ -0,0 +1,222 @@
+import numpy as np
+
+
+# Directions of crossing of a counting line (sides are seen in the frame looking from the start to the end of the line)
+DIRECTION_FORWARD = 'forward'  # From the left side to the right side
+DIRECTION_BACKWARD = 'backward'  # From the right side to the left side
+directions = [DIRECTION_FORWARD, DIRECTION_BACKWARD]
+
+
+def transform_points(homography, points):
+    """Transform (N,2) points by the 3x3 homography (None - points aren't changed)."""
+    if homography is None:
+        return points
+    transformed = points @ homography[:, :2].T + homography[:, 2]
+    return transformed[:, :2] / transformed[:, 2:]
+
+
+def get_crossings(previous_points, points, lines):
+    """Check which moves of points cross which lines.
+
+    :param previous_points: (K,2) positions in the previous frame
+    :param points: (K,2) positions in the current frame
+    :param lines: (L,2,2) lines given by their start and end points
+    :return: (K,L) int8 array: 0 - no crossing, 1 - forward crossing, -1 - backward crossing
+    """
+    line_starts, line_vectors = lines[None, :, 0], lines[None, :, 1] - lines[None, :, 0]
+    previous_points, moves = previous_points[:, None], (points - previous_points)[:, None]
+
+    def cross(a, b):
+        return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+    # Sides of the line of positions before and after the move (True - left, the y axis points down),
+    # and sides of the move of ends of the line
+    previous_side = cross(line_vectors, previous_points - line_starts) < 0
+    side = cross(line_vectors, points[:, None] - line_starts) < 0
+    start_side = cross(moves, line_starts - previous_points) < 0
+    end_side = cross(moves, line_starts + line_vectors - previous_points) < 0
+    is_crossing = (previous_side != side) & (start_side != end_side)
+    return np.where(is_crossing, np.where(side, -1, 1), 0).astype(np.int8)
+
+
+def get_smoothed_velocities(bank, slots, state):
+    """Get (K,2) velocities of bottom centres of boxes of filters in given slots (per frame): the median of
+    velocities of the last predictions (see `KalmanBank.get_history`) and the current one, so a jump of the box
+    of a tracker (merged or split by the association) doesn't change it much.
+
+    :param state: (K,8) current states of filters (float64)
+    """
+    _, history_velocities, valid = bank.get_history(slots)
+    velocities = np.concatenate([history_velocities.astype(np.float64), state[:, None, 4:]], axis=1)
+    bottom_velocities = np.stack([velocities[:, :, 0] + velocities[:, :, 2] / 2,
+                                  velocities[:, :, 1] + velocities[:, :, 3]], axis=2)
+
+    # Median of a different count of values of each filter: missing ones are sorted after all values
+    bottom_velocities[:, :-1][~valid] = np.inf
+    bottom_velocities.sort(axis=1)
+    counts = valid.sum(axis=1) + 1
+    lower = np.take_along_axis(bottom_velocities, ((counts - 1) // 2)[:, None, None], axis=1)
+    upper = np.take_along_axis(bottom_velocities, (counts // 2)[:, None, None], axis=1)
+    return ((lower + upper) / 2).reshape(-1, 2)
+
+
+class TrafficAnalytics:
+    """Streaming traffic analytics of tracks of a MultiObjectsTracker: speed and heading of each track,
+    counts of vehicles crossing virtual lines (per lane and direction) and aggregates of intervals.
+
+    All values are calculated from states of Kalman filters of the bank (position, size and their velocities),
+    for all tracks at once. The point of a track is the bottom centre of its box (where the vehicle touches
+    the road), its velocity is the median of velocities of the last predictions (see `get_smoothed_velocities`).
+    With a homography (image -> road, e.g. in meters), speeds and headings are in road coordinates.
+    A track is counted at most once by each line and only after `min_life_time` frames (noise tracks die earlier),
+    jumps of boxes (merged or split by the association) don't cross lines.
+    """
+
+    def __init__(self, lines=None, homography=None, fps=25.0, interval_seconds=60.0, roi=None, min_life_time=5,
+                 on_interval=None):
+        """
+        :param lines: counting lines - pairs of points [[x1, y1], [x2, y2]] of the full frame
+        :param homography: 3x3 matrix transforming points of the frame to the road plane (None - pixels)
+        :param fps: frames per second of the source (speeds are in units of the road plane per second)
+        :param interval_seconds: length of intervals of aggregates
+        :param roi: roi.RegionOfInterest with lanes (None - the ROI of the pipeline in `on_frame`, crossings
+                    aren't assigned to lanes without it)
+        :param min_life_time: min count of frames of a counted track
+        :param on_interval: function called with the report of each finished interval (see `get_report`)
+        """
+        self.lines = np.array(lines if lines else np.zeros((0, 2, 2)), dtype=np.float64).reshape(-1, 2, 2)
+        self.homography = np.array(homography, dtype=np.float64).reshape(3, 3) if homography is not None else None
+        self.fps = fps
+        self.interval_frames = max(1, int(round(interval_seconds * fps)))
+        self.roi = roi
+        self.min_life_time = min_life_time
+        self.on_interval = on_interval
+        self.reports = []
+
+        # Current tracks (sorted by ids)
+        self.track_ids = np.zeros(0, dtype=np.int64)
+        self.points = np.zeros((0, 2))  # Bottom centres in the frame
+        self.speeds = np.zeros(0)
+        self.headings = np.zeros(0)  # Degrees, 0 - along the x axis, 90 - along the y axis
+        self.__counted = np.zeros((0, len(self.lines)), dtype=bool)  # Tracks already counted by lines
+
+        # Aggregates of the current interval: by line, lane (0 - unknown) and direction (allocated when the ROI
+        # is known - in the first frame)
+        self.__counts = None
+        self.__crossing_speeds = None
+        self.__speeds_total = 0.0
+        self.__speeds_count = 0
+        self.__interval_start = None
+        self.__last_frame = None
+
+    @staticmethod
+    def from_config(config, fps=25.0, on_interval=None):
+        """Get analytics with lines, homography and the interval of the config."""
+        return TrafficAnalytics(config.counting_lines, config.homography, fps, config.analytics_interval_seconds,
+                                on_interval=on_interval)
+
+    def on_frame(self, frame_index, pipeline):
+        """Update analytics by tracks of the pipeline (`on_frame` of `pipeline.run_headless` etc.)."""
+        if self.roi is None and self.__counts is None:
+            self.roi = pipeline.roi
+        self.update(frame_index, pipeline.multi_tracker)
+
+    def update(self, frame_index, multi_tracker):
+        if self.__counts is None:
+            lanes_count = len(self.roi.lanes) if self.roi is not None else 0
+            self.__counts = np.zeros((len(self.lines), lanes_count + 1, 2), dtype=np.int64)
+            self.__crossing_speeds = np.zeros(self.__counts.shape)
+        if self.__interval_start is None:
+            self.__interval_start = frame_index
+        elif frame_index - self.__interval_start >= self.interval_frames:
+            self.__finish_interval()
+            self.__interval_start = frame_index
+        self.__last_frame = frame_index
+
+        trackers = multi_tracker.trackers
+        trackers_count = len(trackers)
+        slots = np.fromiter((tracker.slot for tracker in trackers), dtype=np.intp, count=trackers_count)
+        track_ids = np.fromiter((tracker.tracker_id for tracker in trackers), dtype=np.int64, count=trackers_count)
+        life_times = np.fromiter((tracker.life_time for tracker in trackers), dtype=np.int64, count=trackers_count)
+        order = np.argsort(track_ids)
+        slots, track_ids, life_times = slots[order], track_ids[order], life_times[order]
+
+        # State: x, y, w, h and their velocities (per frame)
+        state = multi_tracker.bank.state_post[slots].astype(np.float64)
+        points = np.stack([state[:, 0] + state[:, 2] / 2, state[:, 1] + state[:, 3]], axis=1)
+        velocities = get_smoothed_velocities(multi_tracker.bank, slots, state)
+        road_points = transform_points(self.homography, points)
+        road_velocities = (transform_points(self.homography, points + velocities) - road_points) * self.fps
+        speeds = np.hypot(road_velocities[:, 0], road_velocities[:, 1])
+        headings = np.degrees(np.arctan2(road_velocities[:, 1], road_velocities[:, 0]))
+
+        # Tracks existing in the previous frame (ids are sorted)
+        previous_indexes = np.searchsorted(self.track_ids, track_ids)
+        previous_indexes = np.minimum(previous_indexes, max(len(self.track_ids) - 1, 0))
+        is_continued = np.zeros(trackers_count, dtype=bool)
+        if len(self.track_ids) > 0:
+            is_continued = self.track_ids[previous_indexes] == track_ids
+        counted = np.zeros((trackers_count, len(self.lines)), dtype=bool)
+        counted[is_continued] = self.__counted[previous_indexes[is_continued]]
+
+        if len(self.lines) > 0 and is_continued.any():
+            crossings = np.zeros(counted.shape, dtype=np.int8)
+            crossings[is_continued] = get_crossings(self.points[previous_indexes[is_continued]], points[is_continued],
+                                                    self.lines)
+            # A move far from the smoothed velocity (by more than a half of the box) is a jump of the tracker
+            # (e.g. its box was merged with another one or split), not a move of the vehicle
+            deviations = points - self.points[previous_indexes] - velocities
+            is_jump = np.hypot(deviations[:, 0], deviations[:, 1]) > np.minimum(state[:, 2], state[:, 3]) / 2
+            crossings[counted | (life_times < self.min_life_time)[:, None] | is_jump[:, None]] = 0
+            track_indexes, line_indexes = np.nonzero(crossings)
+            if len(track_indexes) > 0:
+                lanes = self.roi.get_lanes(points[track_indexes]) + 1 if self.roi is not None else 0
+                direction_indexes = (crossings[track_indexes, line_indexes] < 0).astype(np.intp)
+                np.add.at(self.__counts, (line_indexes, lanes, direction_indexes), 1)
+                np.add.at(self.__crossing_speeds, (line_indexes, lanes, direction_indexes), speeds[track_indexes])
+                counted[track_indexes, line_indexes] = True
+
+        self.track_ids, self.points, self.speeds, self.headings = track_ids, points, speeds, headings
+        self.__counted = counted
+        self.__speeds_total += float(speeds.sum())
+        self.__speeds_count += trackers_count
+
+    def get_tracks(self):
+        """Get the current speed and heading of each track: list of dicts."""
+        return [{'id': track_id, 'speed': speed, 'heading': heading}
+                for track_id, speed, heading in zip(self.track_ids.tolist(), self.speeds.tolist(),
+                                                    self.headings.tolist())]
+
+    def get_report(self):
+        """Get aggregates of the current interval: counts and mean speeds of crossing vehicles by line, lane
+        (None - unknown) and direction, and the mean speed of all tracks in all frames."""
+        crossings = []
+        counts = self.__counts if self.__counts is not None else np.zeros((0, 1, 2), dtype=np.int64)
+        for line_index, lane_index, direction_index in zip(*np.nonzero(counts)):
+            count = int(counts[line_index, lane_index, direction_index])
+            crossings.append({
+                'line': int(line_index), 'lane': int(lane_index) - 1 if lane_index > 0 else None,
+                'direction': directions[direction_index], 'count': count,
+                'mean_speed': float(self.__crossing_speeds[line_index, lane_index, direction_index]) / count})
+        return {
+            'first_frame': self.__interval_start, 'last_frame': self.__last_frame,
+            'start_seconds': self.__interval_start / self.fps if self.__interval_start is not None else None,
+            'crossings': crossings,
+            'mean_speed': self.__speeds_total / self.__speeds_count if self.__speeds_count > 0 else None,
+        }
+
+    def finish(self):
+        """Finish the last (not full) interval - e.g. at the end of the video."""
+        if self.__interval_start is not None:
+            self.__finish_interval()
+            self.__interval_start = None
+
+    def __finish_interval(self):
+        report = self.get_report()
+        self.reports.append(report)
+        if self.on_interval is not None:
+            self.on_interval(report)
+        self.__counts[:] = 0
+        self.__crossing_speeds[:] = 0
+        self.__speeds_total = 0.0
+        self.__speeds_count = 0
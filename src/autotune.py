@@ -0,0 +1,326 @@
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import traceback
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from config import PipelineConfig
+from evaluate import find_clips, metrics_names, summarize
+from pipeline import FramePipeline
+from tests.correct_regions import load_vatic_regions
+from tracker.metrics import AllMetricWrapper
+
+
+# Parameters changing masks of the background subtractor - masks are cached for each combination of them,
+# other parameters (morphology, detection, tracking) are tuned on cached masks
+mask_parameters = ['blur', 'n_mixtures', 'learning_rate_of_subtractor', 'history', 'var_threshold',
+                   'quick_start_learning_rate', 'downscale', 'roi_polygons']
+
+# Default space of parameters: trackbars (without 'Shadows' - headless pipeline always removes shadows
+# by the threshold) and constants of the subtractor and tracker
+default_space = {
+    'erode': [0, 1, 2, 3, 4],
+    'dilate': [0, 1, 2, 3, 4],
+    'blur': [0, 6, 12],
+    'kernel_open': [0, 3, 6],
+    'kernel_close': [0, 15, 25, 35],
+    'n_mixtures': [3, 4, 5],
+    'learning_rate_of_subtractor': [-1, 0.001, 0.0001],
+    'max_frames_count_of_missing_track': [3, 5, 8],
+}
+searches = ['grid', 'random', 'halving']
+
+
+def get_mask_key(config):
+    """Get JSON text of parameters of the config which change masks of the background subtractor."""
+    parameters = config.to_dict()
+    return json.dumps({name: parameters[name] for name in mask_parameters}, sort_keys=True)
+
+
+def get_masks_path(cache_directory, video_path, mask_key):
+    """Get path (without extension) of cached masks of the video - the name depends on the video file too."""
+    stat = os.stat(video_path)
+    key = json.dumps([os.path.abspath(video_path), stat.st_size, stat.st_mtime_ns, mask_key])
+    name = os.path.basename(video_path) + '.' + hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(cache_directory, name)
+
+
+class CompressedMasks:
+    """Cached masks of frames of a video: packed bits of each frame compressed by zlib (binary masks compress
+    very well), read from the memory-mapped file and decompressed on access."""
+
+    def __init__(self, path, offsets, height, packed_width):
+        """
+        :param offsets: T+1 offsets of compressed frames in the file (the last one - the size of the file)
+        """
+        self.offsets = offsets
+        self.shape = (height, packed_width)
+        self.__data = np.memmap(path, dtype=np.uint8, mode='r') if offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, frame_index):
+        """Get (H,W/8) array of packed bits of the mask of the frame."""
+        data = self.__data[self.offsets[frame_index]:self.offsets[frame_index + 1]]
+        return np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(self.shape)
+
+
+def load_masks(masks_path):
+    """Load cached masks, or None if they aren't cached.
+
+    :return: (masks, width, frame_shape) - CompressedMasks of frames, the width of masks and the shape of frames
+             of the video (needed by the ROI - see `RegionOfInterest.prepare`)
+    """
+    try:
+        with open(masks_path + '.json') as shape_file:
+            shape = json.load(shape_file)
+        frame_shape = tuple(shape['frame_shape'])
+        offsets = shape['offsets']  # Missing in caches of uncompressed masks - they are computed again
+    except (OSError, ValueError, KeyError):
+        return None
+    masks = CompressedMasks(masks_path + '.bin', offsets, shape['height'], (shape['width'] + 7) // 8)
+    return masks, shape['width'], frame_shape
+
+
+def compute_masks(video_path, configs, cache_directory):
+    """Compute masks of the background subtractor (before morphology) of the video for each config whose
+    masks aren't cached yet. The video is decoded only once for all configs.
+
+    Masks are saved as packed bits (8 pixels per byte) compressed by zlib (see `CompressedMasks`), the JSON file
+    with their shape and offsets of frames is written at the end, so only complete files are used.
+    :return: count of computed variants of masks
+    """
+    pipelines = {}
+    for config in configs:
+        masks_path = get_masks_path(cache_directory, video_path, get_mask_key(config))
+        if masks_path not in pipelines and load_masks(masks_path) is None:
+            pipelines[masks_path] = FramePipeline(config)
+    if not pipelines:
+        return 0
+
+    video_capture = cv2.VideoCapture(video_path)
+    if not video_capture.isOpened():
+        raise IOError("Can't open the video: " + video_path)
+    os.makedirs(cache_directory, exist_ok=True)
+    ret, frame = video_capture.read()
+    first_frame = frame
+    masks_files = {masks_path: open(masks_path + '.bin', 'wb') for masks_path in pipelines}
+    shapes = {masks_path: None for masks_path in pipelines}
+    offsets = {masks_path: [0] for masks_path in pipelines}
+    frames_count = 0
+    try:
+        if ret:
+            for pipeline in pipelines.values():
+                pipeline.start(frame)
+            while True:
+                ret, frame = video_capture.read()
+                if not ret:
+                    break
+                frames_count += 1
+                for masks_path, pipeline in pipelines.items():
+                    mask = pipeline.subtract_background(frame)
+                    shapes[masks_path] = mask.shape
+                    data = zlib.compress(np.packbits(mask > 0, axis=1).tobytes(), 1)
+                    masks_files[masks_path].write(data)
+                    offsets[masks_path].append(offsets[masks_path][-1] + len(data))
+    finally:
+        video_capture.release()
+        for masks_file in masks_files.values():
+            masks_file.close()
+    frame_shape = list(first_frame.shape) if first_frame is not None else []
+    for masks_path, shape in shapes.items():
+        height, width = shape if shape is not None else (0, 0)
+        with open(masks_path + '.json', 'w') as shape_file:
+            json.dump({'frames': frames_count, 'height': height, 'width': width, 'frame_shape': frame_shape,
+                       'offsets': offsets[masks_path]}, shape_file)
+    return len(pipelines)
+
+
+def evaluate_on_masks(video_path, vatic_path, config, cache_directory, max_frames=None):
+    """Evaluate the config on cached masks of the video (see `evaluate.evaluate_clip`) - only morphology,
+    detection and tracking are made, without decoding of the video.
+
+    :param max_frames: evaluate only given count of first frames (None - all frames)
+    :return: dict with results of metrics and counts of their values (or error)
+    """
+    result = {'clip': os.path.basename(video_path), 'video': video_path, 'vatic': vatic_path}
+    try:
+        right_regions = load_vatic_regions(vatic_path)
+        loaded_masks = load_masks(get_masks_path(cache_directory, video_path, get_mask_key(config)))
+        if loaded_masks is None:
+            raise IOError("Masks aren't cached: " + video_path)
+        masks, width, frame_shape = loaded_masks
+        frames_count = min(len(masks), len(right_regions) - 1)
+        if max_frames is not None:
+            frames_count = min(frames_count, max_frames)
+
+        pipeline = FramePipeline(config)
+        if pipeline.roi is not None:
+            pipeline.roi.prepare(frame_shape)  # Frames aren't cropped here, but regions are moved and filtered
+        all_metrics = AllMetricWrapper()
+        for frame_index in range(frames_count):
+            mask = np.unpackbits(masks[frame_index], axis=1, count=width)
+            np.multiply(mask, 255, out=mask)
+            pipeline.track(pipeline.detect(pipeline.apply_morphology(mask)))
+            if pipeline.predictions is not None:
+                all_metrics.update_metric_for_frame(right_regions[pipeline.frames_processed], pipeline.predictions)
+
+        result['frames'] = frames_count
+        for name, value, count in zip(metrics_names, all_metrics.calculate_result(), all_metrics.calculate_counts()):
+            result[name] = value
+            result[name + '_count'] = count
+    except Exception:
+        result['error'] = traceback.format_exc()
+    return result
+
+
+def get_score(summary, objective='mean'):
+    """Get the score of the summary of clips (higher is better): one of metrics or 'mean' of all of them."""
+    if summary['failed'] > 0:
+        return -math.inf
+    if objective != 'mean':
+        value = summary[objective]
+        return value if value is not None else -math.inf
+    values = [summary[name] for name in metrics_names]
+    if any(value is None for value in values):
+        return -math.inf
+    return sum(values) / len(values)
+
+
+def get_grid_candidates(space):
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*[space[name] for name in names])]
+
+
+def get_random_candidates(space, trials, seed=0):
+    """Get unique random combinations of values (all of them if there are fewer combinations than trials)."""
+    combinations_count = 1
+    for values in space.values():
+        combinations_count *= len(values)
+    if combinations_count <= trials:
+        return get_grid_candidates(space)
+    generator = random.Random(seed)
+    candidates = {}
+    while len(candidates) < trials:
+        candidate = {name: generator.choice(values) for name, values in sorted(space.items())}
+        candidates[json.dumps(candidate, sort_keys=True)] = candidate
+    return list(candidates.values())
+
+
+class Autotuner:
+    """Search parameters of the pipeline giving the best metrics on clips with VATIC ground truth.
+
+    Masks of the background subtractor are computed once for each combination of `mask_parameters`
+    (all combinations of a clip in one pass over the video) and cached on disk. Candidates are evaluated
+    on cached masks - only morphology, detection and tracking are repeated. Jobs (clips for masks,
+    pairs of a candidate and a clip for evaluation) run in a process pool.
+    """
+
+    def __init__(self, directory, cache_directory, base_config=None, objective='mean', processes=None):
+        """
+        :param directory: directory with videos and VATIC xml files (see `evaluate.find_clips`)
+        :param cache_directory: directory of cached masks
+        :param base_config: PipelineConfig with values of parameters which aren't tuned
+        :param objective: 'mean' of all metrics or name of one of them (see `evaluate.metrics_names`)
+        :param processes: count of working processes
+        """
+        self.clips = find_clips(directory)
+        self.cache_directory = cache_directory
+        self.base_config = base_config if base_config is not None else PipelineConfig()
+        self.objective = objective
+        self.processes = processes
+        self.results = []  # (candidate, summary, score) of all evaluations
+        os.makedirs(cache_directory, exist_ok=True)
+
+    def get_config(self, candidate):
+        parameters = self.base_config.to_dict()
+        parameters.update(candidate)
+        return PipelineConfig(**parameters)
+
+    def search(self, space, search='random', trials=20, eta=3, min_frames=50, seed=0):
+        """Search the space of parameters ({name of config attribute: list of values}).
+
+        :param search: 'grid' (all combinations), 'random' (given count of trials) or 'halving'
+                       (successive halving - random trials evaluated on `min_frames` first frames,
+                       the best 1/eta of them on eta times more frames, and so on)
+        :return: list of (candidate, summary, score) sorted from the best
+        """
+        if search == 'grid':
+            candidates = get_grid_candidates(space)
+        elif search in ('random', 'halving'):
+            candidates = get_random_candidates(space, trials, seed)
+        else:
+            raise ValueError("Unknown search: " + str(search))
+
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            self.__compute_masks(executor, candidates)
+            max_frames = min_frames if search == 'halving' else None
+            while True:
+                if search == 'halving' and len(candidates) <= eta:
+                    max_frames = None  # The last round on whole clips
+                ranking = self.__evaluate(executor, candidates, max_frames)
+                if max_frames is None:
+                    return ranking
+                candidates = [candidate for candidate, _, _ in ranking[:max(1, int(math.ceil(len(ranking) / eta)))]]
+                max_frames *= eta
+
+    def __compute_masks(self, executor, candidates):
+        configs = [self.get_config(candidate) for candidate in candidates]
+        unique_configs = list({get_mask_key(config): config for config in configs}.values())
+        futures = [executor.submit(compute_masks, video_path, unique_configs, self.cache_directory)
+                   for video_path, _ in self.clips]
+        for future in futures:
+            future.result()
+
+    def __evaluate(self, executor, candidates, max_frames):
+        futures = [[executor.submit(evaluate_on_masks, video_path, vatic_path, self.get_config(candidate),
+                                    self.cache_directory, max_frames)
+                    for video_path, vatic_path in self.clips]
+                   for candidate in candidates]
+        ranking = []
+        for candidate, candidate_futures in zip(candidates, futures):
+            summary = summarize([future.result() for future in candidate_futures])
+            summary['max_frames'] = max_frames
+            ranking.append((candidate, summary, get_score(summary, self.objective)))
+        self.results.extend(ranking)
+        ranking.sort(key=lambda item: item[2], reverse=True)
+        return ranking
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune parameters of processing on videos with VATIC ground truth "
+                                                 "(pairs of files: name.mp4 and name.xml).")
+    parser.add_argument('directory', help="directory with videos and VATIC xml files")
+    parser.add_argument('--search', choices=searches, default='random', help="strategy of the search")
+    parser.add_argument('--trials', type=int, default=20, help="count of random candidates (random and halving)")
+    parser.add_argument('--space', help="JSON file with lists of values of parameters (default: trackbars, "
+                                        "n_mixtures, learning_rate_of_subtractor, max_frames_count_of_missing_track)")
+    parser.add_argument('--config', help="JSON file with values of parameters which aren't tuned")
+    parser.add_argument('--objective', choices=['mean'] + metrics_names, default='mean', help="maximized metric")
+    parser.add_argument('--cache', default='.autotune-cache', help="directory of cached masks")
+    parser.add_argument('--processes', type=int, default=None, help="count of working processes")
+    parser.add_argument('--output', help="save the best config to the JSON file")
+    args = parser.parse_args()
+
+    if args.space:
+        with open(args.space) as space_file:
+            search_space = json.load(space_file)
+    else:
+        search_space = default_space
+    autotuner = Autotuner(args.directory, args.cache, PipelineConfig.from_file(args.config) if args.config else None,
+                          args.objective, args.processes)
+    best = autotuner.search(search_space, args.search, args.trials)
+    for best_candidate, best_summary, best_score in best[:10]:
+        print('{score:.4f}'.format(score=best_score), json.dumps(best_candidate, sort_keys=True),
+              ', '.join(name + '=' + str(best_summary[name]) for name in metrics_names))
+    if args.output and best:
+        autotuner.get_config(best[0][0]).save(args.output)
@@ -0,0 +1,143 @@
+"""Reproducible benchmarks of the pipeline and of the tracker on synthetic traffic scenes.
+
+Run from the `src` directory:
+    python -m benchmarks.run_benchmarks --output results.json [--quick] [--compare previous.json]
+"""
+import argparse
+import json
+import platform
+import subprocess
+import time
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from benchmarks.synthetic import SyntheticTrafficScene, SyntheticVideoCapture
+from config import PipelineConfig
+from instrumentation import Instrumentation
+from pipeline import run_headless
+from region import RegionArray
+from tracker.multi_tracker import MultiObjectsTracker
+
+
+resolutions = {
+    '240p': (426, 240),
+    '360p': (640, 360),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '4K': (3840, 2160),
+}
+objects_counts = [1, 10, 50, 100, 200, 500]
+quick_resolutions = ['240p', '720p']
+quick_objects_counts = [1, 10, 50]
+
+
+def benchmark_pipeline(resolution, objects_count, frames_count=100, seed=0):
+    """Measure FPS and time of stages of the whole pipeline (rendering of frames is not included)."""
+    width, height = resolutions[resolution]
+    scene = SyntheticTrafficScene(width, height, objects_count=objects_count, seed=seed)
+    video_capture = SyntheticVideoCapture(scene, frames_count + 1)
+    config = PipelineConfig(max_object_count=max(30, objects_count * 4), frames_count_to_stabilize=5)
+    instrumentation = Instrumentation()
+    run_headless(video_capture, config, instrumentation=instrumentation, verbose=False)
+
+    summary = instrumentation.summary()
+    frame_seconds = summary['stages']['frame']['total_seconds']
+    return {
+        'benchmark': 'pipeline',
+        'resolution': resolution,
+        'objects_count': objects_count,
+        'frames': frames_count,
+        'fps': frames_count / frame_seconds if frame_seconds > 0 else None,
+        'stages_ms': {name: stage['mean'] * 1000 for name, stage in summary['stages'].items() if 'mean' in stage},
+    }
+
+
+def benchmark_tracker(objects_count, frames_count=200, seed=0):
+    """Measure time of `MultiObjectsTracker.update` alone, on ground truth boxes with jitter as measures."""
+    scene = SyntheticTrafficScene(1920, 1080, objects_count=objects_count, noise=0, seed=seed)
+    random = np.random.RandomState(seed)
+    measures = []
+    for _ in range(frames_count):
+        scene_ground_truth = scene.render_next_frame()[1]
+        boxes = scene_ground_truth[:, 1:] + random.randint(-2, 3, size=(len(scene_ground_truth), 4))
+        boxes[:, 2:] = np.maximum(boxes[:, 2:], 1)
+        measures.append(RegionArray(boxes))
+
+    multi_tracker = MultiObjectsTracker(lost_track_patience=5)
+    start_time = perf_counter()
+    for measured_regions in measures:
+        multi_tracker.update(measured_regions)
+    seconds = perf_counter() - start_time
+    return {
+        'benchmark': 'tracker_update',
+        'objects_count': objects_count,
+        'frames': frames_count,
+        'update_ms': seconds / frames_count * 1000,
+        'trackers': len(multi_tracker.trackers),
+    }
+
+
+def get_environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+    }
+
+
+def run_all(quick=False, frames_count=100):
+    results = []
+    for objects_count in (quick_objects_counts if quick else objects_counts):
+        results.append(benchmark_tracker(objects_count, frames_count * 2))
+        print(results[-1])
+    for resolution in (quick_resolutions if quick else resolutions):
+        for objects_count in (quick_objects_counts if quick else objects_counts):
+            results.append(benchmark_pipeline(resolution, objects_count, frames_count))
+            print({key: value for key, value in results[-1].items() if key != 'stages_ms'})
+    return {'environment': get_environment(), 'results': results}
+
+
+def get_result_key(result):
+    return result['benchmark'], result.get('resolution'), result['objects_count']
+
+
+def compare(previous, actual):
+    """Print relative changes of main values of benchmarks (FPS or time of update) between two runs."""
+    previous_results = {get_result_key(result): result for result in previous['results']}
+    for result in actual['results']:
+        previous_result = previous_results.get(get_result_key(result))
+        if previous_result is None:
+            continue
+        value_name = 'fps' if result['benchmark'] == 'pipeline' else 'update_ms'
+        if previous_result[value_name] and result[value_name]:
+            change = (result[value_name] / previous_result[value_name] - 1) * 100
+            print('{key}: {name} {old:.3f} -> {new:.3f} ({change:+.1f}%)'.format(
+                key=get_result_key(result), name=value_name, old=previous_result[value_name],
+                new=result[value_name], change=change))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of tracking on synthetic traffic scenes.")
+    parser.add_argument('--output', help="save results to the JSON file")
+    parser.add_argument('--quick', action='store_true', help="only small subset of resolutions and objects counts")
+    parser.add_argument('--frames', type=int, default=100, help="count of frames of each pipeline benchmark")
+    parser.add_argument('--compare', help="JSON file with results of a previous run")
+    args = parser.parse_args()
+
+    all_results = run_all(args.quick, args.frames)
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            json.dump(all_results, results_file, indent=2)
+    if args.compare:
+        with open(args.compare) as previous_file:
+            compare(json.load(previous_file), all_results)
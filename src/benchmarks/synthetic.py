@@ -0,0 +1,176 @@
+import cv2
+import numpy as np
+
+
+class SyntheticTrafficScene:
+    """Synthetic traffic scene: rectangles (vehicles) moving along horizontal lanes on a static road.
+
+    Each call of `render_next_frame` moves vehicles and returns the frame and the ground truth:
+    (N,5) int32 array of (object_id, x, y, w, h) of visible parts of vehicles. A vehicle leaving
+    the frame comes back on the other side as a new object (with a new id).
+    """
+    noise_frames_count = 4
+
+    def __init__(self, width=640, height=360, objects_count=10, speed=(2.0, 6.0), size=(0.08, 0.16),
+                 occluders_count=0, noise=4.0, seed=0):
+        """
+        :param objects_count: count of vehicles in the scene at the same time
+        :param speed: range of speeds of vehicles (pixels per frame, scaled with the width of 640 pixels)
+        :param size: range of lengths of vehicles as fraction of the height of the frame
+        :param occluders_count: count of static vertical poles drawn in front of vehicles
+        :param noise: standard deviation of gaussian noise of the camera
+        """
+        self.width = width
+        self.height = height
+        self.objects_count = objects_count
+        self.speed = speed
+        self.size = size
+        self.random = np.random.RandomState(seed)
+        self.background = self.__create_background()
+        self.occluders = self.__create_occluders(occluders_count)
+        self.noise_frames = [self.__create_noise(noise) for _ in range(SyntheticTrafficScene.noise_frames_count)]
+        self.frame_index = 0
+        self.next_object_id = 0
+
+        # Vehicles: x (float), lane, speed, w, h, color and id; lanes are stretched over the whole road
+        self.lanes_count = max(2, min(objects_count, height // 40))
+        self.lane_height = (self.height * 0.8) / self.lanes_count
+        self.vehicles = [self.__create_vehicle(start_x=self.random.uniform(-0.2, 1.0) * width)
+                         for _ in range(objects_count)]
+
+    def __create_background(self):
+        background = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        background[:] = (70, 110, 80)  # Verge
+        road_top, road_bottom = int(self.height * 0.1), int(self.height * 0.9)
+        background[road_top:road_bottom] = (90, 90, 90)
+        for y in np.linspace(road_top, road_bottom, 5)[1:-1]:
+            for x in range(0, self.width, 40):
+                cv2.line(background, (x, int(y)), (x + 20, int(y)), (220, 220, 220), 2)
+        return background
+
+    def __create_occluders(self, count):
+        xs = self.random.randint(0, max(1, self.width - 10), size=count)
+        return [(int(x), max(4, self.width // 100)) for x in xs]
+
+    def __create_noise(self, sigma):
+        if sigma <= 0:
+            return None
+        return self.random.normal(0, sigma, size=(self.height, self.width, 3)).astype(np.int16)
+
+    def __create_vehicle(self, start_x=None):
+        length = int(self.random.uniform(*self.size) * self.height * 2)
+        width = int(min(self.lane_height * 0.8, length * 0.6))
+        lane = self.random.randint(self.lanes_count)
+        speed = self.random.uniform(*self.speed) * self.width / 640.0
+        direction = 1 if lane % 2 == 0 else -1
+        if start_x is None:
+            start_x = -length if direction > 0 else self.width
+        color = tuple(int(c) for c in self.random.randint(0, 256, size=3))
+        vehicle = [float(start_x), lane, speed * direction, max(length, 4), max(width, 4), color, self.next_object_id]
+        self.next_object_id += 1
+        return vehicle
+
+    def __get_vehicle_box(self, vehicle):
+        x, lane, _, w, h = vehicle[:5]
+        y = self.height * 0.1 + lane * self.lane_height + (self.lane_height - h) / 2
+        return int(x), int(y), w, h
+
+    def render_next_frame(self):
+        """Move vehicles and render the frame.
+
+        :return: (BGR frame, ground truth as (N,5) int32 array of object_id, x, y, w, h)
+        """
+        frame = self.background.copy()
+        ground_truth = []
+        for i, vehicle in enumerate(self.vehicles):
+            vehicle[0] += vehicle[2]
+            x, y, w, h = self.__get_vehicle_box(vehicle)
+            if x > self.width or x + w < 0:
+                self.vehicles[i] = vehicle = self.__create_vehicle()
+                x, y, w, h = self.__get_vehicle_box(vehicle)
+            cv2.rectangle(frame, (x, y), (x + w, y + h), vehicle[5], -1)
+            visible_x, visible_x2 = max(x, 0), min(x + w, self.width - 1)
+            if visible_x2 > visible_x:
+                ground_truth.append((vehicle[6], visible_x, y, visible_x2 - visible_x, h))
+        for x, pole_width in self.occluders:
+            frame[:, x:x + pole_width] = (40, 40, 40)
+
+        noise = self.noise_frames[self.frame_index % len(self.noise_frames)]
+        if noise is not None:
+            frame = np.clip(frame + noise, 0, 255).astype(np.uint8)
+        self.frame_index += 1
+        return frame, np.array(ground_truth, dtype=np.int32).reshape(-1, 5)
+
+
+class SyntheticVideoCapture:
+    """Stand-in for cv2.VideoCapture rendering frames of a synthetic scene on the fly."""
+
+    def __init__(self, scene, frames_count, fps=25.0):
+        self.scene = scene
+        self.frames_count = frames_count
+        self.fps = fps
+        self.ground_truth = []  # Ground truth of each read frame
+        self.__opened = True
+
+    def isOpened(self):
+        return self.__opened
+
+    def read(self):
+        if not self.__opened or self.scene.frame_index >= self.frames_count:
+            return False, None
+        frame, ground_truth = self.scene.render_next_frame()
+        self.ground_truth.append(ground_truth)
+        return True, frame
+
+    def grab(self):
+        return self.read()[0]
+
+    def get(self, property_id):
+        if property_id == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.scene.width)
+        if property_id == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.scene.height)
+        if property_id == cv2.CAP_PROP_FPS:
+            return self.fps
+        if property_id == cv2.CAP_PROP_FRAME_COUNT:
+            return float(self.frames_count)
+        return 0.0
+
+    def set(self, property_id, value):
+        return False
+
+    def release(self):
+        self.__opened = False
+
+
+def write_video(scene, path, frames_count, fps=25.0, fourcc='MJPG'):
+    """Render the scene to the video file and return ground truth of all frames."""
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, (scene.width, scene.height))
+    ground_truth = []
+    for _ in range(frames_count):
+        frame, frame_ground_truth = scene.render_next_frame()
+        writer.write(frame)
+        ground_truth.append(frame_ground_truth)
+    writer.release()
+    return ground_truth
+
+
+def write_vatic_xml(ground_truth, path, label='car'):
+    """Write ground truth (list of (N,5) arrays of object_id, x, y, w, h for each frame) as a VATIC output file,
+    which can be read by `tests.correct_regions.load_vatic_regions`."""
+    polygons_by_object = {}
+    for t, frame_ground_truth in enumerate(ground_truth):
+        for object_id, x, y, w, h in frame_ground_truth.tolist():
+            polygons_by_object.setdefault(object_id, []).append((t, x, y, x + w, y + h))
+
+    with open(path, 'w') as xml_file:
+        xml_file.write('<?xml version="1.0" encoding="utf-8"?>\n<annotation>\n')
+        for object_id, polygons in sorted(polygons_by_object.items()):
+            xml_file.write('<object><name>{label}</name><deleted>0</deleted><verified>0</verified>'
+                           '<id>{id}</id>\n'.format(label=label, id=object_id))
+            for t, x, y, x2, y2 in polygons:
+                points = ((x, y), (x, y2), (x2, y2), (x2, y))
+                xml_file.write('<polygon><t>{t}</t>{points}</polygon>\n'.format(t=t, points=''.join(
+                    '<pt><x>{x}</x><y>{y}</y><l>1</l></pt>'.format(x=px, y=py) for px, py in points)))
+            xml_file.write('</object>\n')
+        xml_file.write('</annotation>\n')
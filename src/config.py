@@ -0,0 +1,82 @@
+import json
+
+
+class PipelineConfig:
+    """Parameters of the processing pipeline which are normally adjusted with trackbars.
+
+    Used when there is no display (headless mode), so every kernel size and threshold
+    has to be known before the first frame.
+    """
+    # Names of trackbars and matching attributes
+    trackbar_attributes = {
+        'Erode': 'erode',
+        'Dilate': 'dilate',
+        'Blur': 'blur',
+        'Kernel_OPEN': 'kernel_open',
+        'Kernel_CLOSE': 'kernel_close',
+        'Shadows': 'shadows',
+    }
+
+    def __init__(self, **parameters):
+        # Morphological transformations (default values are the same as default trackbars positions)
+        self.erode = 2
+        self.dilate = 2
+        self.blur = 12
+        self.kernel_open = 0
+        self.kernel_close = 25
+        self.shadows = 0
+        self.downscale = 1  # Mask is calculated on frames smaller by this factor (e.g. 2 - half width and height)
+
+        # Region of interest - polygons as lists of points [x, y] of the full frame (see roi.RegionOfInterest)
+        self.roi_polygons = []  # Only their bounding rectangle is processed, pixels outside them are cleared
+        self.lane_polygons = []  # Regions with centres outside all lanes are discarded
+
+        # Background subtractor
+        self.history = 5000
+        self.var_threshold = 16
+        self.n_mixtures = 4
+        self.learning_rate_of_subtractor = -1  # Negative - automatic (1 / count of frames, up to the history)
+        self.quick_start_learning_rate = 0.01
+
+        # Tracking
+        self.max_object_count = 30
+        self.frames_count_to_stabilize = 20
+        self.max_frames_count_of_missing_track = 5
+        self.track_history_size = 25  # Count of last predictions (boxes and velocities) kept for each track
+        #                              (0 - none), speeds of tracks in analytics are their medians
+        self.min_length_of_region = 10
+        self.min_area_of_region = 0  # Used only by the 'components' detector (area of pixels of the mask)
+        self.detector = 'contours'  # 'contours' (cv2.findContours) or 'components' (connected components) -
+        #                             faster for masks with many blobs, slower for big sparse masks
+        self.association = 'dalka'  # 'dalka', 'hungarian' or 'greedy' (see tracker.association)
+        self.association_parameters = {}  # e.g. {"cost": "iou", "min_iou": 0.1} for 'hungarian' and 'greedy'
+        #                                   or {"min_pairs_for_grid": 10000} for 'dalka'
+
+        # Traffic analytics (see analytics.TrafficAnalytics)
+        self.counting_lines = []  # Lines [[x1, y1], [x2, y2]] of the full frame - crossing vehicles are counted
+        self.homography = None  # 3x3 matrix from the frame to the road plane (e.g. in meters), None - pixels
+        self.analytics_interval_seconds = 60.0
+
+        for name, value in parameters.items():
+            if not hasattr(self, name):
+                raise KeyError("Unknown parameter of pipeline: " + name)
+            setattr(self, name, value)
+        if self.track_history_size < 0:
+            raise ValueError("Size of history of tracks can't be negative: " + str(self.track_history_size))
+
+    @staticmethod
+    def from_file(path):
+        """Load config from a JSON file with the same keys as attributes of the config."""
+        with open(path) as config_file:
+            parameters = json.load(config_file)
+        return PipelineConfig(**parameters)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def save(self, path):
+        with open(path, 'w') as config_file:
+            json.dump(self.to_dict(), config_file, indent=2)
+
+    def get_trackbar_value(self, trackbar_name):
+        return getattr(self, PipelineConfig.trackbar_attributes[trackbar_name])
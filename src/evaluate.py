@@ -0,0 +1,123 @@
+import argparse
+import csv
+import json
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+from config import PipelineConfig
+from pipeline import run_headless
+from tests.correct_regions import load_vatic_regions
+from tracker.metrics import AllMetricWrapper
+
+
+video_extensions = ('.mp4', '.avi', '.mkv', '.mov', '.mpg', '.webm')
+metrics_names = ['fragmentation', 'recall_aor', 'precision_adba']
+
+
+def find_clips(directory):
+    """Find pairs (video, VATIC xml) with the same name (without extension) in the directory."""
+    clips = []
+    for file_name in sorted(os.listdir(directory)):
+        name, extension = os.path.splitext(file_name)
+        xml_path = os.path.join(directory, name + '.xml')
+        if extension.lower() in video_extensions and os.path.isfile(xml_path):
+            clips.append((os.path.join(directory, file_name), xml_path))
+    return clips
+
+
+def evaluate_clip(video_path, vatic_path, config):
+    """Track objects in the video without GUI and compare predictions with VATIC regions for each frame.
+
+    :return: dict with results of metrics, counts of their values, count of frames and FPS (or error)
+    """
+    result = {'clip': os.path.basename(video_path), 'video': video_path, 'vatic': vatic_path}
+    try:
+        right_regions = load_vatic_regions(vatic_path)
+        all_metrics = AllMetricWrapper()
+
+        def update_metrics(frame_index, pipeline):
+            if pipeline.predictions is not None:
+                all_metrics.update_metric_for_frame(right_regions[frame_index], pipeline.predictions)
+
+        video_capture = cv2.VideoCapture(video_path)
+        if not video_capture.isOpened():
+            raise IOError("Can't open the video: " + video_path)
+        headless_result = run_headless(video_capture, config, max_frames=len(right_regions) - 1,
+                                       on_frame=update_metrics, verbose=False)
+        video_capture.release()
+
+        result['frames'] = headless_result.frames_count
+        result['fps'] = headless_result.fps
+        for name, value, count in zip(metrics_names, all_metrics.calculate_result(), all_metrics.calculate_counts()):
+            result[name] = value
+            result[name + '_count'] = count
+    except Exception:
+        result['error'] = traceback.format_exc()
+    return result
+
+
+def summarize(results):
+    """Overall result of all clips - metrics are averaged over all values (weighted by counts of values)."""
+    summary = {'clip': 'ALL', 'clips': len(results), 'failed': sum(1 for result in results if 'error' in result)}
+    correct_results = [result for result in results if 'error' not in result]
+    summary['frames'] = sum(result['frames'] for result in correct_results)
+    for name in metrics_names:
+        count = sum(result[name + '_count'] for result in correct_results)
+        total = sum(result[name] * result[name + '_count'] for result in correct_results if result[name] is not None)
+        summary[name] = total / count if count > 0 else None
+        summary[name + '_count'] = count
+    return summary
+
+
+def evaluate_directory(directory, config, processes=None):
+    """Evaluate all clips of the directory in parallel processes.
+
+    :return: (list of results of clips, overall summary)
+    """
+    clips = find_clips(directory)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(evaluate_clip, video_path, vatic_path, config) for video_path, vatic_path in clips]
+        results = [future.result() for future in futures]
+    return results, summarize(results)
+
+
+def save_json(path, results, summary):
+    with open(path, 'w') as report_file:
+        json.dump({'clips': results, 'summary': summary}, report_file, indent=2)
+
+
+def save_csv(path, results, summary):
+    columns = ['clip', 'frames', 'fps'] + [column for name in metrics_names for column in (name, name + '_count')] + \
+              ['error']
+    with open(path, 'w', newline='') as report_file:
+        writer = csv.DictWriter(report_file, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        for result in results + [summary]:
+            writer.writerow(result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate tracking on videos with VATIC ground truth "
+                                                 "(pairs of files: name.mp4 and name.xml).")
+    parser.add_argument('directory', help="directory with videos and VATIC xml files")
+    parser.add_argument('--config', help="JSON file with parameters of processing")
+    parser.add_argument('--processes', type=int, default=None, help="count of working processes")
+    parser.add_argument('--json', help="path of JSON report")
+    parser.add_argument('--csv', help="path of CSV report")
+    args = parser.parse_args()
+
+    pipeline_config = PipelineConfig.from_file(args.config) if args.config else PipelineConfig()
+    clips_results, clips_summary = evaluate_directory(args.directory, pipeline_config, args.processes)
+    for clip_result in clips_results + [clips_summary]:
+        if 'error' in clip_result:
+            print(clip_result['clip'], 'FAILED:\n' + clip_result['error'])
+        else:
+            print(clip_result['clip'], clip_result['frames'], 'frames:',
+                  ', '.join(name + '=' + str(clip_result[name]) for name in metrics_names))
+    if args.json:
+        save_json(args.json, clips_results, clips_summary)
+    if args.csv:
+        save_csv(args.csv, clips_results, clips_summary)
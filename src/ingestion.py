@@ -0,0 +1,290 @@
+import argparse
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from config import PipelineConfig
+from pipeline import FramePipeline
+from stream_runner import open_source
+
+
+# Health states of a stream
+STATE_CONNECTING = 'connecting'
+STATE_STREAMING = 'streaming'
+STATE_BACKOFF = 'backoff'  # Waiting for the next attempt of connection
+STATE_FINISHED = 'finished'  # End of the video file, max frames or stopped
+STATE_FAILED = 'failed'  # Max count of reconnections exceeded or error of processing
+
+
+def is_live_source(source):
+    """Check if the source is live (a local camera or a network stream), not a video file."""
+    source = str(source)
+    return source.isdigit() or ('://' in source and not source.lower().startswith('file://'))
+
+
+class StreamHealth:
+    """Health of a single supervised stream."""
+
+    def __init__(self, source, live=True):
+        self.source = source
+        self.live = live
+        self.state = STATE_CONNECTING
+        self.frames_count = 0  # Read frames
+        self.processed_frames = 0
+        self.dropped_frames = 0  # The oldest frames dropped from the full queue
+        self.connections = 0
+        self.reconnections = 0
+        self.last_error = None
+        self.last_frame_time = None
+
+    def get_seconds_since_frame(self):
+        if self.last_frame_time is None:
+            return None
+        return monotonic() - self.last_frame_time
+
+    def to_dict(self):
+        return {'source': str(self.source), 'live': self.live, 'state': self.state, 'frames': self.frames_count,
+                'processed': self.processed_frames, 'dropped': self.dropped_frames,
+                'reconnections': self.reconnections, 'seconds_since_frame': self.get_seconds_since_frame(),
+                'last_error': self.last_error}
+
+    def __repr__(self):
+        return "{source}: {state}, {frames} frames ({processed} processed, {dropped} dropped), " \
+               "{reconnections} reconnections".format(
+                source=self.source, state=self.state, frames=self.frames_count, processed=self.processed_frames,
+                dropped=self.dropped_frames, reconnections=self.reconnections)
+
+
+class DroppingQueue:
+    """Bounded asyncio queue of frames - when it's full, the oldest frame is dropped (a live stream
+    shouldn't wait for a slow consumer, the newest frames are the most valuable). Frames of not live
+    sources (files) are put by `put_waiting`, which waits for a free place instead, so nothing is lost."""
+
+    def __init__(self, maxsize, health):
+        self.queue = asyncio.Queue(maxsize)
+        self.health = health
+
+    def put(self, item):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.health.dropped_frames += 1
+        self.queue.put_nowait(item)
+
+    async def put_waiting(self, item):
+        await self.queue.put(item)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+_end_of_stream = None
+
+
+class StreamSupervisor:
+    """Ingestion of many streams (network cameras, files) supervised by one asyncio event loop.
+
+    For each stream a reader task opens the capture, reads frames and puts them to a bounded queue
+    (dropping the oldest ones), and a processing task takes them to its own FramePipeline. Blocking
+    calls of OpenCV (opening, decoding, processing) are made in thread pools - OpenCV releases the GIL,
+    so the event loop only supervises. When a stream can't be opened or stops sending frames, it's
+    reopened with exponential backoff. The state of each stream is kept in its StreamHealth.
+    Live streams drop the oldest queued frame when processing can't keep up, reading of other sources
+    (files) waits for processing, so all their frames are processed.
+    """
+
+    def __init__(self, sources, config=None, queue_size=4, initial_backoff=0.5, max_backoff=30.0,
+                 max_reconnections=None, reconnect_on_end=False, max_frames=None, on_tracks=None,
+                 open_capture=open_source, decode_workers=None, process_workers=None, live=None):
+        """
+        :param sources: list of video files paths, URLs or camera numbers
+        :param config: PipelineConfig used for all streams
+        :param queue_size: max count of frames waiting for processing (per stream)
+        :param initial_backoff: seconds before the first reconnection, doubled after each failed attempt
+        :param max_backoff: max seconds between attempts of reconnection
+        :param max_reconnections: the stream fails after given count of reconnections (None - unlimited)
+        :param reconnect_on_end: reconnect also when the stream ends (live stream), otherwise it's finished
+        :param max_frames: stop each stream after given count of frames
+        :param on_tracks: function called in the event loop with (stream index, frame index, tracks array)
+        :param open_capture: function opening the source (returns an object like cv2.VideoCapture)
+        :param decode_workers: count of threads opening and decoding streams (default: one per live stream - each
+                               of them waits for the next frame in a thread - and one per other source, max 64
+                               of them). With fewer threads than live streams, reads of live streams wait for
+                               a free thread and the streams fall behind.
+        :param process_workers: count of threads processing frames (default: like ThreadPoolExecutor)
+        :param live: which sources are live (their frames are dropped when processing is too slow): True or False
+                     for all sources, a list with a value for each source, or None - cameras and network URLs
+                     are live, files aren't (see `is_live_source`)
+        """
+        self.sources = list(sources)
+        self.config = config if config is not None else PipelineConfig()
+        self.queue_size = queue_size
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.max_reconnections = max_reconnections
+        self.reconnect_on_end = reconnect_on_end
+        self.max_frames = max_frames
+        self.on_tracks = on_tracks
+        self.open_capture = open_capture
+        self.process_workers = process_workers
+        if live is None:
+            live = [is_live_source(source) for source in self.sources]
+        elif isinstance(live, bool):
+            live = [live] * len(self.sources)
+        if len(live) != len(self.sources):
+            raise ValueError("Count of live flags differs from count of sources")
+        if decode_workers is None:
+            live_count = sum(1 for is_live in live if is_live)
+            decode_workers = max(live_count + min(len(self.sources) - live_count, 64), 1)
+        self.decode_workers = decode_workers
+        self.health = [StreamHealth(source, is_live) for source, is_live in zip(self.sources, live)]
+        self.__stop_event = None
+        self.__decode_executor = None
+        self.__process_executor = None
+
+    async def run(self):
+        """Supervise all streams until all of them are finished or failed (or `stop` is called)."""
+        self.__stop_event = asyncio.Event()
+        self.__decode_executor = ThreadPoolExecutor(self.decode_workers, thread_name_prefix='ingestion-decode')
+        self.__process_executor = ThreadPoolExecutor(self.process_workers, thread_name_prefix='ingestion-process')
+        try:
+            await asyncio.gather(*[self.__supervise(stream_index) for stream_index in range(len(self.sources))])
+        finally:
+            self.__decode_executor.shutdown(wait=True)
+            self.__process_executor.shutdown(wait=True)
+        return self.health
+
+    def stop(self):
+        """Stop all streams (must be called from the event loop, e.g. by `loop.call_soon_threadsafe`)."""
+        if self.__stop_event is not None:
+            self.__stop_event.set()
+
+    def get_health(self):
+        return [health.to_dict() for health in self.health]
+
+    async def __supervise(self, stream_index):
+        health = self.health[stream_index]
+        frames_queue = DroppingQueue(self.queue_size, health)
+        reader = asyncio.ensure_future(self.__read(stream_index, frames_queue))
+        processor = asyncio.ensure_future(self.__process(stream_index, frames_queue))
+        stopper = asyncio.ensure_future(self.__stop_event.wait())
+        # Reading is cancelled when all streams are stopped or processing of the stream failed
+        await asyncio.wait([reader, processor, stopper], return_when=asyncio.FIRST_COMPLETED)
+        if not reader.done():
+            reader.cancel()
+        stopper.cancel()
+        await asyncio.gather(reader, processor, stopper, return_exceptions=True)
+        if health.state != STATE_FAILED:
+            health.state = STATE_FINISHED
+
+    async def __run_blocking(self, executor, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+    async def __read(self, stream_index, frames_queue):
+        """Read frames of the stream to the queue - reopen the stream with backoff when it fails."""
+        health = self.health[stream_index]
+        backoff = self.initial_backoff
+        end_sent = False
+        try:
+            while self.max_frames is None or health.frames_count < self.max_frames:
+                health.state = STATE_CONNECTING
+                video_capture = await self.__open(stream_index)
+                if video_capture is not None:
+                    health.state = STATE_STREAMING
+                    health.connections += 1
+                    frames_before = health.frames_count
+                    ended = await self.__read_frames(video_capture, health, frames_queue)
+                    if health.frames_count > frames_before:
+                        backoff = self.initial_backoff  # The connection was working
+                    if ended and not self.reconnect_on_end:
+                        break
+                if self.max_frames is not None and health.frames_count >= self.max_frames:
+                    break
+                if self.max_reconnections is not None and health.reconnections >= self.max_reconnections:
+                    health.state = STATE_FAILED
+                    break
+                health.state = STATE_BACKOFF
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                health.reconnections += 1
+            if not health.live:
+                await frames_queue.put_waiting(_end_of_stream)  # Don't drop the last frames
+                end_sent = True
+        finally:
+            if not end_sent:
+                frames_queue.put(_end_of_stream)
+
+    async def __open(self, stream_index):
+        health = self.health[stream_index]
+        try:
+            video_capture = await self.__run_blocking(self.__decode_executor, self.open_capture,
+                                                      self.sources[stream_index])
+            if video_capture is not None and video_capture.isOpened():
+                return video_capture
+            health.last_error = "Can't open the stream: " + str(self.sources[stream_index])
+        except Exception:
+            health.last_error = traceback.format_exc()
+        return None
+
+    async def __read_frames(self, video_capture, health, frames_queue):
+        """Read frames until the end of the stream (returns True) or an error (returns False)."""
+        try:
+            while self.max_frames is None or health.frames_count < self.max_frames:
+                ret, frame = await self.__run_blocking(self.__decode_executor, video_capture.read)
+                if not ret:
+                    health.last_error = "End of the stream"
+                    return True
+                health.frames_count += 1
+                health.last_frame_time = monotonic()
+                if health.live:
+                    frames_queue.put(frame)
+                else:
+                    await frames_queue.put_waiting(frame)
+            return True
+        except Exception:
+            health.last_error = traceback.format_exc()
+            return False
+        finally:
+            await self.__run_blocking(self.__decode_executor, video_capture.release)
+
+    async def __process(self, stream_index, frames_queue):
+        """Process frames of the queue by the pipeline of the stream, one by one in order."""
+        health = self.health[stream_index]
+        pipeline = None
+        try:
+            while True:
+                frame = await frames_queue.get()
+                if frame is _end_of_stream:
+                    break
+                if pipeline is None:
+                    pipeline = FramePipeline(self.config)
+                    await self.__run_blocking(self.__process_executor, pipeline.start, frame)
+                    continue
+                await self.__run_blocking(self.__process_executor, pipeline.process, frame)
+                health.processed_frames += 1
+                if self.on_tracks is not None:
+                    self.on_tracks(stream_index, pipeline.frames_processed, pipeline.multi_tracker.get_tracks_array())
+        except Exception:
+            health.last_error = traceback.format_exc()
+            health.state = STATE_FAILED
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest and track many streams (e.g. network cameras) "
+                                                 "supervised by one event loop.")
+    parser.add_argument('sources', nargs='+', help="video files, URLs or numbers of local cameras")
+    parser.add_argument('--config', help="JSON file with parameters of processing")
+    parser.add_argument('--live', action='store_true', help="reconnect also when a stream ends and treat all sources "
+                                                           "as live - drop frames when processing can't keep up "
+                                                           "(default: only cameras and network URLs are live)")
+    parser.add_argument('--max-frames', type=int, default=None, help="process at most given frames of each stream")
+    parser.add_argument('--max-reconnections', type=int, default=None, help="give up a stream after it")
+    parser.add_argument('--queue-size', type=int, default=4, help="max count of frames waiting for processing")
+    args = parser.parse_args()
+
+    supervisor = StreamSupervisor(args.sources, PipelineConfig.from_file(args.config) if args.config else None,
+                                  queue_size=args.queue_size, max_reconnections=args.max_reconnections,
+                                  reconnect_on_end=args.live, max_frames=args.max_frames,
+                                  live=True if args.live else None)
+    for stream_health in asyncio.run(supervisor.run()):
+        print(stream_health)
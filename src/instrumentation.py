@@ -0,0 +1,144 @@
+import json
+import signal
+from time import perf_counter
+
+import numpy as np
+
+
+class _StageTimer:
+    """Context manager measuring wall time of one stage (reused for each frame)."""
+    __slots__ = ('instrumentation', 'name', 'start')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.instrumentation.record(self.name, perf_counter() - self.start)
+        return False
+
+
+class _NoTimer:
+    """Context manager doing nothing - used when instrumentation is disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+
+_no_timer = _NoTimer()
+
+
+class StageStatistics:
+    """Durations of one stage: total and the window of last durations (for percentiles)."""
+
+    def __init__(self, window):
+        self.durations = np.zeros(window)
+        self.count = 0
+        self.total_seconds = 0.0
+
+    def add(self, seconds):
+        self.durations[self.count % len(self.durations)] = seconds
+        self.count += 1
+        self.total_seconds += seconds
+
+    def get_last_durations(self):
+        return self.durations[:min(self.count, len(self.durations))]
+
+    def summary(self):
+        durations = self.get_last_durations()
+        summary = {'count': self.count, 'total_seconds': self.total_seconds}
+        if len(durations) > 0:
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+            summary.update(mean=float(durations.mean()), p50=float(p50), p95=float(p95), p99=float(p99))
+        return summary
+
+
+class Instrumentation:
+    """Lightweight measurement of wall time of each stage of the frame loop and counters.
+
+    Usage: `with instrumentation.stage('blur'): ...`. Percentiles (p50/p95/p99) are calculated
+    over the window of last frames. When it's disabled, `stage` returns a shared context manager
+    doing nothing, so the overhead is negligible.
+    """
+
+    def __init__(self, enabled=True, window=1000):
+        self.enabled = enabled
+        self.window = window
+        self.stages = {}
+        self.counters = {}
+        self.__timers = {}
+
+    def stage(self, name):
+        if not self.enabled:
+            return _no_timer
+        timer = self.__timers.get(name)
+        if timer is None:
+            timer = self.__timers[name] = _StageTimer(self, name)
+        return timer
+
+    def record(self, name, seconds):
+        statistics = self.stages.get(name)
+        if statistics is None:
+            statistics = self.stages[name] = StageStatistics(self.window)
+        statistics.add(seconds)
+
+    def set_counter(self, name, value):
+        if self.enabled:
+            self.counters[name] = value
+
+    def collect_tracker_counters(self, multi_tracker):
+        """Set counters of 6 cases of association and of births and deaths of trackers."""
+        if not self.enabled:
+            return
+        for case_statistic in multi_tracker.get_case_statistics():
+            self.counters['case_' + case_statistic.short_name] = case_statistic.count
+        self.counters['tracker_births'] = multi_tracker.births
+        self.counters['tracker_deaths'] = multi_tracker.deaths
+        self.counters['trackers'] = len(multi_tracker.trackers)
+
+    def summary(self):
+        return {'stages': {name: statistics.summary() for name, statistics in self.stages.items()},
+                'counters': dict(self.counters)}
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self, prefix='car_tracking'):
+        """Get statistics in Prometheus text format (durations as summaries with quantiles)."""
+        lines = ['# TYPE {prefix}_stage_seconds summary'.format(prefix=prefix)]
+        for name, statistics in self.stages.items():
+            summary = statistics.summary()
+            for quantile in ('p50', 'p95', 'p99'):
+                if quantile in summary:
+                    lines.append('{prefix}_stage_seconds{{stage="{name}",quantile="0.{q}"}} {value:.9f}'.format(
+                        prefix=prefix, name=name, q=quantile[1:], value=summary[quantile]))
+            lines.append('{prefix}_stage_seconds_sum{{stage="{name}"}} {value:.9f}'.format(
+                prefix=prefix, name=name, value=summary['total_seconds']))
+            lines.append('{prefix}_stage_seconds_count{{stage="{name}"}} {value}'.format(
+                prefix=prefix, name=name, value=summary['count']))
+        for name, value in self.counters.items():
+            metric_name = prefix + '_' + ''.join(c if c.isalnum() else '_' for c in name)
+            lines.append('# TYPE {name} gauge'.format(name=metric_name))
+            lines.append('{name} {value}'.format(name=metric_name, value=value))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """Save statistics to the file - in Prometheus text format for `.prom` files, otherwise JSON."""
+        text = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        with open(path, 'w') as statistics_file:
+            statistics_file.write(text)
+
+    def dump_on_signal(self, path, signal_number=None):
+        """Dump statistics to the file whenever the process gets the signal (default SIGUSR1, not on Windows)."""
+        if signal_number is None:
+            signal_number = signal.SIGUSR1
+        signal.signal(signal_number, lambda *_: self.dump(path))
@@ -1,10 +1,23 @@
+import argparse
+import json
+import signal
+import sys
 from time import sleep
 
 import cv2
 import numpy as np
 
+from analytics import TrafficAnalytics
+from config import PipelineConfig
+from instrumentation import Instrumentation
+from pipeline import run_headless, run_pipelined
 from transformations import MorphologicalTransformer
 from region import get_regions_from_contours
+from rendering import MJPEGServer, PreviewRenderer
+from roi import RegionOfInterest
+from scheduler import get_source_fps, run_realtime
+from snapshot import PipelineSnapshot
+from track_log import TrackLogWriter
 from tests.correct_regions import load_vatic_regions
 from tracker.metrics import AllMetricWrapper
 from tracker.multi_tracker import MultiObjectsTracker
@@ -17,7 +30,7 @@ max_frames_count_of_missing_track = 5
 window_main_name = 'Video-Main'
 path_correct_vatic_regions = "D:/Wiadomosci/vatic-output/output.xml"
 n_mixtures = 4
-learning_rate_of_subtractor = 0.000000001
+learning_rate_of_subtractor = -1  # Negative - automatic, the same as PipelineConfig.learning_rate_of_subtractor
 font = cv2.FONT_HERSHEY_SIMPLEX
 line_thickness = 2
 font_scale = 1
@@ -26,9 +39,12 @@ yt_url_video = "https://www.youtube.com/watch?v=PNCJQkvALVc"  # M6 Motorway Traf
 show_correct_boxes = False
 break_after_test_end = True
 draw_all_founded_contours = False
+print_tracker_statistics = False  # Printing in each frame slows down processing
 
 
-def main(video_capture, show_intermediate_states=False):
+def main(video_capture, show_intermediate_states=False, instrumentation=None, roi=None):
+    if instrumentation is None:
+        instrumentation = Instrumentation(enabled=False)
     video_capture.set(cv2.CAP_PROP_BUFFERSIZE, 7)
     width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
@@ -43,7 +59,7 @@ def main(video_capture, show_intermediate_states=False):
     background_subtractor.setDetectShadows(True)
     # Quick start for background subtractor
     ret, frame = video_capture.read()
-    background_subtractor.apply(frame, 0.01)
+    background_subtractor.apply(frame if roi is None else roi.crop(frame), learningRate=0.01)
 
     # Tests
     if show_correct_boxes:
@@ -58,20 +74,33 @@ def main(video_capture, show_intermediate_states=False):
             sleep(5)
             continue
         sleep(0.01)  # It's  slowdown video processing for more smooth viewing
-        ret, frame = video_capture.read()
+        with instrumentation.stage('read'):
+            ret, frame = video_capture.read()
         frames_viewed += 1
 
-        frame_blurred = morph_transformer.apply_blur(frame)
-        mask_org = background_subtractor.apply(frame_blurred, learning_rate_of_subtractor)
-        mask_transformed = apply_morphological_operations(morph_transformer, mask_org, show_intermediate_states)
+        # Only the region of interest is processed (if it's given)
+        frame_roi = frame
+        if roi is not None:
+            with instrumentation.stage('roi'):
+                frame_roi = roi.crop(frame)
+        with instrumentation.stage('blur'):
+            frame_blurred = morph_transformer.apply_blur(frame_roi)
+        with instrumentation.stage('background_subtraction'):
+            mask_org = background_subtractor.apply(frame_blurred, learningRate=learning_rate_of_subtractor)
+        mask_transformed = apply_morphological_operations(morph_transformer, mask_org, show_intermediate_states,
+                                                          instrumentation)
 
         # Remove shadows
-        mask_with_shadows = np.copy(mask_transformed)
-        _, mask_transformed = cv2.threshold(mask_transformed, 128, 255, cv2.THRESH_BINARY)
-        output_after_mask = cv2.bitwise_and(frame, frame, mask=mask_transformed)
+        with instrumentation.stage('remove_shadows'):
+            if show_intermediate_states:
+                mask_with_shadows = np.copy(mask_transformed)
+            _, mask_transformed = cv2.threshold(mask_transformed, 128, 255, cv2.THRESH_BINARY)
+        with instrumentation.stage('mask_output'):
+            output_after_mask = cv2.bitwise_and(frame_roi, frame_roi, mask=mask_transformed)
 
         # Find, track and draw regions
-        _, contours, hierarchy = cv2.findContours(mask_transformed, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        with instrumentation.stage('find_contours'):
+            contours = cv2.findContours(mask_transformed, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)[-2]  # OpenCV 3 and 4
         if len(contours) > max_object_count:
             count_str = str(len(contours))
             print("Warning: It's to many objects - probably noise. Check morphological operations.Count = " + count_str)
@@ -80,10 +109,14 @@ def main(video_capture, show_intermediate_states=False):
             color_red = (0, 0, 255)
             color_white = (255, 255, 255)
             frame_with_regions = frame
-            boxes, measured_regions = get_regions_from_contours(contours)
+            with instrumentation.stage('get_regions'):
+                measured_regions = get_regions_from_contours(contours)
+                if roi is not None:
+                    measured_regions = roi.select_regions(measured_regions)
 
             if draw_all_founded_contours:
                 all_boxes = -1
+                boxes = measured_regions.get_box_polygons()
                 frame_with_all_contours = cv2.drawContours(np.copy(frame), boxes, all_boxes, color_red, line_thickness)
                 cv2.imshow("Video - only contours", frame_with_all_contours)
 
@@ -96,23 +129,27 @@ def main(video_capture, show_intermediate_states=False):
 
             # Update tracker and show predicted regions
             if frames_viewed > frames_count_to_stabilize:
-                print("Kalman tracker:" + str(len(multi_tracker.trackers)) +
-                      ", regions=" + str(len(boxes)) + ", frame id =" + str(frames_viewed))
-                print(multi_tracker.statistics())
-                multi_tracker.update(measured_regions)
+                if print_tracker_statistics:
+                    print("Kalman tracker:" + str(len(multi_tracker.trackers)) +
+                          ", regions=" + str(len(measured_regions)) + ", frame id =" + str(frames_viewed))
+                    print(multi_tracker.statistics())
+                with instrumentation.stage('tracker_update'):
+                    multi_tracker.update(measured_regions)
+                instrumentation.collect_tracker_counters(multi_tracker)
                 predictions = multi_tracker.predictions
 
                 # Draw statistics and predicted regions:
-                frame = draw_predicted_regions(frame, multi_tracker)
-                frame_with_regions = cv2.putText(
-                    frame_with_regions, 'Objects: ' + str(len(boxes)), (22, 50),
-                    font, font_scale, color_white, line_thickness, cv2.LINE_AA
-                )
-                frame_with_regions = cv2.putText(
-                    frame_with_regions, 'Trackers: ' + str(len(multi_tracker.trackers)), (width - 240, 50),
-                    font, font_scale, color_white, line_thickness, cv2.LINE_AA
-                )
-                cv2.imshow('Video-Tracked_regions', frame_with_regions)
+                with instrumentation.stage('draw'):
+                    frame = draw_predicted_regions(frame, multi_tracker)
+                    frame_with_regions = cv2.putText(
+                        frame_with_regions, 'Objects: ' + str(len(measured_regions)), (22, 50),
+                        font, font_scale, color_white, line_thickness, cv2.LINE_AA
+                    )
+                    frame_with_regions = cv2.putText(
+                        frame_with_regions, 'Trackers: ' + str(len(multi_tracker.trackers)), (width - 240, 50),
+                        font, font_scale, color_white, line_thickness, cv2.LINE_AA
+                    )
+                    cv2.imshow('Video-Tracked_regions', frame_with_regions)
 
             # Collect metrics
             if show_correct_boxes and frames_viewed < len(right_regions):
@@ -141,23 +178,108 @@ def draw_predicted_regions(frame, multi_tracker):
     return frame
 
 
-def apply_morphological_operations(morph_transformer, mask_org, show_intermediate_states):
+def apply_morphological_operations(morph_transformer, mask_org, show_intermediate_states, instrumentation=None):
+    if instrumentation is None:
+        instrumentation = Instrumentation(enabled=False)
     if show_intermediate_states:
         cv2.imshow('Video-mask-0.BeforeAll', mask_org)
-    mask = morph_transformer.apply_erode(mask_org)
+    with instrumentation.stage('erode'):
+        mask = morph_transformer.apply_erode(mask_org)
     if show_intermediate_states:
         cv2.imshow('Video-mask-1.After Erode', mask)
-    mask = morph_transformer.apply_dilate(mask)
+    with instrumentation.stage('dilate'):
+        mask = morph_transformer.apply_dilate(mask)
     if show_intermediate_states:
         cv2.imshow('Video-mask-2.After Dilate', mask)
-    mask = morph_transformer.apply_morph_open(mask)
-    mask = morph_transformer.apply_morph_close(mask)
+    with instrumentation.stage('morph_open'):
+        mask = morph_transformer.apply_morph_open(mask)
+    with instrumentation.stage('morph_close'):
+        mask = morph_transformer.apply_morph_close(mask)
     if show_intermediate_states:
         cv2.imshow('Video-mask-3.After Open or Close', mask)
     return mask
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vehicles tracking using a static traffic camera.")
+    parser.add_argument('video', nargs='?', default="/home/deep-learning/Downloads/A3 A-road Traffic UK 480x360.mp4")
+    parser.add_argument('--headless', action='store_true', help="process without GUI, as fast as possible")
+    parser.add_argument('--pipelined', action='store_true',
+                        help="in headless mode: decode, preprocess and track in parallel threads")
+    parser.add_argument('--realtime', nargs='?', type=float, const=0,
+                        help="in headless mode: skip processing of frames when it can't keep up with the source "
+                             "(FPS of the source can be given, default - from the video)")
+    parser.add_argument('--config', help="JSON file with parameters used in headless mode "
+                                         "(in interactive mode only polygons of ROI and lanes are used)")
+    parser.add_argument('--tracks-log', help="in headless mode: append tracks of each frame to the binary log file")
+    parser.add_argument('--snapshot', help="in headless mode: restore the background model and trackers from the file "
+                                           "at start and save them periodically and at the end")
+    parser.add_argument('--snapshot-interval', type=float, default=60.0, help="seconds between saves of the snapshot")
+    parser.add_argument('--analytics', help="in headless mode: append reports of intervals (counts of vehicles crossing "
+                                            "counting lines of the config, speeds) to the JSON lines file")
+    parser.add_argument('--preview-port', type=int, help="in headless mode: serve previews of tracks as MJPEG stream "
+                                                         "on the port (http://localhost:PORT/)")
+    parser.add_argument('--preview-fps', type=float, default=5.0, help="max frames per second of previews")
+    parser.add_argument('--stats', help="save time of stages and counters to the file (JSON or Prometheus .prom), "
+                                        "also on SIGUSR1")
+    args = parser.parse_args()
+    stage_instrumentation = Instrumentation(enabled=args.stats is not None)
+    if args.stats is not None and hasattr(signal, 'SIGUSR1'):
+        stage_instrumentation.dump_on_signal(args.stats)
+
     # vid_capture = get_youtube_video_with_choice_quality(yt_url_video)
-    vid_capture = cv2.VideoCapture("/home/deep-learning/Downloads/A3 A-road Traffic UK 480x360.mp4")
-    main(vid_capture, show_intermediate_states=False)
+    vid_capture = cv2.VideoCapture(args.video)
+    if args.headless:
+        pipeline_config = PipelineConfig.from_file(args.config) if args.config else PipelineConfig()
+        tracks_log = TrackLogWriter(args.tracks_log) if args.tracks_log else None
+        pipeline_snapshot = PipelineSnapshot(args.snapshot, args.snapshot_interval) if args.snapshot else None
+        if pipeline_snapshot is not None and hasattr(signal, 'SIGTERM'):
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # The snapshot is saved on the way out
+        preview_renderer, preview_server = None, None
+        if args.preview_port is not None:
+            preview_renderer = PreviewRenderer(args.preview_fps).start()
+            preview_server = MJPEGServer(preview_renderer, port=args.preview_port).start()
+            print('Preview:', preview_server.url)
+        traffic_analytics, analytics_file = None, None
+        if args.analytics is not None:
+            analytics_file = open(args.analytics, 'a')
+            traffic_analytics = TrafficAnalytics.from_config(
+                pipeline_config, args.realtime or get_source_fps(vid_capture),
+                on_interval=lambda report: print(json.dumps(report), file=analytics_file, flush=True))
+        # Indexes of processed frames start from 1 - frames of a continued log start after its last frame
+        frames_offset = max(tracks_log.next_frame - 1, 0) if tracks_log is not None else 0
+
+        def on_processed_frame(frame_index, pipeline):
+            if tracks_log is not None:
+                tracks_log.write_trackers(frames_offset + frame_index, pipeline.multi_tracker)
+            if preview_renderer is not None:
+                preview_renderer.on_frame(frame_index, pipeline)
+            if traffic_analytics is not None:
+                traffic_analytics.on_frame(frame_index, pipeline)
+        consumers = [tracks_log, preview_renderer, traffic_analytics]
+        on_frame = on_processed_frame if any(consumer is not None for consumer in consumers) else None
+        try:
+            if args.realtime is not None:
+                run_realtime(vid_capture, pipeline_config, source_fps=args.realtime, on_frame=on_frame,
+                             instrumentation=stage_instrumentation, snapshot=pipeline_snapshot)
+            elif args.pipelined:
+                run_pipelined(vid_capture, pipeline_config, on_frame=on_frame, instrumentation=stage_instrumentation,
+                              snapshot=pipeline_snapshot)
+            else:
+                run_headless(vid_capture, pipeline_config, on_frame=on_frame, instrumentation=stage_instrumentation,
+                             snapshot=pipeline_snapshot)
+        finally:  # Also on SIGTERM - records of the log written before the snapshot mustn't be lost
+            vid_capture.release()
+            if tracks_log is not None:
+                tracks_log.close()
+            if preview_renderer is not None:
+                preview_server.stop()
+                preview_renderer.stop()
+            if traffic_analytics is not None:
+                traffic_analytics.finish()
+                analytics_file.close()
+    else:
+        interactive_roi = RegionOfInterest.from_config(PipelineConfig.from_file(args.config)) if args.config else None
+        main(vid_capture, show_intermediate_states=False, instrumentation=stage_instrumentation, roi=interactive_roi)
+    if args.stats is not None:
+        stage_instrumentation.dump(args.stats)
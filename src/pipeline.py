@@ -0,0 +1,298 @@
+import queue
+import threading
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from instrumentation import Instrumentation
+from region import get_components_stats, get_regions_from_components, get_regions_from_contours
+from roi import RegionOfInterest
+from transformations import MorphologicalTransformer
+from tracker.association import create_association
+from tracker.multi_tracker import MultiObjectsTracker
+
+
+class FramePipeline:
+    """Processing of frames without any GUI: background subtraction, morphological
+    transformations, contours detection and tracking.
+
+    All parameters are taken from the config (see `config.PipelineConfig`).
+    Wall time of each stage is measured by the given instrumentation (see `instrumentation.Instrumentation`).
+    """
+
+    def __init__(self, config, instrumentation=None):
+        self.config = config
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation(enabled=False)
+        self.morph_transformer = MorphologicalTransformer(config=config)
+        self.roi = RegionOfInterest.from_config(config)  # None - the whole frame is processed
+        self.multi_tracker = MultiObjectsTracker(
+            lost_track_patience=config.max_frames_count_of_missing_track,
+            association=create_association(config.association, **config.association_parameters),
+            history_size=config.track_history_size)
+        self.background_subtractor = cv2.createBackgroundSubtractorMOG2(
+            history=config.history, varThreshold=config.var_threshold)
+        self.background_subtractor.setNMixtures(config.n_mixtures)
+        self.background_subtractor.setDetectShadows(True)
+        if config.detector not in ('contours', 'components'):
+            raise ValueError("Unknown detector: " + str(config.detector))
+        self.components_labels = None  # Buffer of labels of connected components (reused between frames)
+        self.frames_processed = 0
+        self.frames_to_stabilize = config.frames_count_to_stabilize  # Tracking starts after them
+        self.frame = None  # The last processed frame (e.g. for previews, see `rendering.PreviewRenderer`),
+        #                    None - the last frame wasn't decoded
+        self.measured_regions = []
+        self.predictions = []  # Predictions of the last frame (None if the frame was skipped - too many objects)
+
+    def start(self, frame):
+        """Quick start for background subtractor."""
+        if self.roi is not None:
+            frame = self.roi.crop(frame)
+        self.background_subtractor.apply(self.morph_transformer.downscale_frame(frame),
+                                         learningRate=self.config.quick_start_learning_rate)
+
+    def start_with_snapshot(self, frame, snapshot=None):
+        """Start from the snapshot (see `snapshot.PipelineSnapshot`) or by the quick start if it's None."""
+        if snapshot is not None:
+            snapshot.start(self, frame)
+        else:
+            self.start(frame)
+
+    def preprocess(self, frame):
+        """Get binary mask of moving objects (without shadows) of the ROI, downscaled by `config.downscale`.
+
+        The mask is a buffer reused in the next frame (see `MorphologicalTransformer.get_foreground_mask`).
+        """
+        return self.apply_morphology(self.subtract_background(frame))
+
+    def subtract_background(self, frame):
+        """Get binary mask of moving objects before morphology (the first part of `preprocess`)."""
+        if self.roi is not None:
+            with self.instrumentation.stage('roi'):
+                frame = self.roi.crop(frame)
+        return self.morph_transformer.get_subtracted_mask(frame, self.background_subtractor,
+                                                          self.config.learning_rate_of_subtractor, self.instrumentation)
+
+    def apply_morphology(self, mask):
+        """Apply morphological transformations to the mask in place (the second part of `preprocess`)."""
+        return self.morph_transformer.apply_morphology(mask, self.instrumentation)
+
+    def detect(self, mask):
+        """Get measured regions from the mask or None when there are too many objects (noise)."""
+        downscale = self.morph_transformer.get_downscale()
+        if self.config.detector == 'components':
+            with self.instrumentation.stage('find_components'):
+                if self.components_labels is None or self.components_labels.shape != mask.shape:
+                    self.components_labels = np.empty(mask.shape, dtype=np.int32)
+                stats = get_components_stats(mask, self.components_labels)
+            if len(stats) > self.config.max_object_count:
+                return None
+            with self.instrumentation.stage('get_regions'):
+                measured_regions = get_regions_from_components(stats, self.config.min_length_of_region,
+                                                               self.config.min_area_of_region, downscale)
+        else:
+            with self.instrumentation.stage('find_contours'):
+                contours = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)[-2]  # OpenCV 3 and 4
+            if len(contours) > self.config.max_object_count:
+                return None
+            with self.instrumentation.stage('get_regions'):
+                measured_regions = get_regions_from_contours(contours, self.config.min_length_of_region, downscale)
+        if self.roi is not None:
+            measured_regions = self.roi.select_regions(measured_regions)
+        return measured_regions
+
+    def track(self, measured_regions):
+        """Update trackers, but only when background subtractor is stabilized."""
+        self.frames_processed += 1
+        if measured_regions is None:
+            self.predictions = None
+            return
+        self.measured_regions = measured_regions
+        if self.frames_processed > self.frames_to_stabilize:
+            with self.instrumentation.stage('tracker_update'):
+                self.multi_tracker.update(measured_regions)
+            self.instrumentation.collect_tracker_counters(self.multi_tracker)
+            self.predictions = self.multi_tracker.predictions
+        else:
+            self.predictions = []
+
+    def coast(self, frame=None):
+        """Only predict trackers - the frame was skipped (e.g. by `scheduler.RealTimeScheduler`).
+
+        :param frame: the frame if it was decoded (None - it was only grabbed)
+        """
+        self.frame = frame
+        self.frames_processed += 1
+        if self.frames_processed > self.frames_to_stabilize:
+            with self.instrumentation.stage('tracker_coast'):
+                self.multi_tracker.coast()
+            self.predictions = self.multi_tracker.predictions
+        else:
+            self.predictions = []
+
+    def process(self, frame):
+        with self.instrumentation.stage('frame'):
+            self.frame = frame
+            mask = self.preprocess(frame)
+            self.track(self.detect(mask))
+        return self.multi_tracker
+
+
+class HeadlessResult:
+    def __init__(self, frames_count, seconds):
+        self.frames_count = frames_count
+        self.seconds = seconds
+
+    @property
+    def fps(self):
+        if self.seconds > 0:
+            return self.frames_count / self.seconds
+        return 0.0
+
+    def __repr__(self):
+        return "{frames} frames in {seconds:.2f} s ({fps:.1f} FPS)".format(
+            frames=self.frames_count, seconds=self.seconds, fps=self.fps)
+
+
+def run_headless(video_capture, config, max_frames=None, on_frame=None, verbose=True, instrumentation=None,
+                 snapshot=None):
+    """Process the whole video as fast as possible, without displaying anything.
+
+    :param video_capture: opened cv2.VideoCapture (or an object with the same `read` method)
+    :param config: PipelineConfig with parameters of processing
+    :param max_frames: stop after given count of frames (None - until end of the video)
+    :param on_frame: function called after each frame with index of the frame and the FramePipeline
+    :param verbose: print the result
+    :param instrumentation: Instrumentation measuring time of stages (None - disabled)
+    :param snapshot: snapshot.PipelineSnapshot - the pipeline is restored from it and saved to it periodically
+                     and at the end (None - no snapshots)
+    :return: HeadlessResult with count of frames and frames per second
+    """
+    pipeline = FramePipeline(config, instrumentation)
+    ret, frame = video_capture.read()
+    if not ret:
+        return HeadlessResult(0, 0.0)
+    pipeline.start_with_snapshot(frame, snapshot)
+
+    start_time = perf_counter()
+    try:
+        while max_frames is None or pipeline.frames_processed < max_frames:
+            with pipeline.instrumentation.stage('read'):
+                ret, frame = video_capture.read()
+            if not ret:
+                break
+            pipeline.process(frame)
+            if snapshot is not None:
+                snapshot.update(pipeline)
+            if on_frame is not None:
+                on_frame(pipeline.frames_processed, pipeline)
+    finally:
+        if snapshot is not None:
+            snapshot.save(pipeline)
+    result = HeadlessResult(pipeline.frames_processed, perf_counter() - start_time)
+    if verbose:
+        print("Headless processing:", result)
+    return result
+
+
+_end_of_stream = None
+
+
+def run_pipelined(video_capture, config, max_frames=None, on_frame=None, verbose=True, instrumentation=None,
+                  queue_size=8, snapshot=None):
+    """Process the whole video like `run_headless`, but with 3 stages working in parallel threads:
+    decoding, preprocessing (blur, background subtraction, morphology) and detection with tracking.
+
+    Stages are connected by bounded queues, so a fast stage waits for a slow one (backpressure).
+    Each stage is processed by one thread in order of frames, so results are the same as from `run_headless`.
+    OpenCV releases the GIL in decoding and filters, so the stages really work in parallel.
+    :param queue_size: max count of frames waiting between two stages
+    :param snapshot: snapshot.PipelineSnapshot - the pipeline is restored from it and saved to it at the end
+                     (not periodically - stages would have to be stopped)
+    """
+    pipeline = FramePipeline(config, instrumentation)
+    ret, frame = video_capture.read()
+    if not ret:
+        return HeadlessResult(0, 0.0)
+    pipeline.start_with_snapshot(frame, snapshot)
+
+    frames_queue = queue.Queue(maxsize=queue_size)
+    masks_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    errors = []
+
+    def put(out_queue, item):
+        while not stop_event.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(in_queue):
+        while not stop_event.is_set():
+            try:
+                return in_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _end_of_stream
+
+    def run_stage(stage):
+        try:
+            stage()
+        except Exception as error:
+            errors.append(error)
+            stop_event.set()
+
+    def decode():
+        frames_count = 0
+        while max_frames is None or frames_count < max_frames:
+            with pipeline.instrumentation.stage('read'):
+                ret_read, frame_read = video_capture.read()
+            if not ret_read or not put(frames_queue, frame_read):
+                break
+            frames_count += 1
+        put(frames_queue, _end_of_stream)
+
+    def preprocess():
+        while True:
+            frame_to_process = get(frames_queue)
+            if frame_to_process is _end_of_stream:
+                break
+            mask_to_track = pipeline.preprocess(frame_to_process).copy()  # The buffer is reused in the next frame
+            if not put(masks_queue, (frame_to_process, mask_to_track)):
+                break
+        put(masks_queue, _end_of_stream)
+
+    def track():
+        while True:
+            item = get(masks_queue)
+            if item is _end_of_stream:
+                break
+            pipeline.frame, mask = item
+            pipeline.track(pipeline.detect(mask))
+            if on_frame is not None:
+                on_frame(pipeline.frames_processed, pipeline)
+
+    start_time = perf_counter()
+    threads = [threading.Thread(target=run_stage, args=(stage,), name='pipeline-' + stage.__name__, daemon=True)
+               for stage in (decode, preprocess, track)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        if snapshot is not None:
+            stop_event.set()  # Stop all stages (e.g. after an interruption) before saving
+            for thread in threads:
+                thread.join()
+            snapshot.save(pipeline)
+    if errors:
+        raise errors[0]
+
+    result = HeadlessResult(pipeline.frames_processed, perf_counter() - start_time)
+    if verbose:
+        print("Pipelined processing:", result)
+    return result
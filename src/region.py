@@ -8,11 +8,16 @@ min_length_of_region = 10
 
 
 class Region:
+    __slots__ = ('x', 'y', 'w', 'h', 'x2', 'y2', 'was_reversed')
+
     def __init__(self, x, y, w, h):
         assert isinstance(x, numbers.Number) \
             and isinstance(y, numbers.Number) \
             and isinstance(w, numbers.Number) \
             and isinstance(h, numbers.Number)
+        self.__set(x, y, w, h)
+
+    def __set(self, x, y, w, h):
         if w < 0 and h < 0:
             self.was_reversed = True
             if w < 0:
@@ -33,7 +38,23 @@ class Region:
 
     @staticmethod
     def from_matrix(matrix):
-        return Region(matrix[0], matrix[1], matrix[2], matrix[3])
+        """Create region from a row of numbers (x, y, w, h) - without checking of types."""
+        region = Region.__new__(Region)
+        region.__set(matrix[0], matrix[1], matrix[2], matrix[3])
+        return region
+
+    @staticmethod
+    def from_box(x, y, w, h):
+        """Create region from integer box with not negative size (e.g. a row of RegionArray) - without any checks."""
+        region = Region.__new__(Region)
+        region.x = x
+        region.y = y
+        region.w = w
+        region.h = h
+        region.x2 = x + w
+        region.y2 = y + h
+        region.was_reversed = False
+        return region
 
     def is_overlapping(self, other_point):
         if self.x > other_point.x2 or other_point.x > self.x2:
@@ -76,38 +97,276 @@ class Region:
 
     @staticmethod
     def compare_exists_in_regions(measure_regions, predicted_regions):
-        overlapping_matrix = np.zeros((len(measure_regions), len(predicted_regions)))
-        for m in range(len(measure_regions)):
-            for p in range(len(predicted_regions)):
-                overlapping_matrix[m, p] = measure_regions[m].is_overlapping(predicted_regions[p])
-        return overlapping_matrix
+        return get_overlapping_matrix(regions_to_array(measure_regions), regions_to_array(predicted_regions))
+
+
+class RegionArray:
+    """Regions of a whole frame kept in a single (N,4) int32 array of boxes (x, y, w, h).
+
+    Region objects are created only when an item is accessed (and cached), so the hot path
+    of tracking works on the array only.
+    """
+
+    def __init__(self, boxes):
+        self.boxes = np.ascontiguousarray(boxes, dtype=np.int32).reshape(-1, 4)
+        self.__regions = [None] * len(self.boxes)
+
+    @staticmethod
+    def from_regions(regions):
+        return RegionArray(regions_to_array(regions))
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __getitem__(self, index):
+        region = self.__regions[index]
+        if region is None:
+            x, y, w, h = self.boxes[index].tolist()
+            region = Region.from_box(x, y, w, h)
+            self.__regions[index] = region
+        return region
+
+    def __iter__(self):
+        for index in range(len(self.boxes)):
+            yield self[index]
+
+    def get_box_polygons(self):
+        """Get (N,4,2) array of 4 corners of each box (e.g. for cv2.drawContours)."""
+        x, y = self.boxes[:, 0], self.boxes[:, 1]
+        x2, y2 = x + self.boxes[:, 2], y + self.boxes[:, 3]
+        return np.stack([np.stack([x, y], axis=1), np.stack([x2, y], axis=1),
+                         np.stack([x2, y2], axis=1), np.stack([x, y2], axis=1)], axis=1)
+
+
+def regions_to_array(regions):
+    """Get (N,4) int32 array of boxes (x, y, w, h) from the list of regions."""
+    if isinstance(regions, RegionArray):
+        return regions.boxes
+    boxes = np.empty((len(regions), 4), dtype=np.int32)
+    for i, region in enumerate(regions):
+        boxes[i] = (region.x, region.y, region.w, region.h)
+    return boxes
+
+
+def array_to_regions(boxes):
+    return list(RegionArray(boxes))
+
+
+def get_overlapping_matrix(boxes_a, boxes_b):
+    """Boolean (N,M) matrix with the same meaning as `Region.is_overlapping` for each pair of boxes
+    (touching edges are overlapping)."""
+    x_a, y_a = boxes_a[:, 0, None], boxes_a[:, 1, None]
+    x2_a, y2_a = x_a + boxes_a[:, 2, None], y_a + boxes_a[:, 3, None]
+    x_b, y_b = boxes_b[None, :, 0], boxes_b[None, :, 1]
+    x2_b, y2_b = x_b + boxes_b[None, :, 2], y_b + boxes_b[None, :, 3]
+    return (x_a <= x2_b) & (x_b <= x2_a) & (y_a <= y2_b) & (y_b <= y2_a)
+
+
+def get_iou_matrix(boxes_a, boxes_b):
+    """(N,M) matrix of intersection over union for each pair of boxes."""
+    x_a, y_a = boxes_a[:, 0, None], boxes_a[:, 1, None]
+    x2_a, y2_a = x_a + boxes_a[:, 2, None], y_a + boxes_a[:, 3, None]
+    x_b, y_b = boxes_b[None, :, 0], boxes_b[None, :, 1]
+    x2_b, y2_b = x_b + boxes_b[None, :, 2], y_b + boxes_b[None, :, 3]
+    intersection_w = np.clip(np.minimum(x2_a, x2_b) - np.maximum(x_a, x_b), 0, None)
+    intersection_h = np.clip(np.minimum(y2_a, y2_b) - np.maximum(y_a, y_b), 0, None)
+    intersection = intersection_w.astype(np.float64) * intersection_h
+    area_a = boxes_a[:, 2, None].astype(np.float64) * boxes_a[:, 3, None]
+    area_b = boxes_b[None, :, 2].astype(np.float64) * boxes_b[None, :, 3]
+    union = area_a + area_b - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+class GridIndex:
+    """Uniform grid over boxes for finding overlapping pairs of boxes without comparing all pairs.
+
+    Each box is registered in all cells which it covers, then only boxes sharing a cell are compared.
+    The index is built and queried with array operations (sorting and binary search of cells keys).
+    """
+    min_cell_size = 8
+
+    def __init__(self, boxes, cell_size=None):
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        if cell_size is None:
+            cell_size = 2 * int(np.median(self.boxes[:, 2:])) if len(self.boxes) > 0 else 0
+        self.cell_size = max(int(cell_size), GridIndex.min_cell_size)
+
+        keys, box_indexes = self.__get_cells_of_boxes(self.boxes)
+        order = np.argsort(keys, kind='stable')
+        self.__keys = keys[order]
+        self.__box_indexes = box_indexes[order]
+
+    def __get_cells_of_boxes(self, boxes):
+        """Get (keys of cells, indexes of boxes) for all cells covered by boxes (edges included)."""
+        cell_x = boxes[:, 0].astype(np.int64) // self.cell_size
+        cell_y = boxes[:, 1].astype(np.int64) // self.cell_size
+        cells_w = (boxes[:, 0].astype(np.int64) + boxes[:, 2]) // self.cell_size - cell_x + 1
+        cells_h = (boxes[:, 1].astype(np.int64) + boxes[:, 3]) // self.cell_size - cell_y + 1
+        cells_w = np.maximum(cells_w, 1)
+        cells_count = cells_w * np.maximum(cells_h, 1)
+
+        box_indexes = np.repeat(np.arange(len(boxes)), cells_count)
+        first_cell = np.repeat(np.cumsum(cells_count) - cells_count, cells_count)
+        cell_of_box = np.arange(len(box_indexes)) - first_cell
+        widths = cells_w[box_indexes]
+        x = cell_x[box_indexes] + cell_of_box % widths
+        y = cell_y[box_indexes] + cell_of_box // widths
+        return (y << 32) + x, box_indexes
+
+    def query(self, other_boxes):
+        """Find all overlapping pairs (the same meaning as `Region.is_overlapping`) of other boxes and boxes of index.
+
+        :return: (other boxes indexes, index boxes indexes) arrays, sorted by other boxes
+        """
+        other_boxes = np.asarray(other_boxes, dtype=np.int32).reshape(-1, 4)
+        keys, other_indexes = self.__get_cells_of_boxes(other_boxes)
+        starts = np.searchsorted(self.__keys, keys, side='left')
+        ends = np.searchsorted(self.__keys, keys, side='right')
+        counts = ends - starts
+
+        # All candidates from the same cells (without duplicates from many shared cells)
+        candidates_other = np.repeat(other_indexes, counts)
+        first_candidate = np.repeat(np.cumsum(counts) - counts, counts)
+        positions = np.repeat(starts, counts) + np.arange(len(candidates_other)) - first_candidate
+        candidates = np.unique(candidates_other * len(self.boxes) + self.__box_indexes[positions])
+        candidates_other, candidates_index = np.divmod(candidates, max(len(self.boxes), 1))
+
+        a, b = other_boxes[candidates_other], self.boxes[candidates_index]
+        is_overlapping = (a[:, 0] <= b[:, 0] + b[:, 2]) & (b[:, 0] <= a[:, 0] + a[:, 2]) & \
+                         (a[:, 1] <= b[:, 1] + b[:, 3]) & (b[:, 1] <= a[:, 1] + a[:, 3])
+        return candidates_other[is_overlapping], candidates_index[is_overlapping]
+
+
+def get_subregions_array(boxes_a, boxes_b):
+    """Intersections of corresponding pairs of boxes (the same as `Region.get_own_subregion`)."""
+    x = np.maximum(boxes_a[:, 0], boxes_b[:, 0])
+    y = np.maximum(boxes_a[:, 1], boxes_b[:, 1])
+    x2 = np.minimum(boxes_a[:, 0] + boxes_a[:, 2], boxes_b[:, 0] + boxes_b[:, 2])
+    y2 = np.minimum(boxes_a[:, 1] + boxes_a[:, 3], boxes_b[:, 1] + boxes_b[:, 3])
+    return np.stack([x, y, x2 - x, y2 - y], axis=1).astype(np.int32)
 
 
 class CoverArea:
+    """Area of a base region covered by other regions, calculated exactly without rasterization."""
+
     @staticmethod
     def calculate(base_region, overlapping_regions):
         assert isinstance(base_region, Region)
-        if base_region.h < 1 or base_region.w < 1:   # TODO: Prevent this situation
-            pass
-        area_boxes = np.zeros(shape=(base_region.h, base_region.w))
         for overlapping_region in overlapping_regions:
             assert isinstance(overlapping_region, Region)
-            x_dependent = overlapping_region.x - base_region.x
-            y_dependent = overlapping_region.y - base_region.y
-            area_boxes[y_dependent:(y_dependent+overlapping_region.h),
-                       x_dependent:(x_dependent+overlapping_region.w)] = 1
-        return area_boxes.sum()
-
-
-def get_regions_from_contours(contours):
-    """Get boxes regions and regions from list of detected contours."""
-    boxes = []
-    measured_regions = []
-    for contour in contours:
-        x, y, w, h = cv2.boundingRect(contour)
-        if w >= min_length_of_region and h >= min_length_of_region:
-            measured_regions.append(Region(x, y, w, h))
-            box = np.array([[x, y], [x + w, y], [x + w, y + h], [x, y + h]])
-            box = np.int0(box)
-            boxes.append(box)
-    return boxes, measured_regions
+        if len(overlapping_regions) == 0:
+            return 0.0
+        base_boxes = regions_to_array([base_region])
+        overlapping_boxes = regions_to_array(overlapping_regions)
+        pairs = (np.zeros(len(overlapping_boxes), dtype=np.intp), np.arange(len(overlapping_boxes)))
+        return CoverArea.calculate_batch(base_boxes, overlapping_boxes, pairs)[0]
+
+    @staticmethod
+    def calculate_batch(base_boxes, other_boxes, overlapping_pairs):
+        """Areas of all base boxes covered by other boxes at once.
+
+        :param base_boxes: (N,4) array of boxes (x, y, w, h)
+        :param other_boxes: (M,4) array of boxes
+        :param overlapping_pairs: (base indexes, other indexes) arrays of pairs which cover each other
+        :return: (N,) array of covered areas
+        """
+        base_indexes, other_indexes = overlapping_pairs
+        base_boxes = np.asarray(base_boxes).reshape(-1, 4)
+        sub_boxes = get_subregions_array(base_boxes[base_indexes], np.asarray(other_boxes).reshape(-1, 4)[other_indexes])
+        return get_union_areas(sub_boxes, base_indexes, len(base_boxes))
+
+
+def get_union_areas(boxes, groups, groups_count):
+    """Areas of unions of boxes in each group, calculated by coordinates compression.
+
+    Coordinates of edges of boxes split the plane into cells, so the area of the union is the sum
+    of areas of cells covered by any box. Groups of similar sizes are calculated at once (padded to
+    the next power of two), so the cost follows sizes of groups, not the biggest group.
+    :param boxes: (K,4) array of boxes (x, y, w, h), boxes with negative size are empty
+    :param groups: (K,) array with index of group for each box
+    :param groups_count: count of groups
+    :return: (groups_count,) array of areas
+    """
+    areas = np.zeros(groups_count)
+    if len(boxes) == 0:
+        return areas
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    groups = np.asarray(groups, dtype=np.intp)
+    boxes_count_by_group = np.bincount(groups, minlength=groups_count)
+    is_not_empty = boxes_count_by_group > 0
+    size_classes = np.zeros(groups_count, dtype=np.intp)
+    size_classes[is_not_empty] = np.ceil(np.log2(boxes_count_by_group[is_not_empty]))
+    for size_class in np.unique(size_classes[is_not_empty]):
+        class_groups = np.flatnonzero(is_not_empty & (size_classes == size_class))
+        index_in_class = np.full(groups_count, -1, dtype=np.intp)
+        index_in_class[class_groups] = np.arange(len(class_groups))
+        is_in_class = index_in_class[groups] >= 0
+        areas[class_groups] = _get_padded_union_areas(boxes[is_in_class], index_in_class[groups[is_in_class]],
+                                                      len(class_groups))
+    return areas
+
+
+def _get_padded_union_areas(boxes, groups, groups_count):
+    """Areas of unions of boxes in each group (see `get_union_areas`) - all groups at once,
+    padded to the biggest group."""
+    groups = np.asarray(groups, dtype=np.intp)
+    boxes_count_by_group = np.bincount(groups, minlength=groups_count)
+    max_boxes_count = boxes_count_by_group.max()
+
+    # Pad groups with empty boxes: (groups, max_boxes_count) arrays of edges
+    order = np.argsort(groups, kind='stable')
+    position_in_group = np.arange(len(groups)) - (np.cumsum(boxes_count_by_group) - boxes_count_by_group)[groups[order]]
+    x1, y1, x2, y2 = (np.zeros((groups_count, max_boxes_count), dtype=np.int64) for _ in range(4))
+    boxes = np.asarray(boxes, dtype=np.int64)[order]
+    group_of_box = groups[order]
+    x1[group_of_box, position_in_group] = boxes[:, 0]
+    y1[group_of_box, position_in_group] = boxes[:, 1]
+    x2[group_of_box, position_in_group] = boxes[:, 0] + np.maximum(boxes[:, 2], 0)
+    y2[group_of_box, position_in_group] = boxes[:, 1] + np.maximum(boxes[:, 3], 0)
+
+    # Cells between sorted edges (duplicated edges give empty cells)
+    xs = np.sort(np.concatenate([x1, x2], axis=1), axis=1)
+    ys = np.sort(np.concatenate([y1, y2], axis=1), axis=1)
+    cells_x, cells_w = xs[:, :-1], np.diff(xs, axis=1)
+    cells_y, cells_h = ys[:, :-1], np.diff(ys, axis=1)
+    covered_x = (x1[:, :, None] <= cells_x[:, None, :]) & (cells_x[:, None, :] < x2[:, :, None])
+    covered_y = (y1[:, :, None] <= cells_y[:, None, :]) & (cells_y[:, None, :] < y2[:, :, None])
+    covered = np.matmul(covered_y.transpose(0, 2, 1).astype(np.float32), covered_x.astype(np.float32)) > 0
+    return np.einsum('gyx,gy,gx->g', covered, cells_h.astype(np.float64), cells_w.astype(np.float64))
+
+
+def get_components_stats(mask, labels=None):
+    """Get (N,5) int32 array of statistics (x, y, w, h, area) of 8-connected components of the binary mask
+    (without the background). Works the same in OpenCV 3 and 4.
+
+    :param labels: preallocated (H,W) int32 image of labels of components (reused between frames)
+    """
+    stats = cv2.connectedComponentsWithStats(mask, labels=labels, connectivity=8)[2]
+    return stats[1:]
+
+
+def get_regions_from_components(stats, min_length=min_length_of_region, min_area=0, scale=1):
+    """Get regions big enough from (N,5) statistics of connected components (see `get_components_stats`).
+
+    Filtering is vectorized - no Python object is created for a component.
+    :param scale: factor of scaling of boxes (e.g. components of a downscaled mask) - applied before filtering
+    """
+    boxes = stats[:, :4]
+    areas = stats[:, 4]
+    if scale != 1:
+        boxes = np.round(boxes * scale).astype(np.int32)
+        areas = areas * (scale * scale)
+    is_big_enough = (boxes[:, 2] >= min_length) & (boxes[:, 3] >= min_length) & (areas >= min_area)
+    return RegionArray(boxes[is_big_enough])
+
+
+def get_regions_from_contours(contours, min_length=min_length_of_region, scale=1):
+    """Get regions (bounding boxes big enough) from list of detected contours.
+
+    :param scale: factor of scaling of boxes (e.g. contours found on a downscaled mask) - applied before filtering
+    """
+    boxes = np.array([cv2.boundingRect(contour) for contour in contours], dtype=np.int32).reshape(-1, 4)
+    if scale != 1:
+        boxes = np.round(boxes * scale).astype(np.int32)
+    is_big_enough = (boxes[:, 2] >= min_length) & (boxes[:, 3] >= min_length)
+    return RegionArray(boxes[is_big_enough])
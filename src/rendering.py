@@ -0,0 +1,244 @@
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+
+import cv2
+import numpy as np
+
+
+font = cv2.FONT_HERSHEY_SIMPLEX
+line_thickness = 2
+color_white = (255, 255, 255)
+mjpeg_boundary = 'frame'
+
+
+def draw_tracks(frame, tracks, colors):
+    """Draw boxes and ids of tracks on the frame (in place).
+
+    :param tracks: (N,5) array of (tracker_id, x, y, w, h) - see `MultiObjectsTracker.get_tracks_array`
+    :param colors: N colors (B, G, R) of trackers
+    """
+    for (tracker_id, x, y, w, h), color in zip(tracks.tolist(), colors):
+        cv2.rectangle(frame, (x, y), (x + w, y + h), color, line_thickness)
+        cv2.putText(frame, str(tracker_id), (x, y), font, 1, color, line_thickness, cv2.LINE_AA)
+    cv2.putText(frame, 'Trackers: ' + str(len(tracks)), (22, 50), font, 1, color_white, line_thickness, cv2.LINE_AA)
+    return frame
+
+
+class PreviewRenderer:
+    """Rendering of previews (frames with tracks) in its own thread, off the processing loop.
+
+    The processing loop only publishes references to the frame and tracks (see `on_frame`) - and only when
+    a preview is due: a viewer is connected and the interval of the preview rate passed, or a preview was
+    requested on demand (see `get_jpeg`). Otherwise publishing costs one comparison. Published frames must
+    not be modified later (frames read by cv2.VideoCapture are new arrays). The last rendered preview is
+    cached as JPEG, so all viewers of the same frame share one rendering and encoding.
+    """
+
+    def __init__(self, preview_fps=5.0, jpeg_quality=80, max_width=None):
+        """
+        :param preview_fps: max count of previews rendered per second for viewers
+        :param jpeg_quality: quality of JPEG encoding (0-100)
+        :param max_width: previews wider than it are downscaled (None - original size)
+        """
+        self.preview_interval = 1.0 / preview_fps
+        self.jpeg_quality = jpeg_quality
+        self.max_width = max_width
+        self.rendered_count = 0
+        self.__condition = threading.Condition()
+        self.__viewers = 0
+        self.__requested = False
+        self.__next_time = 0.0
+        self.__pending = None  # (frame index, frame, tracks, colors) waiting for rendering
+        self.__jpeg = None  # Cached (frame index, JPEG bytes) of the last preview
+        self.__running = False
+        self.__thread = None
+
+    @property
+    def running(self):
+        return self.__running
+
+    def start(self):
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name='preview-renderer', daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def is_due(self):
+        """Check if the next frame should be published (called by the processing loop)."""
+        return self.__requested or (self.__viewers > 0 and monotonic() >= self.__next_time)
+
+    def on_frame(self, frame_index, pipeline):
+        """Publish the frame of the pipeline if a preview is due (`on_frame` of `pipeline.run_headless` etc.),
+        frames which weren't decoded (dropped by `scheduler.RealTimeScheduler`) are skipped."""
+        if not self.is_due() or pipeline.frame is None:
+            return
+        trackers = pipeline.multi_tracker.trackers
+        self.publish(frame_index, pipeline.frame, pipeline.multi_tracker.get_tracks_array(),
+                     [tracker.color for tracker in trackers])
+
+    def publish(self, frame_index, frame, tracks, colors):
+        """Pass the frame and its tracks to the rendering thread (a not rendered older frame is replaced)."""
+        with self.__condition:
+            self.__pending = (frame_index, frame, tracks, colors)
+            self.__requested = False
+            self.__next_time = monotonic() + self.preview_interval
+            self.__condition.notify_all()
+
+    def add_viewer(self):
+        with self.__condition:
+            self.__viewers += 1
+
+    def remove_viewer(self):
+        with self.__condition:
+            self.__viewers -= 1
+
+    def get_jpeg(self, timeout=None):
+        """Get the preview of the next processed frame on demand (JPEG bytes), or the last cached preview
+        if no frame was processed in the timeout (None if there isn't any)."""
+        with self.__condition:
+            last_index = self.__jpeg[0] if self.__jpeg is not None else None
+            self.__requested = True
+        jpeg = self.wait_for_jpeg(last_index, timeout)
+        return jpeg[1] if jpeg is not None else None
+
+    def wait_for_jpeg(self, last_index=None, timeout=None):
+        """Wait for a preview newer than the frame of the given index.
+
+        :return: (frame index, JPEG bytes) - the last cached preview after the timeout (or None if there isn't any)
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: not self.__running or (
+                self.__jpeg is not None and self.__jpeg[0] != last_index), timeout)
+            return self.__jpeg
+
+    def render(self, frame, tracks, colors):
+        """Render the preview of the frame (on its copy) and encode it to JPEG bytes."""
+        preview = draw_tracks(frame.copy(), tracks, colors)
+        if self.max_width is not None and preview.shape[1] > self.max_width:
+            height = int(round(preview.shape[0] * self.max_width / preview.shape[1]))
+            preview = cv2.resize(preview, (self.max_width, height), interpolation=cv2.INTER_AREA)
+        ok, jpeg = cv2.imencode('.jpg', preview, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if not ok:
+            raise IOError("Can't encode the preview")
+        return jpeg.tobytes()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: not self.__running or self.__pending is not None)
+                if not self.__running:
+                    break
+                frame_index, frame, tracks, colors = self.__pending
+                self.__pending = None
+            jpeg = self.render(frame, tracks, colors)
+            with self.__condition:
+                self.__jpeg = (frame_index, jpeg)
+                self.rendered_count += 1
+                self.__condition.notify_all()
+
+
+class _PreviewRequestHandler(BaseHTTPRequestHandler):
+    """Endpoints: `/` (or `/stream.mjpg`) - MJPEG stream of previews, `/snapshot.jpg` - a single preview."""
+    renderer = None  # Set in a subclass created by MJPEGServer
+    timeout_seconds = 5.0
+
+    def do_GET(self):
+        if self.path in ('/', '/stream.mjpg'):
+            self.__send_stream()
+        elif self.path == '/snapshot.jpg':
+            jpeg = self.renderer.get_jpeg(self.timeout_seconds)
+            if jpeg is None:
+                self.send_error(503, "No processed frames yet")
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(jpeg)))
+            self.end_headers()
+            self.wfile.write(jpeg)
+        else:
+            self.send_error(404)
+
+    def __send_stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + mjpeg_boundary)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.renderer.add_viewer()
+        try:
+            last_index = None
+            while self.renderer.running:
+                jpeg = self.renderer.wait_for_jpeg(last_index, self.timeout_seconds)
+                if jpeg is None or jpeg[0] == last_index:
+                    continue  # Nothing new - processing is paused or ended
+                last_index = jpeg[0]
+                self.wfile.write('--{boundary}\r\nContent-Type: image/jpeg\r\nContent-Length: {length}\r\n\r\n'.format(
+                    boundary=mjpeg_boundary, length=len(jpeg[1])).encode('ascii'))
+                self.wfile.write(jpeg[1])
+                self.wfile.write(b'\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The viewer disconnected
+        finally:
+            self.renderer.remove_viewer()
+
+    def log_message(self, *_):
+        pass
+
+
+class MJPEGServer:
+    """HTTP server of previews of the PreviewRenderer (MJPEG stream readable by browsers and VLC)
+    running in a daemon thread."""
+
+    def __init__(self, renderer, host='127.0.0.1', port=8090):
+        handler = type('PreviewRequestHandler', (_PreviewRequestHandler,), {'renderer': renderer})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.__thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{host}:{port}/'.format(host=host, port=port)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.server.serve_forever, name='preview-server', daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.__thread is not None:
+            self.__thread.join()
+
+
+def read_mjpeg(url, max_frames=None, timeout=10.0):
+    """Read previews of the MJPEG stream (a simple client, e.g. for checking of the server).
+
+    :return: generator of decoded frames
+    """
+    frames_count = 0
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        while max_frames is None or frames_count < max_frames:
+            length = None
+            line = response.readline()
+            if not line:
+                break
+            while line not in (b'\r\n', b''):
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':', 1)[1])
+                line = response.readline()
+            if length is None:
+                continue
+            jpeg = response.read(length)
+            response.readline()
+            frames_count += 1
+            yield cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
@@ -0,0 +1,97 @@
+import cv2
+import numpy as np
+
+from region import RegionArray
+
+
+class RegionOfInterest:
+    """Part of the frame of a static camera where vehicles can be found (e.g. without sky and verges).
+
+    The ROI is given by polygons (lists of points (x, y) of the full frame). Processing is cropped to
+    the bounding rectangle of the polygons and pixels outside them are cleared before the background
+    subtraction, so they never become foreground. Lanes (also polygons of the full frame) are used to
+    discard detected regions with centres outside all lanes and to get lanes of points.
+    Masks are rasterized when the first frame is known (and again when the size of frames changes).
+    """
+
+    def __init__(self, polygons=None, lanes=None):
+        """
+        :param polygons: polygons of the ROI (None or empty - the whole frame)
+        :param lanes: polygons of lanes (None or empty - regions aren't filtered by lanes)
+        """
+        self.polygons = [np.array(polygon, dtype=np.int32).reshape(-1, 2) for polygon in polygons or []]
+        self.lanes = [np.array(lane, dtype=np.int32).reshape(-1, 2) for lane in lanes or []]
+        self.rect = None  # (x, y, w, h) of the cropped part of the frame
+        self.mask = None  # Mask of polygons in the cropped part (None - all pixels are inside)
+        self.lanes_map = None  # Index of the lane + 1 of each pixel of the cropped part (0 - outside lanes)
+        self.__frame_shape = None
+        self.__masked_frame = None
+
+    @staticmethod
+    def from_config(config):
+        """Get ROI from polygons of the config or None if there are no polygons (whole frame is processed)."""
+        if not config.roi_polygons and not config.lane_polygons:
+            return None
+        return RegionOfInterest(config.roi_polygons, config.lane_polygons)
+
+    def prepare(self, frame_shape):
+        """Rasterize masks for frames of the shape - it's made by `crop`, but it has to be called explicitly
+        when regions are selected without cropping of frames (e.g. on cached masks)."""
+        height, width = frame_shape[:2]
+        x, y, x2, y2 = 0, 0, width, height
+        if self.polygons:
+            rect_x, rect_y, rect_w, rect_h = cv2.boundingRect(np.concatenate(self.polygons))
+            x, y = max(rect_x, 0), max(rect_y, 0)
+            x2, y2 = max(min(rect_x + rect_w, width), x + 1), max(min(rect_y + rect_h, height), y + 1)
+        self.rect = (x, y, x2 - x, y2 - y)
+        offset = np.array([x, y], dtype=np.int32)
+
+        self.mask = None
+        if self.polygons:
+            mask = np.zeros((y2 - y, x2 - x), dtype=np.uint8)
+            cv2.fillPoly(mask, [polygon - offset for polygon in self.polygons], 255)
+            if not mask.all():
+                self.mask = mask
+        self.lanes_map = None
+        if self.lanes:
+            self.lanes_map = np.zeros((y2 - y, x2 - x), dtype=np.int16)
+            for lane_index, lane in enumerate(self.lanes):
+                cv2.fillPoly(self.lanes_map, [lane - offset], lane_index + 1)
+        self.__masked_frame = None
+        self.__frame_shape = frame_shape
+
+    def crop(self, frame):
+        """Get the part of the frame to process - a view of the bounding rectangle of the ROI with pixels
+        outside polygons cleared (in a buffer reused in the next frame)."""
+        if frame.shape != self.__frame_shape:
+            self.prepare(frame.shape)
+        x, y, w, h = self.rect
+        cropped_frame = frame[y:y + h, x:x + w]
+        if self.mask is None:
+            return cropped_frame
+        if self.__masked_frame is None:
+            # Pixels outside the mask are never written, so they stay cleared
+            self.__masked_frame = np.zeros(cropped_frame.shape, dtype=cropped_frame.dtype)
+        return cv2.bitwise_and(cropped_frame, cropped_frame, mask=self.mask, dst=self.__masked_frame)
+
+    def get_lanes(self, points):
+        """Get indexes of lanes of (N,2) points of the full frame (-1 - outside all lanes)."""
+        points = np.asarray(points).reshape(-1, 2)
+        if self.lanes_map is None:
+            return np.full(len(points), -1, dtype=np.int32)
+        x, y, w, h = self.rect
+        xs = np.floor(points[:, 0]).astype(np.int64) - x
+        ys = np.floor(points[:, 1]).astype(np.int64) - y
+        is_inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        lanes = np.full(len(points), -1, dtype=np.int32)
+        lanes[is_inside] = self.lanes_map[ys[is_inside], xs[is_inside]] - 1
+        return lanes
+
+    def select_regions(self, regions):
+        """Move regions found in the cropped part to coordinates of the full frame and discard regions
+        with centres outside all lanes (when lanes are given)."""
+        boxes = regions.boxes + np.array([self.rect[0], self.rect[1], 0, 0], dtype=np.int32)
+        if self.lanes_map is not None:
+            centres = boxes[:, :2] + boxes[:, 2:] / 2
+            boxes = boxes[self.get_lanes(centres) >= 0]
+        return RegionArray(boxes)
@@ -0,0 +1,159 @@
+from time import perf_counter
+
+import cv2
+
+from pipeline import FramePipeline, HeadlessResult
+
+
+# Ways of processing of a frame
+FRAME_FULL = 'full'  # Detection and tracking
+FRAME_DEGRADED = 'degraded'  # Decoded, but only predicted by trackers
+FRAME_DROPPED = 'dropped'  # Only grabbed (not decoded to an image) and predicted by trackers
+
+default_source_fps = 25.0
+
+
+class RealTimeScheduler:
+    """Decide how each frame of a live stream is processed, so processing keeps up with the source.
+
+    The lag is the count of frames produced by the source (according to its FPS and wall time) which
+    aren't processed yet. While the lag is small, each frame is fully processed. When it grows above
+    `max_lag`, only every `stride`-th frame is fully processed - the stride is doubled (up to `max_stride`)
+    while the lag keeps growing and halved when the lag drops below one frame. Other frames are degraded,
+    or dropped when the lag is above `drop_lag`. Trackers only predict in skipped frames, so tracks continue.
+    """
+
+    def __init__(self, source_fps, max_lag=2.0, drop_lag=5.0, max_stride=8):
+        """
+        :param source_fps: frames per second produced by the source
+        :param max_lag: lag (in frames) above which frames start to be skipped
+        :param drop_lag: lag (in frames) above which skipped frames aren't even decoded
+        :param max_stride: max count of frames per one fully processed frame
+        """
+        self.frame_seconds = 1.0 / source_fps
+        self.max_lag = max_lag
+        self.drop_lag = drop_lag
+        self.max_stride = max_stride
+        self.stride = 1
+        self.frames_count = 0
+        self.full_frames = 0
+        self.degraded_frames = 0
+        self.dropped_frames = 0
+        self.__frames_since_full = 0
+        self.__last_lag = 0.0
+        self.__start_time = None
+
+    def start(self):
+        """Start measuring of time - the source starts producing frames."""
+        self.__start_time = perf_counter()
+
+    def get_lag(self):
+        if self.__start_time is None:
+            return 0.0
+        return (perf_counter() - self.__start_time) / self.frame_seconds - self.frames_count
+
+    def next_action(self):
+        """Get the way of processing of the next frame: FRAME_FULL, FRAME_DEGRADED or FRAME_DROPPED."""
+        lag = self.get_lag()
+        self.frames_count += 1
+        self.__frames_since_full += 1
+        if self.__frames_since_full >= self.stride:
+            self.__adapt_stride(lag)
+            self.__frames_since_full = 0
+            return FRAME_FULL
+        if lag > self.drop_lag:
+            return FRAME_DROPPED
+        return FRAME_DEGRADED
+
+    def count_frame(self, action):
+        """Count the frame processed in the given way (after it was really read)."""
+        if action == FRAME_FULL:
+            self.full_frames += 1
+        elif action == FRAME_DEGRADED:
+            self.degraded_frames += 1
+        else:
+            self.dropped_frames += 1
+
+    def __adapt_stride(self, lag):
+        if lag > self.max_lag and lag >= self.__last_lag:
+            self.stride = min(self.stride * 2, self.max_stride)
+        elif lag < 1.0:
+            self.stride = max(self.stride // 2, 1)
+        self.__last_lag = lag
+
+    def collect_counters(self, instrumentation):
+        instrumentation.set_counter('frames_full', self.full_frames)
+        instrumentation.set_counter('frames_degraded', self.degraded_frames)
+        instrumentation.set_counter('frames_dropped', self.dropped_frames)
+        instrumentation.set_counter('scheduler_stride', self.stride)
+
+
+class RealTimeResult(HeadlessResult):
+    def __init__(self, frames_count, seconds, scheduler):
+        super().__init__(frames_count, seconds)
+        self.full_frames = scheduler.full_frames
+        self.degraded_frames = scheduler.degraded_frames
+        self.dropped_frames = scheduler.dropped_frames
+
+    def __repr__(self):
+        return super().__repr__() + ", {full} full, {degraded} degraded, {dropped} dropped".format(
+            full=self.full_frames, degraded=self.degraded_frames, dropped=self.dropped_frames)
+
+
+def get_source_fps(video_capture):
+    fps = video_capture.get(cv2.CAP_PROP_FPS)
+    if not fps or fps != fps or fps <= 0:  # Unknown (0 or NaN)
+        return default_source_fps
+    return fps
+
+
+def run_realtime(video_capture, config, source_fps=None, max_frames=None, on_frame=None, verbose=True,
+                 instrumentation=None, scheduler=None, snapshot=None):
+    """Process a live stream like `run_headless`, but skip processing of frames when it can't keep up
+    with the source (see `RealTimeScheduler`), so the latency doesn't grow.
+
+    A video file is treated as a live stream producing frames with its FPS from the start of processing.
+    :param source_fps: FPS of the source (None - read from the video capture)
+    :param scheduler: RealTimeScheduler (None - default one for FPS of the source)
+    :param snapshot: snapshot.PipelineSnapshot - the pipeline is restored from it and saved to it periodically
+                     and at the end (None - no snapshots)
+    :return: RealTimeResult with counts of fully processed, degraded and dropped frames
+    """
+    pipeline = FramePipeline(config, instrumentation)
+    if scheduler is None:
+        scheduler = RealTimeScheduler(source_fps if source_fps else get_source_fps(video_capture))
+    ret, frame = video_capture.read()
+    if not ret:
+        return RealTimeResult(0, 0.0, scheduler)
+    pipeline.start_with_snapshot(frame, snapshot)
+
+    start_time = perf_counter()
+    scheduler.start()
+    try:
+        while max_frames is None or pipeline.frames_processed < max_frames:
+            action = scheduler.next_action()
+            with pipeline.instrumentation.stage('read'):
+                if action == FRAME_DROPPED:
+                    ret = video_capture.grab()
+                else:
+                    ret, frame = video_capture.read()
+            if not ret:
+                break
+            scheduler.count_frame(action)
+            if action == FRAME_FULL:
+                pipeline.process(frame)
+            else:
+                pipeline.coast(frame if action == FRAME_DEGRADED else None)
+            if snapshot is not None:
+                snapshot.update(pipeline)
+            if pipeline.instrumentation.enabled:
+                scheduler.collect_counters(pipeline.instrumentation)
+            if on_frame is not None:
+                on_frame(pipeline.frames_processed, pipeline)
+    finally:
+        if snapshot is not None:
+            snapshot.save(pipeline)
+    result = RealTimeResult(pipeline.frames_processed, perf_counter() - start_time, scheduler)
+    if verbose:
+        print("Real-time processing:", result)
+    return result
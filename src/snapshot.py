@@ -0,0 +1,116 @@
+import json
+import os
+from time import monotonic
+
+import numpy as np
+
+
+# Parameters of cv2.BackgroundSubtractorMOG2 saved in snapshots (name of the getter/setter without get/set)
+mog2_parameters = ['History', 'NMixtures', 'VarThreshold', 'VarThresholdGen', 'VarInit', 'VarMin', 'VarMax',
+                   'BackgroundRatio', 'ComplexityReductionThreshold', 'DetectShadows', 'ShadowThreshold',
+                   'ShadowValue']
+snapshot_version = 1
+
+
+class PipelineSnapshot:
+    """Snapshot of the state of a FramePipeline in a file: the background model and all trackers.
+
+    OpenCV doesn't expose the model of MOG2, so parameters of the subtractor and its background image
+    are saved. On restart, the background image is applied to a new subtractor with the learning rate 1,
+    so subtraction (and tracking, restored with Kalman filters) works well from the first frame, without
+    waiting for stabilization. The file is written to a temporary file and then renamed, so a crash
+    during saving never breaks the previous snapshot.
+    """
+
+    def __init__(self, path, interval_seconds=60.0):
+        """
+        :param path: path of the snapshot file (.npz)
+        :param interval_seconds: min time between periodic saves (see `update`)
+        """
+        self.path = path
+        self.interval_seconds = interval_seconds
+        self.restored = False
+        self.__last_save_time = monotonic()
+
+    def start(self, pipeline, frame):
+        """Start the pipeline with the first frame - from the snapshot if it exists and fits the frame,
+        otherwise by the quick start of the pipeline.
+
+        :return: True if the pipeline was restored from the snapshot
+        """
+        self.restored = False
+        self.__last_save_time = monotonic()
+        state = load_state(self.path)
+        if state is not None:
+            self.restored = restore_pipeline(pipeline, state, frame)
+        if not self.restored:
+            pipeline.start(frame)
+        return self.restored
+
+    def update(self, pipeline):
+        """Save the snapshot if the interval passed since the last save (called after each frame)."""
+        if monotonic() - self.__last_save_time >= self.interval_seconds:
+            self.save(pipeline)
+
+    def save(self, pipeline):
+        save_state(self.path, get_pipeline_state(pipeline))
+        self.__last_save_time = monotonic()
+
+
+def get_pipeline_state(pipeline):
+    """Get the state of the pipeline as a dict of arrays and JSON metadata."""
+    background_subtractor = pipeline.background_subtractor
+    metadata = {
+        'version': snapshot_version,
+        'frames_processed': pipeline.frames_processed,
+        'mog2': {name: getattr(background_subtractor, 'get' + name)() for name in mog2_parameters},
+    }
+    state = {'tracker_' + name: array for name, array in pipeline.multi_tracker.get_state().items()}
+    background = background_subtractor.getBackgroundImage()
+    if background is not None:
+        state['background'] = background
+    state['metadata'] = np.array(json.dumps(metadata))
+    return state
+
+
+def restore_pipeline(pipeline, state, frame):
+    """Restore the pipeline from the state - only if the background fits the processed part of the frame
+    (the same size, ROI and downscale).
+
+    :return: True if the pipeline was restored
+    """
+    metadata = json.loads(str(state['metadata']))
+    if metadata.get('version') != snapshot_version or 'background' not in state:
+        return False
+    if pipeline.roi is not None:
+        frame = pipeline.roi.crop(frame)
+    processed_frame = pipeline.morph_transformer.downscale_frame(frame)
+    background = state['background']
+    if background.shape != processed_frame.shape:
+        return False
+
+    background_subtractor = pipeline.background_subtractor
+    for name, value in metadata['mog2'].items():
+        getattr(background_subtractor, 'set' + name)(value)
+    background_subtractor.apply(background, learningRate=1)
+    pipeline.multi_tracker.set_state({name[len('tracker_'):]: array for name, array in state.items()
+                                      if name.startswith('tracker_')})
+    pipeline.frames_to_stabilize = 0  # The background is already stable
+    return True
+
+
+def save_state(path, state):
+    """Save arrays to the .npz file atomically (a temporary file is renamed)."""
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as snapshot_file:
+        np.savez(snapshot_file, **state)
+    os.replace(temporary_path, path)
+
+
+def load_state(path):
+    """Load arrays saved by `save_state` or None if there is no valid file."""
+    try:
+        with np.load(path, allow_pickle=False) as snapshot_file:
+            return {name: snapshot_file[name] for name in snapshot_file.files}
+    except (OSError, ValueError, KeyError):
+        return None
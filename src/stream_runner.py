@@ -0,0 +1,198 @@
+import argparse
+import multiprocessing
+import queue
+import traceback
+from time import perf_counter
+
+import cv2
+
+from config import PipelineConfig
+from pipeline import run_headless
+
+
+# Types of messages sent by workers
+MESSAGE_FRAME = 'frame'
+MESSAGE_DONE = 'done'
+MESSAGE_ERROR = 'error'
+
+
+class StreamStatistics:
+    """Throughput (or error) of a single processed stream."""
+
+    def __init__(self, source):
+        self.source = source
+        self.frames_count = 0
+        self.seconds = 0.0
+        self.error = None
+
+    @property
+    def fps(self):
+        if self.seconds > 0:
+            return self.frames_count / self.seconds
+        return 0.0
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    def __repr__(self):
+        if self.failed:
+            return "{source}: FAILED after {frames} frames".format(source=self.source, frames=self.frames_count)
+        return "{source}: {frames} frames in {seconds:.2f} s ({fps:.1f} FPS)".format(
+            source=self.source, frames=self.frames_count, seconds=self.seconds, fps=self.fps)
+
+
+def open_source(source):
+    """Open video file, URL or local camera (given by its number)."""
+    if isinstance(source, str) and source.isdigit():
+        source = int(source)
+    return cv2.VideoCapture(source)
+
+
+def _process_stream(stream_index, source, config, results_queue, max_frames):
+    """Worker: process one stream with own subtractor, transformer and tracker, and send results to the queue."""
+    try:
+        video_capture = open_source(source)
+        if not video_capture.isOpened():
+            raise IOError("Can't open the stream: " + str(source))
+
+        def send_tracks(frame_index, pipeline):
+            tracks = pipeline.multi_tracker.get_tracks_array()
+            results_queue.put((MESSAGE_FRAME, stream_index, frame_index, tracks))
+
+        result = run_headless(video_capture, config, max_frames=max_frames, on_frame=send_tracks, verbose=False)
+        video_capture.release()
+        results_queue.put((MESSAGE_DONE, stream_index, result.frames_count, result.seconds))
+    except Exception:
+        results_queue.put((MESSAGE_ERROR, stream_index, traceback.format_exc()))
+
+
+class MultiStreamRunner:
+    """Process many streams (e.g. many cameras) at once, each stream in a separate process.
+
+    At most `processes` streams are processed at the same time, the rest waits for a free process.
+    Each worker sends (stream index, frame index, tracks array) for each frame - see
+    `MultiObjectsTracker.get_tracks_array`. A crash of one stream (an exception or even
+    death of the process) is reported in its statistics and doesn't stop other streams.
+    """
+    poll_timeout = 0.1
+
+    def __init__(self, sources, config=None, processes=None, max_frames=None, on_tracks=None):
+        """
+        :param sources: list of video files paths, URLs or camera numbers
+        :param config: PipelineConfig used for all streams
+        :param processes: max count of working processes (default: count of CPUs)
+        :param max_frames: stop each stream after given count of frames
+        :param on_tracks: function called in the main process with (stream index, frame index, tracks array)
+        """
+        self.sources = list(sources)
+        self.config = config if config is not None else PipelineConfig()
+        self.processes = processes if processes is not None else multiprocessing.cpu_count()
+        self.max_frames = max_frames
+        self.on_tracks = on_tracks
+        self.statistics = [StreamStatistics(source) for source in self.sources]
+        self.seconds = 0.0
+
+    def run(self):
+        """Process all streams and return list of StreamStatistics."""
+        start_time = perf_counter()
+        results_queue = multiprocessing.Queue()
+        waiting = list(range(len(self.sources)))
+        waiting.reverse()
+        running = {}
+        finished = set()
+
+        while waiting or running:
+            while waiting and len(running) < self.processes:
+                stream_index = waiting.pop()
+                worker = multiprocessing.Process(
+                    target=_process_stream,
+                    args=(stream_index, self.sources[stream_index], self.config, results_queue, self.max_frames),
+                    daemon=True)
+                worker.start()
+                running[stream_index] = worker
+
+            try:
+                message = results_queue.get(timeout=MultiStreamRunner.poll_timeout)
+            except queue.Empty:
+                message = None
+            if message is not None:
+                self.__handle_message(message, finished)
+            # Checked in each iteration - messages of other workers can keep the queue busy
+            self.__check_workers(running, results_queue, finished)
+            for stream_index in [index for index in running if index in finished]:
+                running.pop(stream_index).join()
+
+        self.seconds = perf_counter() - start_time
+        return self.statistics
+
+    def __check_workers(self, running, results_queue, finished):
+        """Fail streams of workers which have exited without sending their result.
+
+        Messages sent by a worker before its exit can still be in the queue, so it's drained first.
+        """
+        exited = [stream_index for stream_index, worker in running.items()
+                  if stream_index not in finished and not worker.is_alive()]
+        if not exited:
+            return
+        while True:
+            try:
+                self.__handle_message(results_queue.get_nowait(), finished)
+            except queue.Empty:
+                break
+        for stream_index in exited:
+            if stream_index not in finished:
+                exit_code = running[stream_index].exitcode
+                if exit_code != 0:
+                    self.statistics[stream_index].error = "Process exited with code " + str(exit_code)
+                else:
+                    self.statistics[stream_index].error = "Process exited without sending the result"
+                finished.add(stream_index)
+
+    def __handle_message(self, message, finished):
+        message_type, stream_index = message[0], message[1]
+        statistics = self.statistics[stream_index]
+        if message_type == MESSAGE_FRAME:
+            _, _, frame_index, tracks = message
+            statistics.frames_count = frame_index
+            if self.on_tracks is not None:
+                self.on_tracks(stream_index, frame_index, tracks)
+        elif message_type == MESSAGE_DONE:
+            _, _, statistics.frames_count, statistics.seconds = message
+            finished.add(stream_index)
+        elif message_type == MESSAGE_ERROR:
+            statistics.error = message[2]
+            finished.add(stream_index)
+
+    @property
+    def total_frames_count(self):
+        return sum(statistics.frames_count for statistics in self.statistics)
+
+    @property
+    def total_fps(self):
+        if self.seconds > 0:
+            return self.total_frames_count / self.seconds
+        return 0.0
+
+    def report(self):
+        lines = [str(statistics) for statistics in self.statistics]
+        for statistics in self.statistics:
+            if statistics.failed:
+                lines.append("Error of " + str(statistics.source) + ":\n" + statistics.error)
+        lines.append("Total: {frames} frames of {streams} streams in {seconds:.2f} s ({fps:.1f} FPS)".format(
+            frames=self.total_frames_count, streams=len(self.sources), seconds=self.seconds, fps=self.total_fps))
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Track vehicles on many streams in parallel (without GUI).")
+    parser.add_argument('sources', nargs='+', help="video files, URLs or numbers of local cameras")
+    parser.add_argument('--processes', type=int, default=None, help="count of working processes")
+    parser.add_argument('--config', help="JSON file with parameters of processing")
+    parser.add_argument('--max-frames', type=int, default=None, help="process at most given frames of each stream")
+    args = parser.parse_args()
+
+    runner = MultiStreamRunner(args.sources, PipelineConfig.from_file(args.config) if args.config else None,
+                               processes=args.processes, max_frames=args.max_frames)
+    runner.run()
+    print(runner.report())
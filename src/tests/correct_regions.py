@@ -1,45 +1,186 @@
+import array
+import hashlib
+import json
+import os
 from xml.etree import ElementTree
 
-from region import Region
+import numpy as np
 
+from region import RegionArray
 
-def load_vatic_regions(path):
-    """Parse a VATIC output file to the list of lists consisting of regions for each time step.
 
+# Columns of the table of VATIC regions
+COLUMN_FRAME = 0
+COLUMN_OBJECT_ID = 1
+COLUMNS_BOX = slice(2, 6)  # x, y, w, h
+columns_count = 6
+
+cache_version = 1
+
+
+class VaticTable:
+    """Regions of a VATIC file as a columnar table (frame, object_id, x, y, w, h) sorted by frames.
+
+    It behaves like a list of regions for each time step: `table[t]` is a RegionArray of the frame t
+    (a view of the table - O(1) by offsets of frames) and `len(table)` is the count of frames.
+    """
+
+    def __init__(self, table, frame_offsets):
+        self.table = table
+        self.frame_offsets = frame_offsets
+
+    @staticmethod
+    def from_columns(frames, objects_ids, boxes):
+        table = np.empty((len(frames), columns_count), dtype=np.int32)
+        table[:, COLUMN_FRAME] = frames
+        table[:, COLUMN_OBJECT_ID] = objects_ids
+        table[:, COLUMNS_BOX] = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        table = table[np.lexsort((table[:, COLUMN_OBJECT_ID], table[:, COLUMN_FRAME]))]
+        frames_count = int(table[-1, COLUMN_FRAME]) + 1 if len(table) > 0 else 0
+        frame_offsets = np.searchsorted(table[:, COLUMN_FRAME], np.arange(frames_count + 1))
+        return VaticTable(table, frame_offsets)
+
+    def __len__(self):
+        return len(self.frame_offsets) - 1
+
+    def get_frame_rows(self, t):
+        """Get rows (frame, object_id, x, y, w, h) of the frame t."""
+        return self.table[self.frame_offsets[t]:self.frame_offsets[t + 1]]
+
+    def get_boxes(self, t):
+        return self.get_frame_rows(t)[:, COLUMNS_BOX]
+
+    def __getitem__(self, t):
+        if t < 0 or t >= len(self):
+            raise IndexError("Frame out of the VATIC table: " + str(t))
+        return RegionArray(self.get_boxes(t))
+
+    def __iter__(self):
+        for t in range(len(self)):
+            yield self[t]
+
+
+def load_vatic_regions(path, use_cache=True):
+    """Parse a VATIC output file to the table of regions for each time step.
+
+    The parsed table is cached next to the xml file (see `load_vatic_table`).
     :param path: path of xml file
-    :return: list of lists consisting of regions for each time step
+    :param use_cache: load the table from the cache (and save it there) if it's possible
+    :return: VaticTable - `table[t]` is a RegionArray of regions of the time step t
+    """
+    return load_vatic_table(path, use_cache)
+
+
+def load_vatic_table(path, use_cache=True):
+    """Load VaticTable from the cache or parse the xml file.
+
+    The cache consists of files `<path>.regions.npy`, `<path>.offsets.npy` (loaded as memory maps)
+    and `<path>.cache.json` with the key: modification time, size and SHA-1 of the xml file.
     """
-    max_polygon = 10000000000000
-    tree = ElementTree.parse(path)
-    root = tree.getroot()
-    all_right_measures = [[] for i in range(250)]
-    for child in root.findall('object'):
-        print(child.tag)
-        for act_count, subchild in enumerate(child):
-            if subchild.tag != 'polygon':
-                continue
-            if act_count > max_polygon:
-                raise RuntimeWarning("File has to many objects")
-
-            polygon = list(subchild)
+    if not use_cache:
+        return parse_vatic_file(path)
+    key = _get_cache_key(path)
+    table = _load_cache(path, key)
+    if table is None:
+        table = parse_vatic_file(path)
+        _save_cache(path, key, table)
+    return table
+
+
+def parse_vatic_file(path):
+    """Parse a VATIC output file incrementally (elements are freed after parsing) to the VaticTable."""
+    frames = array.array('i')
+    objects_ids = array.array('i')
+    boxes = array.array('i')
+    object_index = -1
+    object_id = None
+    in_polygon = False
+    root = None
+
+    for event, element in ElementTree.iterparse(path, events=('start', 'end')):
+        if root is None:
+            root = element
+        if event == 'start':
+            if element.tag == 'object':
+                object_index += 1
+                object_id = object_index
+            elif element.tag == 'polygon':
+                in_polygon = True
+            continue
+
+        if element.tag == 'id' and not in_polygon and object_id is not None:
+            object_id = int(element.text)
+        elif element.tag == 'polygon':
+            in_polygon = False
+            polygon = list(element)
             t = int(polygon[0].text)
             down_lef_point = (int(polygon[1].find("x").text), int(polygon[1].find("y").text))
             up_right_point = (int(polygon[3].find("x").text), int(polygon[3].find("y").text))
-            w = up_right_point[0]-down_lef_point[0]
-            h = up_right_point[1]-down_lef_point[1]
-            measure = Region(down_lef_point[0], down_lef_point[1], w, h)
-
-            if len(all_right_measures) < t+1:
-                _resize_list(all_right_measures, t + 1)
-            all_right_measures[t].append(measure)
-    for t, t_measure_list in enumerate(all_right_measures):
-        print(len(t_measure_list), "|t=", t)
-    print("Finish")
-    return all_right_measures
-
-
-def _resize_list(all_right_measures, given_size):
-    list_len = len(all_right_measures)
-    if list_len < given_size:
-        all_right_measures.extend([] for i in range(given_size-list_len))
-    return all_right_measures
+            frames.append(t)
+            objects_ids.append(object_id)
+            boxes.extend((down_lef_point[0], down_lef_point[1],
+                          up_right_point[0] - down_lef_point[0], up_right_point[1] - down_lef_point[1]))
+            element.clear()
+        elif element.tag == 'object':
+            object_id = None
+            root.clear()  # Free parsed objects
+
+    return VaticTable.from_columns(np.frombuffer(frames, dtype=np.int32), np.frombuffer(objects_ids, dtype=np.int32),
+                                   np.frombuffer(boxes, dtype=np.int32))
+
+
+def _get_cache_paths(path):
+    return path + '.regions.npy', path + '.offsets.npy', path + '.cache.json'
+
+
+def _get_file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as xml_file:
+        for chunk in iter(lambda: xml_file.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _get_cache_key(path):
+    stat = os.stat(path)
+    return {'version': cache_version, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def _load_cache(path, key):
+    """Load the table from the cache if it's valid for the actual xml file, otherwise return None."""
+    regions_path, offsets_path, key_path = _get_cache_paths(path)
+    try:
+        with open(key_path) as key_file:
+            cached_key = json.load(key_file)
+        if cached_key.get('version') != key['version'] or cached_key.get('size') != key['size']:
+            return None
+        if cached_key.get('mtime_ns') != key['mtime_ns']:
+            # The file was touched - check its content
+            key['sha1'] = _get_file_sha1(path)
+            if cached_key.get('sha1') != key['sha1']:
+                return None
+            _write_key(key_path, key)
+        return VaticTable(np.load(regions_path, mmap_mode='r'), np.load(offsets_path, mmap_mode='r'))
+    except (OSError, ValueError):
+        return None
+
+
+def _save_cache(path, key, table):
+    regions_path, offsets_path, key_path = _get_cache_paths(path)
+    if 'sha1' not in key:
+        key['sha1'] = _get_file_sha1(path)
+    try:
+        if os.path.exists(key_path):
+            os.remove(key_path)
+        np.save(regions_path, table.table)
+        np.save(offsets_path, table.frame_offsets)
+        _write_key(key_path, key)  # The key is written at the end, so the cache is valid only if it's complete
+    except OSError:
+        pass  # e.g. read only directory - the cache is only an optimization
+
+
+def _write_key(key_path, key):
+    temporary_path = key_path + '.tmp'
+    with open(temporary_path, 'w') as key_file:
+        json.dump(key, key_file)
+    os.replace(temporary_path, key_path)
@@ -0,0 +1,50 @@
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+from autotune import Autotuner, compute_masks, evaluate_on_masks
+from benchmarks.synthetic import SyntheticTrafficScene, write_vatic_xml, write_video
+from config import PipelineConfig
+from evaluate import evaluate_clip, metrics_names
+
+
+class AutotuneWithRegionOfInterestTest(unittest.TestCase):
+    """Autotuning of a config with the ROI - cached masks are cropped, so regions have to be moved back
+    to the full frame and filtered by lanes as in the normal pipeline."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_directory = os.path.join(self.directory, 'cache')
+        self.video_path = os.path.join(self.directory, 'clip.avi')
+        self.vatic_path = os.path.join(self.directory, 'clip.xml')
+        ground_truth = write_video(SyntheticTrafficScene(width=320, height=180, objects_count=4), self.video_path, 60)
+        write_vatic_xml(ground_truth, self.vatic_path)
+        self.config = PipelineConfig(roi_polygons=[[[20, 10], [300, 10], [300, 170], [20, 170]]],
+                                     lane_polygons=[[[0, 0], [320, 0], [320, 180], [0, 180]]],
+                                     frames_count_to_stabilize=5)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cached_masks_give_the_same_metrics_as_the_pipeline(self):
+        compute_masks(self.video_path, [self.config], self.cache_directory)
+        cached_result = evaluate_on_masks(self.video_path, self.vatic_path, self.config, self.cache_directory)
+        result = evaluate_clip(self.video_path, self.vatic_path, self.config)
+        self.assertNotIn('error', cached_result)
+        for name in metrics_names:
+            self.assertEqual(cached_result[name + '_count'], result[name + '_count'])
+            self.assertAlmostEqual(cached_result[name], result[name])
+
+    def test_search_with_roi(self):
+        autotuner = Autotuner(self.directory, self.cache_directory, self.config, processes=1)
+        ranking = autotuner.search({'erode': [1, 2], 'dilate': [2, 3]}, 'grid')
+        self.assertEqual(len(ranking), 4)
+        for _, summary, score in ranking:
+            self.assertEqual(summary['failed'], 0)
+            self.assertTrue(math.isfinite(score))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+import os
+import struct
+
+import numpy as np
+
+
+# Fixed-width record of a track in a frame
+record_dtype = np.dtype([('frame', '<i4'), ('id', '<i4'), ('x', '<i4'), ('y', '<i4'), ('w', '<i4'), ('h', '<i4'),
+                         ('flags', '<u2')])
+
+# Flags of records
+FLAG_UPDATED = 1  # The tracker was corrected by a measured region in this frame
+FLAG_NEW = 2  # The first frame of the track
+
+# Layout of the file: header, contiguous records, index of chunks, footer
+header_format = '<8sII'  # Magic, version, size of record
+header_magic = b'CTRKLOG1'
+version = 2  # Version 1 had 16-bit coordinates
+chunk_dtype = np.dtype([('offset', '<u8'), ('count', '<u8'), ('first_frame', '<i4'), ('last_frame', '<i4'),
+                        ('min_id', '<i4'), ('max_id', '<i4')])
+footer_format = '<QQ8s'  # Offset of the index, count of chunks, magic
+footer_magic = b'CTRKIDX1'
+header_size = struct.calcsize(header_format)
+footer_size = struct.calcsize(footer_format)
+
+
+class TrackLogWriter:
+    """Append records (frame, id, x, y, w, h, flags) of tracks to a binary log file.
+
+    Records are collected in a preallocated chunk and written by one call when the chunk is full,
+    so the cost per frame is only copying of a few values. The index of chunks (ranges of frames
+    and ids) is written as a footer when the log is closed. An existing log is continued: its footer
+    is removed and written again at the end - if it's missing (the process was killed), the index
+    is rebuilt from records (a partially written record is discarded).
+    Frames must be written in non-decreasing order (see `next_frame` when a log is continued).
+    """
+
+    def __init__(self, path, chunk_size=65536):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.chunks = np.zeros(0, dtype=chunk_dtype)
+        self.__chunk = np.zeros(chunk_size, dtype=record_dtype)
+        self.__chunk_count = 0
+        self.__last_frame = -1
+        self.__known_ids = set()
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.chunks, data_end = _read_index(path, chunk_size)
+            self.file = open(path, 'r+b')
+            self.file.truncate(data_end)
+            self.file.seek(data_end)
+            if len(self.chunks) > 0:
+                self.__last_frame = int(self.chunks[-1]['last_frame'])
+                # Tracks of the last frame continue after the restart - they aren't new
+                self.__known_ids = set(self.__read_last_frame_ids().tolist())
+        else:
+            self.file = open(path, 'wb')
+            self.file.write(struct.pack(header_format, header_magic, version, record_dtype.itemsize))
+
+    def __read_last_frame_ids(self):
+        """Read ids of records of the last frame (they can span more chunks) from the end of the file."""
+        ids = []
+        for chunk in self.chunks[::-1]:
+            self.file.seek(int(chunk['offset']))
+            records = np.frombuffer(self.file.read(int(chunk['count']) * record_dtype.itemsize), dtype=record_dtype)
+            ids.append(records['id'][records['frame'] == self.__last_frame])
+            if chunk['first_frame'] < self.__last_frame:
+                break
+        self.file.seek(0, os.SEEK_END)
+        return np.concatenate(ids)
+
+    @property
+    def next_frame(self):
+        """Index of the frame after the last written one (e.g. the offset of frames of a continued log)."""
+        return self.__last_frame + 1
+
+    def write(self, frame_index, tracks, flags=None):
+        """Append tracks of the frame.
+
+        :param tracks: (N,5) array of (tracker_id, x, y, w, h) - see `MultiObjectsTracker.get_tracks_array`
+        :param flags: (N,) array of flags of records (None - no flags)
+        """
+        if frame_index < self.__last_frame:
+            raise ValueError("Frames must be written in order: {frame} after {last}".format(
+                frame=frame_index, last=self.__last_frame))
+        self.__last_frame = frame_index
+        tracks = np.asarray(tracks).reshape(-1, 5)
+        start = 0
+        while start < len(tracks):
+            count = min(len(tracks) - start, self.chunk_size - self.__chunk_count)
+            records = self.__chunk[self.__chunk_count:self.__chunk_count + count]
+            part = tracks[start:start + count]
+            records['frame'] = frame_index
+            records['id'] = part[:, 0]
+            records['x'] = part[:, 1]
+            records['y'] = part[:, 2]
+            records['w'] = part[:, 3]
+            records['h'] = part[:, 4]
+            records['flags'] = 0 if flags is None else flags[start:start + count]
+            self.__chunk_count += count
+            start += count
+            if self.__chunk_count == self.chunk_size:
+                self.flush()
+
+    def write_trackers(self, frame_index, multi_tracker):
+        """Append tracks of all trackers of the MultiObjectsTracker in the frame."""
+        trackers = multi_tracker.trackers
+        flags = np.fromiter(((FLAG_UPDATED if tracker.frames_without_update == 0 else 0) |
+                             (FLAG_NEW if tracker.tracker_id not in self.__known_ids else 0)
+                             for tracker in trackers), dtype=np.uint16, count=len(trackers))
+        self.__known_ids = {tracker.tracker_id for tracker in trackers}
+        self.write(frame_index, multi_tracker.get_tracks_array(), flags)
+
+    def flush(self):
+        """Write collected records as a new chunk (the index is written only by `close`)."""
+        if self.__chunk_count == 0:
+            return
+        records = self.__chunk[:self.__chunk_count]
+        offset = self.file.tell()
+        self.file.write(records.tobytes())
+        self.file.flush()
+        self.chunks = _append_chunk(self.chunks, offset, records)
+        self.__chunk_count = 0
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        index_offset = self.file.tell()
+        self.file.write(self.chunks.tobytes())
+        self.file.write(struct.pack(footer_format, index_offset, len(self.chunks), footer_magic))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+        return False
+
+
+def _append_chunk(chunks, offset, records):
+    chunk = np.zeros(1, dtype=chunk_dtype)
+    chunk['offset'] = offset
+    chunk['count'] = len(records)
+    chunk['first_frame'] = records['frame'][0]
+    chunk['last_frame'] = records['frame'][-1]
+    chunk['min_id'] = records['id'].min()
+    chunk['max_id'] = records['id'].max()
+    return np.concatenate([chunks, chunk])
+
+
+def _read_index(path, chunk_size=65536):
+    """Read the index of chunks of the log - from the footer, or rebuilt from records if there isn't any.
+
+    :return: (array of chunks, offset of the end of records)
+    """
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as log_file:
+        magic, log_version, record_size = struct.unpack(header_format, log_file.read(header_size))
+        if magic != header_magic:
+            raise ValueError("Not a track log: " + path)
+        if log_version != version or record_size != record_dtype.itemsize:
+            raise ValueError("Unsupported version of track log {version}: {path}".format(version=log_version,
+                                                                                          path=path))
+        if file_size >= header_size + footer_size:
+            log_file.seek(file_size - footer_size)
+            index_offset, chunks_count, magic = struct.unpack(footer_format, log_file.read(footer_size))
+            if magic == footer_magic and index_offset + chunks_count * chunk_dtype.itemsize + footer_size == file_size:
+                log_file.seek(index_offset)
+                chunks = np.frombuffer(log_file.read(chunks_count * chunk_dtype.itemsize), dtype=chunk_dtype)
+                return chunks.copy(), index_offset
+
+    # No footer - the log wasn't closed, recover complete records (until frames stop being ordered,
+    # e.g. a partially written index)
+    records_count = (file_size - header_size) // record_dtype.itemsize
+    chunks = np.zeros(0, dtype=chunk_dtype)
+    if records_count > 0:
+        records = np.memmap(path, dtype=record_dtype, mode='r', offset=header_size, shape=(records_count,))
+        frames = records['frame']
+        is_broken = (frames < 0) | (np.diff(frames, prepend=frames[:1]) < 0)
+        if is_broken.any():
+            records_count = int(np.argmax(is_broken))
+        for start in range(0, records_count, chunk_size):
+            chunk_records = records[start:min(start + chunk_size, records_count)]
+            chunks = _append_chunk(chunks, header_size + start * record_dtype.itemsize, chunk_records)
+        del records, frames
+    return chunks, header_size + records_count * record_dtype.itemsize
+
+
+class TrackLogReader:
+    """Read a track log as a memory-mapped array of records (see `record_dtype`).
+
+    Records are sorted by frames, so a range of frames is a view of the mapped file (nothing is copied).
+    Queries by ids skip chunks by the index and return copies of matching records.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks, data_end = _read_index(path)
+        records_count = (data_end - header_size) // record_dtype.itemsize
+        if records_count > 0:
+            self.records = np.memmap(path, dtype=record_dtype, mode='r', offset=header_size, shape=(records_count,))
+        else:
+            self.records = np.zeros(0, dtype=record_dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __get_record_index(self, frame_index):
+        """Index of the first record of the frame (or the next one) - the chunk is found by the index first."""
+        chunk_position = np.searchsorted(self.chunks['last_frame'], frame_index, side='left')
+        if chunk_position >= len(self.chunks):
+            return len(self.records)
+        chunk = self.chunks[chunk_position]
+        start = (int(chunk['offset']) - header_size) // record_dtype.itemsize
+        frames = self.records['frame'][start:start + int(chunk['count'])]
+        return start + int(np.searchsorted(frames, frame_index, side='left'))
+
+    def get_frames(self, first_frame, last_frame=None):
+        """Get records of frames from first_frame to last_frame (inclusive) - a view of the file."""
+        if last_frame is None:
+            last_frame = first_frame
+        return self.records[self.__get_record_index(first_frame):self.__get_record_index(last_frame + 1)]
+
+    def get_ids(self, min_id, max_id=None, first_frame=None, last_frame=None):
+        """Get records of tracks with ids from min_id to max_id (inclusive), optionally only in a range of frames."""
+        if max_id is None:
+            max_id = min_id
+        chunks = self.chunks
+        is_selected = (chunks['max_id'] >= min_id) & (chunks['min_id'] <= max_id)
+        if first_frame is not None:
+            is_selected &= chunks['last_frame'] >= first_frame
+        if last_frame is not None:
+            is_selected &= chunks['first_frame'] <= last_frame
+        parts = []
+        for chunk in chunks[is_selected]:
+            start = (int(chunk['offset']) - header_size) // record_dtype.itemsize
+            records = self.records[start:start + int(chunk['count'])]
+            is_matching = (records['id'] >= min_id) & (records['id'] <= max_id)
+            if first_frame is not None:
+                is_matching &= records['frame'] >= first_frame
+            if last_frame is not None:
+                is_matching &= records['frame'] <= last_frame
+            parts.append(records[is_matching])
+        if len(parts) == 0:
+            return np.zeros(0, dtype=record_dtype)
+        return np.concatenate(parts)
+
+    @staticmethod
+    def get_boxes(records):
+        """Get (N,4) int32 array of boxes (x, y, w, h) of records."""
+        return np.stack([records['x'], records['y'], records['w'], records['h']], axis=1).astype(np.int32)
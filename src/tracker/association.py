@@ -0,0 +1,240 @@
+import numpy as np
+
+from region import GridIndex, get_subregions_array, get_overlapping_matrix, get_iou_matrix
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+
+class CasesAssociation:
+    """Association of measured regions and predictions of trackers solved for 6 cases
+    (see `MultiObjectsTracker`) with array operations on the overlapping pairs.
+
+    Overlapping pairs is a sparse form of the overlapping matrix: (regions, trackers) arrays of indexes
+    of all overlapping pairs (e.g. from `np.nonzero(overlapping_matrix)` or `GridIndex.query`).
+    All results are indexes of trackers and regions or arrays of boxes:
+        lost_trackers        - 1. Trackers 1  <=> 0  Regions
+        new_regions          - 2. Trackers 0  <=> 1  Region
+        single_trackers, single_regions               - 3. Trackers 1  <=> 1  Region
+        shared_trackers, shared_boxes                 - 4. Trackers 2+ <=> 1  Region
+        merged_trackers, merged_boxes                 - 5. Trackers 1  <=> 2+ Regions
+        merged_shared_trackers, merged_shared_boxes   - 6. Trackers 2+ <=> 2+ Regions
+    """
+
+    def __init__(self, overlapping_pairs, measure_boxes, predicted_boxes):
+        pair_regions = np.asarray(overlapping_pairs[0], dtype=np.intp)
+        pair_trackers = np.asarray(overlapping_pairs[1], dtype=np.intp)
+        trackers_count_by_region = np.bincount(pair_regions, minlength=len(measure_boxes))
+        regions_count_by_tracker = np.bincount(pair_trackers, minlength=len(predicted_boxes))
+
+        self.lost_trackers = np.flatnonzero(regions_count_by_tracker == 0)
+        self.new_regions = np.flatnonzero(trackers_count_by_region == 0)
+
+        # Trackers with exactly one region (pairs sorted by trackers)
+        is_one_region_pair = regions_count_by_tracker[pair_trackers] == 1
+        order = np.argsort(pair_trackers[is_one_region_pair], kind='stable')
+        one_region_trackers = pair_trackers[is_one_region_pair][order]
+        one_region_of_tracker = pair_regions[is_one_region_pair][order]
+        is_single = trackers_count_by_region[one_region_of_tracker] == 1
+        self.single_trackers = one_region_trackers[is_single]
+        self.single_regions = one_region_of_tracker[is_single]
+        self.shared_trackers = one_region_trackers[~is_single]
+        self.shared_boxes = get_subregions_array(measure_boxes[one_region_of_tracker[~is_single]],
+                                                 predicted_boxes[self.shared_trackers])
+
+        # Trackers with many regions - merge all theirs regions
+        many_regions_trackers = np.flatnonzero(regions_count_by_tracker > 1)
+        is_many_regions_pair = regions_count_by_tracker[pair_trackers] > 1
+        merged_boxes = CasesAssociation.__merge_boxes_by_trackers(
+            measure_boxes, pair_regions[is_many_regions_pair], pair_trackers[is_many_regions_pair],
+            len(predicted_boxes))[many_regions_trackers]
+        shared_regions_count = np.bincount(pair_trackers, weights=trackers_count_by_region[pair_regions] > 1,
+                                           minlength=len(predicted_boxes))
+        has_shared_region = shared_regions_count[many_regions_trackers] > 0
+        self.merged_trackers = many_regions_trackers[~has_shared_region]
+        self.merged_boxes = merged_boxes[~has_shared_region]
+        self.merged_shared_trackers = many_regions_trackers[has_shared_region]
+        self.merged_shared_boxes = get_subregions_array(merged_boxes[has_shared_region],
+                                                        predicted_boxes[self.merged_shared_trackers])
+
+    @staticmethod
+    def from_matches(matched_trackers, matched_regions, trackers_count, regions_count):
+        """Create association with only 1 <=> 1 cases (others are empty) from matched pairs."""
+        association = CasesAssociation.__new__(CasesAssociation)
+        association.single_trackers = np.asarray(matched_trackers, dtype=np.intp)
+        association.single_regions = np.asarray(matched_regions, dtype=np.intp)
+        association.lost_trackers = np.setdiff1d(np.arange(trackers_count), association.single_trackers)
+        association.new_regions = np.setdiff1d(np.arange(regions_count), association.single_regions)
+        no_trackers = np.empty(0, dtype=np.intp)
+        no_boxes = np.empty((0, 4), dtype=np.int32)
+        association.shared_trackers, association.shared_boxes = no_trackers, no_boxes
+        association.merged_trackers, association.merged_boxes = no_trackers, no_boxes
+        association.merged_shared_trackers, association.merged_shared_boxes = no_trackers, no_boxes
+        return association
+
+    @staticmethod
+    def __merge_boxes_by_trackers(boxes, regions, trackers, trackers_count):
+        """Merge boxes of regions (the same as `Region.merge_regions`) for each tracker of given pairs."""
+        big = np.iinfo(np.int32).max
+        x = np.full(trackers_count, big, dtype=np.int64)
+        y = np.full(trackers_count, big, dtype=np.int64)
+        x2 = np.full(trackers_count, -big, dtype=np.int64)
+        y2 = np.full(trackers_count, -big, dtype=np.int64)
+        np.minimum.at(x, trackers, boxes[regions, 0])
+        np.minimum.at(y, trackers, boxes[regions, 1])
+        np.maximum.at(x2, trackers, boxes[regions, 0] + boxes[regions, 2])
+        np.maximum.at(y2, trackers, boxes[regions, 1] + boxes[regions, 3])
+        return np.stack([x, y, x2 - x, y2 - y], axis=1).astype(np.int32)
+
+
+class DalkaAssociation:
+    """Default association: every overlapping region and prediction are associated,
+    then 6 cases are solved by rules of Dalka (see `CasesAssociation`).
+
+    For many objects the overlapping pairs are found with a spatial grid index over predictions
+    (see `GridIndex`), so only neighbouring boxes are compared.
+    """
+
+    def __init__(self, min_pairs_for_grid=90000, cell_size=None):
+        """
+        :param min_pairs_for_grid: use the grid index when count of all pairs is at least this value,
+            for less objects (up to about 300 x 300) all pairs are compared, because it is faster
+        :param cell_size: size of cells of the grid (default - adjusted to size of predictions)
+        """
+        self.min_pairs_for_grid = min_pairs_for_grid
+        self.cell_size = cell_size
+
+    def associate(self, measure_boxes, predicted_boxes):
+        if len(measure_boxes) * len(predicted_boxes) >= self.min_pairs_for_grid:
+            overlapping_pairs = GridIndex(predicted_boxes, self.cell_size).query(measure_boxes)
+        else:
+            overlapping_pairs = np.nonzero(get_overlapping_matrix(measure_boxes, predicted_boxes))
+        return CasesAssociation(overlapping_pairs, measure_boxes, predicted_boxes)
+
+
+class AssignmentAssociation:
+    """Association of each region with at most one tracker (and vice versa) by assignment on a cost matrix.
+
+    Costs:
+        'iou'      - 1 - IoU of region and prediction, pairs with IoU lower than `min_iou` are never associated,
+        'distance' - distance of centres, pairs more distant than `max_distance` are never associated.
+    Methods:
+        'optimal'  - minimal sum of costs (Hungarian algorithm, from scipy if it is installed),
+        'greedy'   - pairs with the lowest cost first (fast, good enough for not crowded scenes).
+    Unassigned trackers and regions are lost trackers and new regions (only cases 1, 2 and 3 occur).
+    """
+    unfeasible_cost = 1e6
+
+    def __init__(self, cost='iou', method='optimal', min_iou=0.1, max_distance=50.0):
+        assert cost in ('iou', 'distance') and method in ('optimal', 'greedy')
+        self.cost = cost
+        self.method = method
+        self.min_iou = min_iou
+        self.max_distance = max_distance
+
+    def get_cost_matrix(self, measure_boxes, predicted_boxes):
+        """Get (regions, trackers) matrix of costs and the mask of pairs which pass the gate."""
+        if self.cost == 'iou':
+            iou = get_iou_matrix(measure_boxes, predicted_boxes)
+            return 1.0 - iou, iou >= self.min_iou
+        measure_centres = measure_boxes[:, :2] + measure_boxes[:, 2:] / 2.0
+        predicted_centres = predicted_boxes[:, :2] + predicted_boxes[:, 2:] / 2.0
+        distance = np.linalg.norm(measure_centres[:, None, :] - predicted_centres[None, :, :], axis=2)
+        return distance, distance <= self.max_distance
+
+    def associate(self, measure_boxes, predicted_boxes):
+        cost, is_feasible = self.get_cost_matrix(measure_boxes, predicted_boxes)
+        if self.method == 'optimal':
+            regions, trackers = solve_linear_assignment(
+                np.where(is_feasible, cost, AssignmentAssociation.unfeasible_cost))
+            is_matched = is_feasible[regions, trackers]
+            regions, trackers = regions[is_matched], trackers[is_matched]
+        else:
+            regions, trackers = solve_greedy_assignment(cost, is_feasible)
+        return CasesAssociation.from_matches(trackers, regions, len(predicted_boxes), len(measure_boxes))
+
+
+def create_association(name='dalka', **parameters):
+    """Create association strategy by its name: 'dalka', 'hungarian' or 'greedy'."""
+    if name == 'dalka':
+        return DalkaAssociation(**parameters)
+    if name == 'hungarian':
+        return AssignmentAssociation(method='optimal', **parameters)
+    if name == 'greedy':
+        return AssignmentAssociation(method='greedy', **parameters)
+    raise ValueError("Unknown association: " + str(name))
+
+
+def solve_greedy_assignment(cost, is_feasible):
+    """Assign pairs (rows, columns) in order of increasing cost, each row and column at most once."""
+    rows, columns = np.nonzero(is_feasible)
+    order = np.argsort(cost[rows, columns], kind='stable')
+    used_rows = np.zeros(cost.shape[0], dtype=bool)
+    used_columns = np.zeros(cost.shape[1], dtype=bool)
+    assigned_rows, assigned_columns = [], []
+    for row, column in zip(rows[order].tolist(), columns[order].tolist()):
+        if not used_rows[row] and not used_columns[column]:
+            used_rows[row] = used_columns[column] = True
+            assigned_rows.append(row)
+            assigned_columns.append(column)
+    return np.array(assigned_rows, dtype=np.intp), np.array(assigned_columns, dtype=np.intp)
+
+
+def solve_linear_assignment(cost):
+    """Assignment of rows to columns with minimal sum of costs (min(rows, columns) pairs).
+
+    :return: (rows, columns) arrays of assigned pairs, sorted by rows
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    if cost.size == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    if linear_sum_assignment is not None:
+        rows, columns = linear_sum_assignment(cost)
+        return rows.astype(np.intp), columns.astype(np.intp)
+    if cost.shape[0] > cost.shape[1]:
+        columns, rows = _hungarian(cost.T)
+        order = np.argsort(rows)
+        return rows[order], columns[order]
+    return _hungarian(cost)
+
+
+def _hungarian(cost):
+    """Hungarian algorithm (shortest augmenting paths with potentials) for cost with rows <= columns."""
+    rows_count, columns_count = cost.shape
+    # Index 0 is a dummy column/row, so real rows and columns are numbered from 1
+    u = np.zeros(rows_count + 1)
+    v = np.zeros(columns_count + 1)
+    row_of_column = np.zeros(columns_count + 1, dtype=np.intp)
+    way = np.zeros(columns_count + 1, dtype=np.intp)
+    for row in range(1, rows_count + 1):
+        row_of_column[0] = row
+        column = 0
+        min_values = np.full(columns_count + 1, np.inf)
+        used = np.zeros(columns_count + 1, dtype=bool)
+        while True:
+            used[column] = True
+            actual_row = row_of_column[column]
+            reduced = cost[actual_row - 1] - u[actual_row] - v[1:]
+            is_better = ~used[1:] & (reduced < min_values[1:])
+            min_values[1:][is_better] = reduced[is_better]
+            way[1:][is_better] = column
+            free_values = np.where(used[1:], np.inf, min_values[1:])
+            next_column = int(np.argmin(free_values)) + 1
+            delta = free_values[next_column - 1]
+            u[row_of_column[used]] += delta
+            v[used] -= delta
+            min_values[~used] -= delta
+            column = next_column
+            if row_of_column[column] == 0:
+                break
+        # Change assignments along the augmenting path
+        while column != 0:
+            previous_column = way[column]
+            row_of_column[column] = row_of_column[previous_column]
+            column = previous_column
+    columns = np.flatnonzero(row_of_column[1:]) + 1
+    rows = row_of_column[columns] - 1
+    order = np.argsort(rows)
+    return rows[order], columns[order] - 1
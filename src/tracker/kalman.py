@@ -1,24 +1,241 @@
 import random
-from queue import Queue
 
-import cv2
 import numpy as np
 
 from region import Region
 
 
+class KalmanBank:
+    """Kalman filters of many trackers kept as stacked arrays, so all of them
+    are predicted or corrected in one vectorized call.
+
+    Each filter uses a slot (index of the first axis of all arrays). Slots of removed
+    filters are kept on a free list and reused by new filters. The math is the same as
+    in cv2.KalmanFilter with the measurement matrix [I 0] (measures are the first
+    `measure_params` values of the state).
+
+    Predicted boxes and velocities of the last `history_size` predictions of each filter are kept
+    in preallocated ring buffers ((C,K,4) arrays), written by `predict` without any allocation
+    (see `get_history`). With `history_size` 0 no history is kept.
+    """
+    matrix_size = 8
+    min_matrix_size = 4
+    measure_params = 4
+    default_history_size = 25  # One second at 25 FPS (e.g. for smoothed speeds of tracks)
+
+    def __init__(self, capacity=64, history_size=default_history_size):
+        if history_size < 0:
+            raise ValueError("Size of history can't be negative: " + str(history_size))
+        self.capacity = 0
+        self.history_size = history_size
+        self.state_pre = np.empty((0, KalmanBank.matrix_size), dtype=np.float32)
+        self.state_post = np.empty((0, KalmanBank.matrix_size), dtype=np.float32)
+        self.error_cov_pre = np.empty((0, KalmanBank.matrix_size, KalmanBank.matrix_size), dtype=np.float32)
+        self.error_cov_post = np.empty((0, KalmanBank.matrix_size, KalmanBank.matrix_size), dtype=np.float32)
+        self.transition_matrix = np.empty((0, KalmanBank.matrix_size, KalmanBank.matrix_size), dtype=np.float32)
+        self.process_noise_cov = np.empty((0, KalmanBank.matrix_size, KalmanBank.matrix_size), dtype=np.float32)
+        self.measurement_noise_cov = np.empty((0, KalmanBank.measure_params, KalmanBank.measure_params),
+                                              dtype=np.float32)
+        self.active = np.zeros(0, dtype=bool)
+        self.history_boxes = np.empty((0, history_size, KalmanBank.measure_params), dtype=np.float32)
+        self.history_velocities = np.empty((0, history_size, KalmanBank.measure_params), dtype=np.float32)
+        self.history_count = np.zeros(0, dtype=np.int64)  # Count of predictions written to the ring buffer
+        self.__free_slots = []
+        self.__grow(capacity)
+
+        # Transition matrix: position and size are changed by velocities
+        measures_addiction = np.diag(
+            np.ones(KalmanBank.matrix_size - KalmanBank.min_matrix_size, dtype=np.float32),
+            k=KalmanBank.min_matrix_size)
+        self.__default_transition_matrix = np.eye(KalmanBank.matrix_size, dtype=np.float32) + measures_addiction
+
+    def __grow(self, new_capacity):
+        added = new_capacity - self.capacity
+        if added <= 0:
+            return
+
+        def extended(array):
+            return np.concatenate([array, np.zeros((added,) + array.shape[1:], dtype=array.dtype)])
+
+        self.state_pre = extended(self.state_pre)
+        self.state_post = extended(self.state_post)
+        self.error_cov_pre = extended(self.error_cov_pre)
+        self.error_cov_post = extended(self.error_cov_post)
+        self.transition_matrix = extended(self.transition_matrix)
+        self.process_noise_cov = extended(self.process_noise_cov)
+        self.measurement_noise_cov = extended(self.measurement_noise_cov)
+        self.active = extended(self.active)
+        self.history_boxes = extended(self.history_boxes)
+        self.history_velocities = extended(self.history_velocities)
+        self.history_count = extended(self.history_count)
+        # The lowest free slots are used first
+        self.__free_slots.extend(range(new_capacity - 1, self.capacity - 1, -1))
+        self.capacity = new_capacity
+
+    def add(self, start_measure, meaningful_of_noise=0.5):
+        """Init a new filter with the measure (x, y, w, h) and return its slot."""
+        if len(self.__free_slots) == 0:
+            self.__grow(max(1, self.capacity * 2))
+        slot = self.__free_slots.pop()
+        size = KalmanBank.matrix_size
+
+        self.state_pre[slot] = 0
+        self.state_pre[slot, :KalmanBank.measure_params] = start_measure
+        self.state_post[slot] = self.state_pre[slot]
+        self.error_cov_pre[slot] = 0
+        self.error_cov_post[slot] = np.eye(size, dtype=np.float32) * 0.1
+        self.transition_matrix[slot] = self.__default_transition_matrix
+        self.process_noise_cov[slot] = np.eye(size, dtype=np.float32) * meaningful_of_noise
+        self.measurement_noise_cov[slot] = np.eye(KalmanBank.measure_params, dtype=np.float32) * 0.1
+        self.active[slot] = True
+        self.history_count[slot] = 0
+        return slot
+
+    def get_state(self):
+        """Get all arrays of the bank (e.g. to save it) - see `set_state`."""
+        return {'state_pre': self.state_pre, 'state_post': self.state_post, 'error_cov_pre': self.error_cov_pre,
+                'error_cov_post': self.error_cov_post, 'transition_matrix': self.transition_matrix,
+                'process_noise_cov': self.process_noise_cov, 'measurement_noise_cov': self.measurement_noise_cov,
+                'active': self.active, 'history_boxes': self.history_boxes,
+                'history_velocities': self.history_velocities, 'history_count': self.history_count}
+
+    def set_state(self, state):
+        """Restore arrays of the bank got by `get_state` (free slots are the inactive ones).
+
+        The size of history of the bank is kept - history saved with another size is cut to (or padded up to) it.
+        """
+        history_size = self.history_size
+        self.state_pre = np.array(state['state_pre'], dtype=np.float32)
+        self.state_post = np.array(state['state_post'], dtype=np.float32)
+        self.error_cov_pre = np.array(state['error_cov_pre'], dtype=np.float32)
+        self.error_cov_post = np.array(state['error_cov_post'], dtype=np.float32)
+        self.transition_matrix = np.array(state['transition_matrix'], dtype=np.float32)
+        self.process_noise_cov = np.array(state['process_noise_cov'], dtype=np.float32)
+        self.measurement_noise_cov = np.array(state['measurement_noise_cov'], dtype=np.float32)
+        self.active = np.array(state['active'], dtype=bool)
+        self.capacity = len(self.active)
+        if 'history_boxes' in state:
+            self.history_boxes = np.array(state['history_boxes'], dtype=np.float32)
+            self.history_velocities = np.array(state['history_velocities'], dtype=np.float32)
+            self.history_count = np.array(state['history_count'], dtype=np.int64)
+            self.history_size = self.history_boxes.shape[1]
+            if self.history_size != history_size:
+                self.__resize_history(history_size)
+        else:  # Saved without history
+            history_shape = (self.capacity, self.history_size, KalmanBank.measure_params)
+            self.history_boxes = np.zeros(history_shape, dtype=np.float32)
+            self.history_velocities = np.zeros(history_shape, dtype=np.float32)
+            self.history_count = np.zeros(self.capacity, dtype=np.int64)
+        self.__free_slots = [int(slot) for slot in np.flatnonzero(~self.active)[::-1]]
+
+    def __resize_history(self, history_size):
+        # Last predictions are moved to new ring buffers, the newest one of each filter is written at the position
+        # before the count of kept predictions
+        boxes, velocities, valid = self.get_history(np.arange(self.capacity), min(self.history_size, history_size))
+        counts = valid.sum(axis=1)
+        ages = np.arange(valid.shape[1] - 1, -1, -1)
+        history_shape = (self.capacity, history_size, KalmanBank.measure_params)
+        self.history_boxes = np.zeros(history_shape, dtype=np.float32)
+        self.history_velocities = np.zeros(history_shape, dtype=np.float32)
+        slots, indexes = np.nonzero(valid)
+        positions = counts[slots] - 1 - ages[indexes]
+        self.history_boxes[slots, positions] = boxes[slots, indexes]
+        self.history_velocities[slots, positions] = velocities[slots, indexes]
+        self.history_count = counts.astype(np.int64)
+        self.history_size = history_size
+
+    def remove(self, slot):
+        assert self.active[slot]
+        self.active[slot] = False
+        self.__free_slots.append(slot)
+
+    def active_slots(self):
+        return np.flatnonzero(self.active)
+
+    def predict(self, slots):
+        """Predict next state of filters in given slots.
+
+        As for a single tracker, the prediction is also used as the posterior state,
+        so filters can be predicted many times without correction.
+        :return: (K,4) array of predicted measures
+        """
+        slots = np.asarray(slots, dtype=np.intp)
+        transition = self.transition_matrix[slots]
+        state = np.matmul(transition, self.state_post[slots, :, None])[:, :, 0]
+        error_cov = np.matmul(np.matmul(transition, self.error_cov_post[slots]), transition.transpose(0, 2, 1))
+        error_cov += self.process_noise_cov[slots]
+
+        self.state_pre[slots] = state
+        self.state_post[slots] = state
+        self.error_cov_pre[slots] = error_cov
+        self.error_cov_post[slots] = error_cov
+
+        n = KalmanBank.measure_params
+        if self.history_size > 0:
+            positions = self.history_count[slots] % self.history_size
+            self.history_boxes[slots, positions] = state[:, :n]
+            self.history_velocities[slots, positions] = state[:, n:2 * n]
+            self.history_count[slots] += 1
+        return state[:, :n]
+
+    def get_history(self, slots, length=None):
+        """Get last predictions of filters in given slots, from the oldest to the newest.
+
+        :param length: count of last predictions (None or bigger than `history_size` - `history_size`)
+        :return: (boxes, velocities, valid) - (K,L,4) arrays of predicted boxes (x, y, w, h) and their velocities,
+                 (K,L) boolean array of filled items (a young filter has fewer predictions, missing are the oldest)
+        """
+        if length is None or length > self.history_size:
+            length = self.history_size
+        slots = np.asarray(slots, dtype=np.intp)
+        counts = self.history_count[slots, None]
+        ages = np.arange(length - 1, -1, -1)  # 0 - the newest prediction
+        positions = (counts - 1 - ages) % max(self.history_size, 1)
+        valid = ages < np.minimum(counts, self.history_size)
+        return self.history_boxes[slots[:, None], positions], self.history_velocities[slots[:, None], positions], valid
+
+    def get_mean_velocities(self, slots, length=None):
+        """Get (K,4) array of velocities of filters in given slots averaged over last predictions
+        (e.g. smoothed speed of tracks)."""
+        _, velocities, valid = self.get_history(slots, length)
+        counts = np.maximum(valid.sum(axis=1), 1)[:, None]
+        return (velocities * valid[:, :, None]).sum(axis=1) / counts
+
+    def correct(self, slots, measures):
+        """Correct filters in given slots based on real measures ((K,4) array of x, y, w, h).
+
+        :return: (K,4) array of estimated measures
+        """
+        slots = np.asarray(slots, dtype=np.intp)
+        n = KalmanBank.measure_params
+        error_cov = self.error_cov_pre[slots]
+        state = self.state_pre[slots]
+
+        # gain = P * H^T * (H * P * H^T + R)^-1, where H = [I 0]
+        error_cov_measured = error_cov[:, :n, :]
+        innovation_cov = error_cov_measured[:, :, :n] + self.measurement_noise_cov[slots]
+        gain = np.linalg.solve(innovation_cov, error_cov_measured).transpose(0, 2, 1)
+
+        residual = np.asarray(measures, dtype=np.float32) - state[:, :n]
+        state = state + np.matmul(gain, residual[:, :, None])[:, :, 0]
+        error_cov = error_cov - np.matmul(gain, error_cov_measured)
+
+        self.state_post[slots] = state
+        self.error_cov_post[slots] = error_cov
+        return state[:, :n]
+
+
 class KalmanTracker:
     """Kalman tracker designed for tracking a rectangle object witch changes
     its size and position. It uses a kalman filter. Default use consists of
     prediction the next state and update state based on actual measurement.
+
+    The filter is kept in a slot of a KalmanBank, so many trackers sharing the same
+    bank can be predicted and corrected together (see `MultiObjectsTracker`).
      """
     next_id = 1
-    matrix_size = 8
-    min_matrix_size = 4
-    measure_params = 4
-    max_history_predictions = 5
 
-    def __init__(self, start_measure, meaningful_of_noise=0.5):
+    def __init__(self, start_measure, meaningful_of_noise=0.5, bank=None):
         self.tracker_id = KalmanTracker.next_id
         KalmanTracker.next_id += 1
         self.color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))  # Set random RGB color
@@ -26,75 +243,54 @@ class KalmanTracker:
         self.act_prediction = start_measure
         self.frames_without_update = 0
         self.life_time = 0
-        self.prediction_history = Queue(KalmanTracker.max_history_predictions)
-
-        self.kalman_filter = cv2.KalmanFilter(
-            dynamParams=KalmanTracker.matrix_size,       # Dimension of the state
-            measureParams=KalmanTracker.measure_params,  # Dimension of measurement
-            controlParams=0)                             # Dimension of control vector
-
-        # Init state
-        pre_state = self.kalman_filter.statePre
-        pre_state = KalmanTracker.__get_updated_measure_array(pre_state, self.start_measure)
-        self.kalman_filter.statePre = pre_state
-        self.kalman_filter.statePost = np.copy(pre_state)  # Conversion
-
-        self.kalman_filter.measurementMatrix = cv2.setIdentity(self.kalman_filter.measurementMatrix)
-
-        # Set transitionMatrix
-        self.__measures_addiction = np.diag(
-            np.ones(KalmanTracker.matrix_size-KalmanTracker.min_matrix_size, dtype=np.float32),
-            k=KalmanTracker.min_matrix_size)
-        matrix_A = np.diag(np.ones(KalmanTracker.matrix_size, dtype=np.float32)) + self.__measures_addiction
-        self.kalman_filter.transitionMatrix = matrix_A
-
-        self.kalman_filter.processNoiseCov *= meaningful_of_noise
-        self.kalman_filter.measurementNoiseCov = cv2.setIdentity(
-            self.kalman_filter.measurementNoiseCov, KalmanTracker.__cv2_scalar_all(0.1))
-        self.kalman_filter.errorCovPost = cv2.setIdentity(
-            self.kalman_filter.errorCovPost, KalmanTracker.__cv2_scalar_all(0.1))
-
-    @staticmethod
-    def __cv2_scalar_all(value):
-        return np.full(shape=4, fill_value=value)
 
-    @staticmethod
-    def __get_updated_measure_array(array, measure):
-        array[0, 0] = measure.x
-        array[1, 0] = measure.y
-        array[2, 0] = measure.w
-        array[3, 0] = measure.h
-        return array
+        self.bank = bank if bank is not None else KalmanBank(capacity=1)
+        self.slot = self.bank.add(start_measure.get_matrix(), meaningful_of_noise)
 
     @staticmethod
-    def __decapsulate_measure(matrix):
-        """Subtract 4 parameters (x,y,w,h) from the 2D list to 1D."""
-        return matrix[:KalmanTracker.measure_params, 0]
+    def restore(bank, slot, tracker_id, color, start_measure, act_prediction, frames_without_update, life_time):
+        """Create the tracker of the filter which already is in the slot of the bank (e.g. restored from a file)."""
+        tracker = KalmanTracker.__new__(KalmanTracker)
+        tracker.tracker_id = tracker_id
+        tracker.color = color
+        tracker.start_measure = start_measure
+        tracker.act_prediction = act_prediction
+        tracker.frames_without_update = frames_without_update
+        tracker.life_time = life_time
+        tracker.bank = bank
+        tracker.slot = slot
+        return tracker
 
     def correct(self, measure):
         """Correct the model based on real measures."""
-        measures_array = np.array([measure.x, measure.y, measure.w, measure.h], dtype=np.float32)
-        estimated = self.kalman_filter.correct(measures_array)
-        estimated = KalmanTracker.__decapsulate_measure(estimated)
+        estimated = self.bank.correct([self.slot], [measure.get_matrix()])
+        return self.set_correction(estimated[0])
+
+    def set_correction(self, estimated):
+        """Set the result of correction made by the bank."""
         self.act_prediction = Region.from_matrix(estimated)
         return self.act_prediction
 
     def predict(self):
         """Predict next position and size of tracked object."""
-        prediction_raw = self.kalman_filter.predict()
-        self.kalman_filter.statePost = np.copy(self.kalman_filter.statePre)
-        self.kalman_filter.errorCovPost = np.copy(self.kalman_filter.errorCovPre)
-        prediction_decapsulated = KalmanTracker.__decapsulate_measure(prediction_raw)
-        prediction_wrap = Region.from_matrix(prediction_decapsulated)
-        self.act_prediction = prediction_wrap
-
-        # Collect last history:
-        if self.prediction_history.full():
-            self.prediction_history.get()
-        self.prediction_history.put(self.act_prediction)
+        prediction = self.bank.predict([self.slot])
+        return self.set_prediction(prediction[0])
 
+    def set_prediction(self, prediction):
+        """Set the prediction made by the bank."""
+        self.act_prediction = Region.from_matrix(prediction)
         return self.act_prediction
 
+    @property
+    def prediction_history(self):
+        """Last predictions (regions) of the tracker, from the oldest (kept in the ring buffer of the bank)."""
+        boxes, _, valid = self.bank.get_history([self.slot])
+        return [Region.from_matrix(box) for box in boxes[0][valid[0]]]
+
+    def release(self):
+        """Free the slot of the filter - the tracker can't be used anymore."""
+        self.bank.remove(self.slot)
+
     def mark_as_updated_in_this_frame(self):
         self.life_time += 1
         self.frames_without_update = 0
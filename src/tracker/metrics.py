@@ -1,109 +1,159 @@
 import numpy as np
-import math
 
-from region import Region, CoverArea
+from region import CoverArea, regions_to_array, get_overlapping_matrix
+
+
+class MetricAccumulator:
+    """Running sum and count of values of a metric (in range [0, 1]) - memory doesn't grow with frames.
+
+    Optionally values are counted in a histogram of fixed bins (for quantiles) and rolled up in windows
+    of frames (e.g. per minute of a video): the mean and count of values of each closed window is kept.
+    """
+
+    def __init__(self, histogram_bins=None, window_frames=None):
+        """
+        :param histogram_bins: count of bins of the histogram over [0, 1] (None - no histogram)
+        :param window_frames: count of frames of a window of rollups (None - no rollups)
+        """
+        self.total = 0.0
+        self.count = 0
+        self.frames_count = 0
+        self.histogram = np.zeros(histogram_bins, dtype=np.int64) if histogram_bins else None
+        self.window_frames = window_frames
+        self.windows = []  # (first frame, mean or None, count) of closed windows
+        self.__window_total = 0.0
+        self.__window_count = 0
+
+    def add(self, values):
+        """Add values of the metric in the next frame."""
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) > 0:
+            values_total = float(values.sum())
+            self.total += values_total
+            self.count += len(values)
+            if self.histogram is not None:
+                bins = len(self.histogram)
+                bin_indexes = np.clip((values * bins).astype(np.int64), 0, bins - 1)
+                self.histogram += np.bincount(bin_indexes, minlength=bins)
+            self.__window_total += values_total
+            self.__window_count += len(values)
+        self.frames_count += 1
+        if self.window_frames and self.frames_count % self.window_frames == 0:
+            self.__close_window()
+
+    def __close_window(self):
+        mean = self.__window_total / self.__window_count if self.__window_count > 0 else None
+        self.windows.append((self.frames_count - self.window_frames, mean, self.__window_count))
+        self.__window_total = 0.0
+        self.__window_count = 0
+
+    def get_mean(self):
+        if self.count > 0:
+            return self.total / self.count
+        return None
+
+    def get_quantile(self, quantile):
+        """Approximate quantile of values - the upper edge of the bin of the histogram containing it."""
+        if self.histogram is None:
+            raise ValueError("Quantiles need the histogram (histogram_bins)")
+        if self.count == 0:
+            return None
+        bin_index = int(np.searchsorted(np.cumsum(self.histogram), quantile * self.count, side='left'))
+        return min(bin_index + 1, len(self.histogram)) / len(self.histogram)
 
 
 class FragmentationMetric:
-    def __init__(self):
-        self.fragmentation_metrics = []
+    def __init__(self, histogram_bins=None, window_frames=None):
+        self.accumulator = MetricAccumulator(histogram_bins, window_frames)
 
     def update_metric_for_frame(self, correct_regions, predicted_regions):
-        overlapping_matrix = Region.compare_exists_in_regions(correct_regions, predicted_regions)
-        regions_count = len(correct_regions)
+        correct_boxes = regions_to_array(correct_regions)
+        predicted_boxes = regions_to_array(predicted_regions)
+        self.update_metric_for_boxes(correct_boxes, predicted_boxes,
+                                     get_overlapping_matrix(correct_boxes, predicted_boxes))
+
+    def update_metric_for_boxes(self, correct_boxes, predicted_boxes, overlapping_matrix):
         count_of_predicted_regions_by_region = np.sum(overlapping_matrix, axis=1)
-        for r in range(regions_count):
-            if count_of_predicted_regions_by_region[r] > 0:
-                overlapping_count = count_of_predicted_regions_by_region[r]
-                metric = 1.0/(1.0 + math.log(overlapping_count))
-                self.fragmentation_metrics.append(metric)
+        overlapping_counts = count_of_predicted_regions_by_region[count_of_predicted_regions_by_region > 0]
+        self.accumulator.add(1.0 / (1.0 + np.log(overlapping_counts)))
 
     def calculate_result(self):
-        if len(self.fragmentation_metrics) > 0:
-            return sum(self.fragmentation_metrics) / len(self.fragmentation_metrics)
-        else:
-            return None
+        return self.accumulator.get_mean()
 
 
 class AverageObjectAreaRecallMetric:
-    def __init__(self):
-        self.recall_aor_metrics = []
+    def __init__(self, histogram_bins=None, window_frames=None):
+        self.accumulator = MetricAccumulator(histogram_bins, window_frames)
 
     def update_metric_for_frame(self, correct_regions, predicted_regions):
-        overlapping_matrix = Region.compare_exists_in_regions(correct_regions, predicted_regions)
-        predicted_regions_count = len(predicted_regions)
-        correct_regions_count = len(correct_regions)
-
-        for cr in range(correct_regions_count):
-            correct_region = correct_regions[cr]
-            assert isinstance(correct_region, Region)
-            overlapping_regions = []
-
-            for pr in range(predicted_regions_count):
-                if overlapping_matrix[cr, pr]:
-                    full_region_overlapping = predicted_regions[pr]
-                    overlapping_region = correct_region.get_own_subregion(full_region_overlapping)
-                    overlapping_regions.append(overlapping_region)
+        correct_boxes = regions_to_array(correct_regions)
+        predicted_boxes = regions_to_array(predicted_regions)
+        self.update_metric_for_boxes(correct_boxes, predicted_boxes,
+                                     get_overlapping_matrix(correct_boxes, predicted_boxes))
 
-            overlapping_area = CoverArea.calculate(correct_region, overlapping_regions)
-            metric = overlapping_area / correct_region.get_area()
-            self.recall_aor_metrics.append(metric)
+    def update_metric_for_boxes(self, correct_boxes, predicted_boxes, overlapping_matrix):
+        overlapping_pairs = np.nonzero(overlapping_matrix)
+        overlapping_areas = CoverArea.calculate_batch(correct_boxes, predicted_boxes, overlapping_pairs)
+        correct_areas = correct_boxes[:, 2].astype(np.float64) * correct_boxes[:, 3]
+        self.accumulator.add(overlapping_areas / correct_areas)
 
     def calculate_result(self):
-        if len(self.recall_aor_metrics) > 0:
-            return sum(self.recall_aor_metrics) / len(self.recall_aor_metrics)
-        else:
-            return None
+        return self.accumulator.get_mean()
 
 
 class AverageDetectedBoxAreaPrecisionMetric:
-    def __init__(self):
-        self.precision_adba_metrics = []
+    def __init__(self, histogram_bins=None, window_frames=None):
+        self.accumulator = MetricAccumulator(histogram_bins, window_frames)
 
     def update_metric_for_frame(self, correct_regions, predicted_regions):
-        overlapping_matrix = Region.compare_exists_in_regions(correct_regions, predicted_regions)
-        predicted_regions_count = len(predicted_regions)
-        correct_regions_count = len(correct_regions)
-
-        for pr in range(predicted_regions_count):
-            predicted_region = predicted_regions[pr]
-            assert isinstance(predicted_region, Region)
-            overlapping_regions = []
-
-            for cr in range(correct_regions_count):
-                if overlapping_matrix[cr, pr]:
-                    full_region_overlapping = correct_regions[cr]
-                    overlapping_region = predicted_region.get_own_subregion(full_region_overlapping)
-                    overlapping_regions.append(overlapping_region)
-
-            overlapping_area = CoverArea.calculate(predicted_region, overlapping_regions)
-            predicted_area = predicted_region.get_area()
-            if predicted_area > 0:
-                metric = overlapping_area / predicted_area
-            else:
-                metric = 0
-            self.precision_adba_metrics.append(metric)
+        correct_boxes = regions_to_array(correct_regions)
+        predicted_boxes = regions_to_array(predicted_regions)
+        self.update_metric_for_boxes(correct_boxes, predicted_boxes,
+                                     get_overlapping_matrix(correct_boxes, predicted_boxes))
+
+    def update_metric_for_boxes(self, correct_boxes, predicted_boxes, overlapping_matrix):
+        correct_indexes, predicted_indexes = np.nonzero(overlapping_matrix)
+        overlapping_areas = CoverArea.calculate_batch(predicted_boxes, correct_boxes,
+                                                      (predicted_indexes, correct_indexes))
+        predicted_areas = predicted_boxes[:, 2].astype(np.float64) * predicted_boxes[:, 3]
+        is_not_empty = predicted_areas > 0
+        metrics = np.zeros(len(predicted_boxes))
+        metrics[is_not_empty] = overlapping_areas[is_not_empty] / predicted_areas[is_not_empty]
+        self.accumulator.add(metrics)
 
     def calculate_result(self):
-        if len(self.precision_adba_metrics) > 0:
-            return sum(self.precision_adba_metrics) / len(self.precision_adba_metrics)
-        else:
-            return None
+        return self.accumulator.get_mean()
 
 
 class AllMetricWrapper:
-    def __init__(self):
-        self.fragmentation_metric = FragmentationMetric()
-        self.recall_metric = AverageObjectAreaRecallMetric()
-        self.precision_metric = AverageDetectedBoxAreaPrecisionMetric()
+    def __init__(self, histogram_bins=None, window_frames=None):
+        """
+        :param histogram_bins: count of bins of histograms of values of metrics (None - no histograms)
+        :param window_frames: count of frames of a window of rollups of metrics (None - no rollups)
+        """
+        self.fragmentation_metric = FragmentationMetric(histogram_bins, window_frames)
+        self.recall_metric = AverageObjectAreaRecallMetric(histogram_bins, window_frames)
+        self.precision_metric = AverageDetectedBoxAreaPrecisionMetric(histogram_bins, window_frames)
         self.__all_metrics = [self.fragmentation_metric, self.recall_metric, self.precision_metric]
 
     def update_metric_for_frame(self, correct_regions, predicted_regions):
+        # The overlapping matrix is shared by all metrics
+        correct_boxes = regions_to_array(correct_regions)
+        predicted_boxes = regions_to_array(predicted_regions)
+        overlapping_matrix = get_overlapping_matrix(correct_boxes, predicted_boxes)
         for metric in self.__all_metrics:
-            metric.update_metric_for_frame(correct_regions, predicted_regions)
+            metric.update_metric_for_boxes(correct_boxes, predicted_boxes, overlapping_matrix)
 
     def calculate_result(self):
         results = []
         for metric in self.__all_metrics:
             results.append(metric.calculate_result())
         return results
+
+    def calculate_counts(self):
+        """Counts of values averaged by each metric (e.g. for weighting results of many videos)."""
+        return [metric.accumulator.count for metric in self.__all_metrics]
+
+    def get_windows(self):
+        """Rollups of each metric: lists of (first frame, mean or None, count) of closed windows."""
+        return [metric.accumulator.windows for metric in self.__all_metrics]
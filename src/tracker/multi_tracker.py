@@ -1,20 +1,29 @@
 import numpy as np
 
-from tracker.kalman import KalmanTracker
-from region import Region
+from tracker.association import DalkaAssociation
+from tracker.kalman import KalmanBank, KalmanTracker
+from region import Region, regions_to_array
 
 
 class MultiObjectsTracker:
     """Track multiple rectangular objects using and managing Kalman tracker.
     Logic of tracker management based on the doctoral dissertation (in Polish language):
         Dalka, P. (2015). Metody algorytmicznej analizy obrazu wizyjnego do zastosowań w monitorowaniu ruchu drogowego
+    Association of regions and trackers can be changed (see `tracker.association`), e.g. to Hungarian
+    assignment on IoU costs, which associates each region with at most one tracker.
     """
 
-    def __init__(self, lost_track_patience, min_prediction_area=10):
+    def __init__(self, lost_track_patience, min_prediction_area=10, association=None,
+                 history_size=KalmanBank.default_history_size):
         self.min_prediction_area = min_prediction_area
+        self.association = association if association is not None else DalkaAssociation()
         self.lost_track_patience = lost_track_patience
         self.trackers = []
         self.predictions = []
+        self.history_size = history_size
+        self.bank = KalmanBank(history_size=history_size)  # Keeps last `history_size` predictions of each tracker
+        self.births = 0
+        self.deaths = 0
 
         # Collect statistics of 6 types of situation
         self.cs1 = CaseStatistic("Tracker  1  <=> 0  Regions", "T:1-0:R")
@@ -32,113 +41,152 @@ class MultiObjectsTracker:
         # Create tracker for all new regions
         if len(self.trackers) == 0:
             for measure in measures_regions:
-                self.trackers.append(KalmanTracker(measure))
+                self.trackers.append(KalmanTracker(measure, bank=self.bank))
+            self.births += len(measures_regions)
 
         # Collect predictions
-        predicted_regions = []
-        trackers_to_remove = []
-        for tracker in self.trackers:
-            # Update predictions
-            tracker.predict()
-            # Delete when predicted region width or height change its value to negative or min area is too small
-            if tracker.act_prediction.was_reversed or tracker.act_prediction.get_area() < self.min_prediction_area:
-                trackers_to_remove.append(tracker)
-            else:
-                predicted_regions.append(tracker.act_prediction)
-        for tracker_to_remove in trackers_to_remove:
-            self.trackers.remove(tracker_to_remove)
-
-        # Get overlapping area of regions.
-        overlapping_matrix = Region.compare_exists_in_regions(measures_regions, predicted_regions)
-
-        trackers_count = len(self.trackers)
-        regions_count = len(measures_regions)
-        trackers_count_by_region = np.sum(overlapping_matrix, axis=1)
-        regions_count_by_tracker = np.sum(overlapping_matrix, axis=0)
+        self.__predict_all()
+        # Delete when predicted region width or height change its value to negative or min area is too small
+        self.__keep_trackers([not tracker.act_prediction.was_reversed and
+                              tracker.act_prediction.get_area() >= self.min_prediction_area
+                              for tracker in self.trackers])
+        predicted_regions = [tracker.act_prediction for tracker in self.trackers]
+
+        # Associate regions with trackers and solve 6 different cases.
+        measure_boxes = regions_to_array(measures_regions)
+        predicted_boxes = regions_to_array(predicted_regions)
+        cases = self.association.associate(measure_boxes, predicted_boxes)
 
-        # Update predictions for 6 different cases.
         # 1. Trackers 1  <=> 0  Regions
-        for i in range(trackers_count):
-            if regions_count_by_tracker[i] == 0:
-                self.trackers[i].mark_as_not_updated_in_this_frame()
-                self.cs1.count += 1
+        for t in cases.lost_trackers:
+            self.trackers[t].mark_as_not_updated_in_this_frame()
+        self.cs1.count += len(cases.lost_trackers)
 
         # 2. Trackers 0  <=> 1  Region
-        new_trackers = []
-        for i in range(regions_count):
-            if trackers_count_by_region[i] == 0:
-                tracker = KalmanTracker(measures_regions[i])
-                tracker.correct(measures_regions[i])
-                new_trackers.append(tracker)
-                self.cs2.count += 1
-
-        for t in range(trackers_count):
-            if regions_count_by_tracker[t] == 1:
-                for r in range(regions_count):
-                    if overlapping_matrix[r, t]:
-                        # 3. Trackers 1  <=> 1  Regions
-                        if trackers_count_by_region[r] == 1:
-                            tracker = self.trackers[t]
-                            tracker.correct(measures_regions[r])
-                            tracker.mark_as_updated_in_this_frame()
-                            self.cs3.count += 1
-                        # 4. Trackers 2+ <=> 1  Regions
-                        elif trackers_count_by_region[r] > 1:
-                            base_region = measures_regions[r]
-                            tracker_region = predicted_regions[t]
-                            sub_region = base_region.get_own_subregion(tracker_region)
-                            self.trackers[t].correct(sub_region)
-                            self.trackers[t].mark_as_updated_in_this_frame()
-                            self.cs4.count += 1
-            elif regions_count_by_tracker[t] > 1:
-                # 5.&6. collect regions
-                regions_for_tracker = []
-                nobody_have_multi_trackers = True
-                for r in range(regions_count):
-                    if overlapping_matrix[r, t]:
-                        if trackers_count_by_region[r] == 1:
-                            regions_for_tracker.append(measures_regions[r])
-                        elif trackers_count_by_region[r] > 1:
-                            regions_for_tracker.append(measures_regions[r])
-                            nobody_have_multi_trackers = False
-
-                if len(regions_for_tracker) > 0:
-                    merged_region = Region.merge_regions(regions_for_tracker)
-                    # 5. Trackers 1  <=> 2+ Regions - only if no regions have other tracker!
-                    if nobody_have_multi_trackers:
-                        self.trackers[t].correct(merged_region)
-                        self.trackers[t].mark_as_updated_in_this_frame()
-                        self.cs5.count += 1
-                    # 6. Trackers 2+ <=> 2+ Regions
-                    else:
-                        sub_region = merged_region.get_own_subregion(predicted_regions[t])
-                        self.trackers[t].correct(sub_region)
-                        self.trackers[t].mark_as_updated_in_this_frame()
-                        self.cs6.count += 1
+        new_trackers = [KalmanTracker(measures_regions[r], bank=self.bank) for r in cases.new_regions]
+        self.cs2.count += len(cases.new_regions)
+        self.births += len(new_trackers)
+
+        # 3. Trackers 1  <=> 1  Regions - correct by the region
+        # 4. Trackers 2+ <=> 1  Regions - correct by own part of the region
+        # 5. Trackers 1  <=> 2+ Regions - only if no regions have other tracker! Correct by merged regions.
+        # 6. Trackers 2+ <=> 2+ Regions - correct by own part of merged regions
+        self.cs3.count += len(cases.single_trackers)
+        self.cs4.count += len(cases.shared_trackers)
+        self.cs5.count += len(cases.merged_trackers)
+        self.cs6.count += len(cases.merged_shared_trackers)
+        updated_trackers = [self.trackers[t] for t in np.concatenate([
+            cases.single_trackers, cases.shared_trackers, cases.merged_trackers, cases.merged_shared_trackers])]
+        for tracker in updated_trackers:
+            tracker.mark_as_updated_in_this_frame()
+
+        # Correct all trackers (new trackers by its regions) at once
+        corrected_trackers = updated_trackers + new_trackers
+        correction_boxes = np.concatenate([
+            measure_boxes[cases.single_regions], cases.shared_boxes, cases.merged_boxes, cases.merged_shared_boxes,
+            measure_boxes[cases.new_regions]])
+        if len(corrected_trackers) > 0:
+            estimated = self.bank.correct([tracker.slot for tracker in corrected_trackers], correction_boxes)
+            for tracker, estimated_measure in zip(corrected_trackers, estimated):
+                tracker.set_correction(estimated_measure)
 
         # Delete outdated tracker:
-        self.trackers = [tracker for tracker in self.trackers
-                         if tracker.frames_without_update < self.lost_track_patience]
+        self.__keep_trackers([tracker.frames_without_update < self.lost_track_patience
+                              for tracker in self.trackers])
 
         self.trackers.extend(new_trackers)
         self.predictions = [tracker.act_prediction for tracker in self.trackers if tracker.frames_without_update == 0]
 
+    def __predict_all(self):
+        if len(self.trackers) == 0:
+            return
+        predictions = self.bank.predict([tracker.slot for tracker in self.trackers])
+        for tracker, prediction in zip(self.trackers, predictions):
+            tracker.set_prediction(prediction)
+
+    def __keep_trackers(self, keep):
+        """Keep only selected trackers and release the rest."""
+        kept_trackers = []
+        for tracker, is_kept in zip(self.trackers, keep):
+            if is_kept:
+                kept_trackers.append(tracker)
+            else:
+                tracker.release()
+        self.deaths += len(self.trackers) - len(kept_trackers)
+        self.trackers = kept_trackers
+
     def update_in_nothing_detected_region_case(self):
-        trackers_to_remove = []
         for tracker in self.trackers:
             tracker.mark_as_not_updated_in_this_frame()
-            # Remove missing tracker
-            if tracker.frames_without_update > self.lost_track_patience:
-                trackers_to_remove.append(tracker)
-        for tracker in trackers_to_remove:
-            self.trackers.remove(tracker)
+        # Remove missing tracker
+        self.__keep_trackers([tracker.frames_without_update <= self.lost_track_patience
+                              for tracker in self.trackers])
         # Predict the move in hidden:
-        for tracker in self.trackers:
-            predict = tracker.predict()
+        self.__predict_all()
         self.predictions = [prediction.act_prediction for prediction in self.trackers]
 
+    def coast(self):
+        """Predict the move of all trackers without any measurement (e.g. the frame was skipped under load).
+
+        Unlike `update_in_nothing_detected_region_case`, frames without update aren't counted, so trackers
+        aren't lost because of skipped frames.
+        """
+        self.__predict_all()
+        self.predictions = [tracker.act_prediction for tracker in self.trackers if tracker.frames_without_update == 0]
+
+    def get_state(self):
+        """Get the state of all trackers and of the bank of filters as a dict of arrays (see `set_state`)."""
+        trackers = self.trackers
+        state = {'bank_' + name: array for name, array in self.bank.get_state().items()}
+        state.update({
+            'tracker_ids': np.array([tracker.tracker_id for tracker in trackers], dtype=np.int64),
+            'slots': np.array([tracker.slot for tracker in trackers], dtype=np.int64),
+            'colors': np.array([tracker.color for tracker in trackers], dtype=np.int32).reshape(-1, 3),
+            'start_boxes': regions_to_array([tracker.start_measure for tracker in trackers]),
+            'predicted_boxes': regions_to_array([tracker.act_prediction for tracker in trackers]),
+            'frames_without_update': np.array([tracker.frames_without_update for tracker in trackers], dtype=np.int64),
+            'life_times': np.array([tracker.life_time for tracker in trackers], dtype=np.int64),
+            'is_predicted': np.array([any(prediction is tracker.act_prediction for prediction in self.predictions)
+                                      for tracker in trackers], dtype=bool),
+            'counters': np.array([KalmanTracker.next_id, self.births, self.deaths] +
+                                 [case_statistic.count for case_statistic in self.get_case_statistics()],
+                                 dtype=np.int64),
+        })
+        return state
+
+    def set_state(self, state):
+        """Restore trackers from the state got by `get_state` (with the size of history of this tracker)."""
+        self.bank = KalmanBank(capacity=0, history_size=self.history_size)
+        self.bank.set_state({name[len('bank_'):]: array for name, array in state.items() if name.startswith('bank_')})
+        self.trackers = []
+        for i, tracker_id in enumerate(state['tracker_ids'].tolist()):
+            start_x, start_y, start_w, start_h = state['start_boxes'][i].tolist()
+            x, y, w, h = state['predicted_boxes'][i].tolist()
+            self.trackers.append(KalmanTracker.restore(
+                self.bank, int(state['slots'][i]), tracker_id, tuple(state['colors'][i].tolist()),
+                Region.from_box(start_x, start_y, start_w, start_h), Region.from_box(x, y, w, h),
+                int(state['frames_without_update'][i]), int(state['life_times'][i])))
+        self.predictions = [tracker.act_prediction
+                            for tracker, is_predicted in zip(self.trackers, state['is_predicted']) if is_predicted]
+        counters = state['counters'].tolist()
+        KalmanTracker.next_id = max(KalmanTracker.next_id, counters[0])
+        self.births, self.deaths = counters[1], counters[2]
+        for case_statistic, count in zip(self.get_case_statistics(), counters[3:]):
+            case_statistic.count = count
+
+    def get_tracks_array(self):
+        """Get actual predictions of all trackers as (N,5) int32 array of (tracker_id, x, y, w, h)."""
+        tracks = np.empty((len(self.trackers), 5), dtype=np.int32)
+        for i, tracker in enumerate(self.trackers):
+            prediction = tracker.act_prediction
+            tracks[i] = (tracker.tracker_id, prediction.x, prediction.y, prediction.w, prediction.h)
+        return tracks
+
+    def get_case_statistics(self):
+        return [self.cs1, self.cs2, self.cs3, self.cs4, self.cs5, self.cs6]
+
     def statistics(self):
-        statistics = str([self.cs1, self.cs2, self.cs3, self.cs4, self.cs5, self.cs6])
+        statistics = str(self.get_case_statistics())
         return str(len(self.trackers))+" Trackers, cases = " + statistics
 
 
@@ -1,29 +1,32 @@
 import cv2
 import numpy as np
 
+from instrumentation import Instrumentation
+
 
 class MorphologicalTransformer:
-    """Adjust and apply morphological transformations"""
+    """Adjust and apply morphological transformations.
+
+    Sizes of kernels are read from trackbars of the given window. When a config is given
+    (or there is no window) they are read from the config instead, so no GUI is needed.
+    All kernels are rectangular (array with ones) - OpenCV applies them separably, by rows and columns.
+    """
 
-    def __init__(self, window_name, max_close_kernel=35):
+    def __init__(self, window_name=None, max_close_kernel=35, config=None):
+        assert window_name is not None or config is not None
         self.window_name = window_name
+        self.config = config
         self.max_close_kernel = max_close_kernel
         self.__track_bars_created = False
 
-        # Prepare gaussian kernels:
-        gauss_kernels = []
-        for i in range(1, max_close_kernel + 1):
-            kernel_gauss_1d = cv2.getGaussianKernel(i, -1)
-            kernel_gauss_2d = np.matmul(kernel_gauss_1d, kernel_gauss_1d.transpose())
-            gauss_kernels.append(kernel_gauss_2d)
-        self.__gauss_kernels = gauss_kernels
-
-        # Prepare simple kernels (array with ones)
+        # Prepare simple kernels (array with ones). Gaussian kernels were used for open and close before,
+        # but morphology takes into account only nonzero elements of a kernel, so the result is the same.
         simple_kernels = []
         for size_of_kernel in range(1, max_close_kernel + 1):
-            kernel = np.ones((size_of_kernel, size_of_kernel), np.uint8)
+            kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (size_of_kernel, size_of_kernel))
             simple_kernels.append(kernel)
         self.__simple_kernels = simple_kernels
+        self.__buffers = {}  # Preallocated images reused in each frame by `get_foreground_mask`
 
     def create_trackbars(self):
         def nothing(_): pass
@@ -34,8 +37,13 @@ class MorphologicalTransformer:
         cv2.createTrackbar('Kernel_CLOSE', self.window_name, 25, self.max_close_kernel, nothing)
         cv2.createTrackbar('Shadows', self.window_name, 0, 200, nothing)
 
+    def get_value(self, trackbar_name):
+        if self.config is not None:
+            return self.config.get_trackbar_value(trackbar_name)
+        return cv2.getTrackbarPos(trackbar_name, self.window_name)
+
     def setup_shadows_settings(self, background_subtractor):
-        shadows = cv2.getTrackbarPos('Shadows', self.window_name)
+        shadows = self.get_value('Shadows')
         if shadows == 0:
             background_subtractor.setDetectShadows(False)
         else:
@@ -43,7 +51,7 @@ class MorphologicalTransformer:
             background_subtractor.setShadowThreshold(shadows)
 
     def apply_erode(self, mask_org):
-        size_of_kernel_erode = cv2.getTrackbarPos('Erode', self.window_name)
+        size_of_kernel_erode = self.get_value('Erode')
         mask_out = mask_org
         if size_of_kernel_erode > 0:
             kernel_erode = self.__simple_kernels[size_of_kernel_erode-1]
@@ -51,7 +59,7 @@ class MorphologicalTransformer:
         return mask_out
 
     def apply_dilate(self, mask_org):
-        size_of_kernel_dilate = cv2.getTrackbarPos('Dilate', self.window_name)
+        size_of_kernel_dilate = self.get_value('Dilate')
         mask_out = mask_org
         if size_of_kernel_dilate > 0:
             kernel_dilate = self.__simple_kernels[size_of_kernel_dilate-1]
@@ -59,25 +67,101 @@ class MorphologicalTransformer:
         return mask_out
 
     def apply_morph_open(self, mask_org):
-        size_of_kernel_open = cv2.getTrackbarPos('Kernel_OPEN', self.window_name)
+        size_of_kernel_open = self.get_value('Kernel_OPEN')
         mask_out = mask_org
         if size_of_kernel_open > 0:
-            kernel_open = self.__gauss_kernels[size_of_kernel_open - 1]
+            kernel_open = self.__simple_kernels[size_of_kernel_open - 1]
             mask_out = cv2.morphologyEx(mask_org, cv2.MORPH_OPEN, kernel_open)
         return mask_out
 
     def apply_morph_close(self, mask_org):
-        size_of_kernel_close = cv2.getTrackbarPos('Kernel_CLOSE', self.window_name)
+        size_of_kernel_close = self.get_value('Kernel_CLOSE')
         mask_out = mask_org
         if size_of_kernel_close > 0:
-            kernel_close = self.__gauss_kernels[size_of_kernel_close - 1]
+            kernel_close = self.__simple_kernels[size_of_kernel_close - 1]
             mask_out = cv2.morphologyEx(mask_org, cv2.MORPH_CLOSE, kernel_close)
         return mask_out
 
     def apply_blur(self, frame):
-        size_of_kernel_blur = cv2.getTrackbarPos('Blur', self.window_name)
+        size_of_kernel_blur = self.get_value('Blur')
         result_frame = frame
         if size_of_kernel_blur > 0:
             size_real = (size_of_kernel_blur - 1) * 2 + 1
             result_frame = cv2.GaussianBlur(frame, (size_real, size_real), 0)
         return result_frame
+
+    def get_downscale(self):
+        """Get factor of downscaling of frames before the background subtraction (1 - full resolution)."""
+        if self.config is not None:
+            return self.config.downscale
+        return 1
+
+    def downscale_frame(self, frame):
+        downscale = self.get_downscale()
+        if downscale == 1:
+            return frame
+        height, width = frame.shape[:2]
+        size = (max(1, int(round(width / downscale))), max(1, int(round(height / downscale))))
+        small_frame = self.__get_buffer('small_frame', (size[1], size[0]) + frame.shape[2:])
+        return cv2.resize(frame, size, dst=small_frame, interpolation=cv2.INTER_AREA)
+
+    def get_foreground_mask(self, frame, background_subtractor, learning_rate, instrumentation=None):
+        """Get binary mask of moving objects (without shadows) - blur, background subtraction and morphology
+        fused into one pass over preallocated buffers.
+
+        The mask has the size of the frame downscaled by `get_downscale()` (sizes of kernels are scaled too),
+        so it's much cheaper on HD frames. Shadows are removed by the threshold just after the subtraction -
+        the threshold commutes with morphology of flat kernels, so the mask is the same as with the threshold
+        at the end. The returned mask is overwritten by the next call.
+        """
+        mask = self.get_subtracted_mask(frame, background_subtractor, learning_rate, instrumentation)
+        return self.apply_morphology(mask, instrumentation)
+
+    def get_subtracted_mask(self, frame, background_subtractor, learning_rate, instrumentation=None):
+        """Get binary mask of moving objects (without shadows) before morphology - see `get_foreground_mask`."""
+        if instrumentation is None:
+            instrumentation = Instrumentation(enabled=False)
+        with instrumentation.stage('blur'):
+            small_frame = self.downscale_frame(frame)
+            size_of_kernel_blur = self.get_value('Blur')
+            frame_blurred = small_frame
+            if size_of_kernel_blur > 0:
+                size_real = self.__scale_kernel_size((size_of_kernel_blur - 1) * 2 + 1) | 1
+                frame_blurred = cv2.GaussianBlur(small_frame, (size_real, size_real), 0,
+                                                 dst=self.__get_buffer('frame_blurred', small_frame.shape))
+        with instrumentation.stage('background_subtraction'):
+            mask = background_subtractor.apply(frame_blurred, fgmask=self.__get_buffer('mask', small_frame.shape[:2]),
+                                               learningRate=learning_rate)
+        with instrumentation.stage('remove_shadows'):
+            cv2.threshold(mask, 128, 255, cv2.THRESH_BINARY, dst=mask)
+        return mask
+
+    def apply_morphology(self, mask, instrumentation=None):
+        """Apply erode, dilate, open and close to the binary mask in place."""
+        if instrumentation is None:
+            instrumentation = Instrumentation(enabled=False)
+        with instrumentation.stage('erode'):
+            self.__apply_in_place(mask, cv2.MORPH_ERODE, 'Erode')
+        with instrumentation.stage('dilate'):
+            self.__apply_in_place(mask, cv2.MORPH_DILATE, 'Dilate')
+        with instrumentation.stage('morph_open'):
+            self.__apply_in_place(mask, cv2.MORPH_OPEN, 'Kernel_OPEN')
+        with instrumentation.stage('morph_close'):
+            self.__apply_in_place(mask, cv2.MORPH_CLOSE, 'Kernel_CLOSE')
+        return mask
+
+    def __apply_in_place(self, mask, operation, trackbar_name):
+        size_of_kernel = self.__scale_kernel_size(self.get_value(trackbar_name))
+        if size_of_kernel > 0:
+            cv2.morphologyEx(mask, operation, self.__simple_kernels[size_of_kernel - 1], dst=mask)
+
+    def __scale_kernel_size(self, size_of_kernel):
+        if size_of_kernel <= 0:
+            return 0
+        return max(1, int(round(size_of_kernel / self.get_downscale())))
+
+    def __get_buffer(self, name, shape):
+        buffer = self.__buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = self.__buffers[name] = np.empty(shape, dtype=np.uint8)
+        return buffer